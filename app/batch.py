@@ -0,0 +1,86 @@
+from uuid import uuid4 as uuid
+
+
+class RemoteScript(object):
+    """ a shell script of named steps to run on a host in one round trip
+
+    Steps run in order. Once a step fails the remaining ordinary steps are
+    skipped, steps added with always=True run regardless (for clean up). The
+    output of a run can be parsed back into a result per step.
+
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.token = "HERD-STEP-{}".format(uuid().hex)
+
+    def step(self, name, cmd, always=False):
+        """ add a step running cmd """
+        self.steps.append((name, cmd, always))
+
+    def write_file(self, name, path, content):
+        """ add a step writing content to a private file at path """
+        if not content.endswith('\n'):
+            content += '\n'
+        cmd = "umask 077; cat > {} <<'{}'\n{}{}".format(
+            path, self.token, content, self.token)
+        self.step(name, cmd)
+
+    def render(self):
+        """ return the text of the script """
+        lines = ["herd_status=0"]
+        for name, cmd, always in self.steps:
+            run_step = [
+                'echo "{} begin {}"'.format(self.token, name),
+                "(\n{}\n) 2>&1".format(cmd),
+                "herd_step_status=$?",
+                'echo "{} end {} $herd_step_status"'.format(self.token, name),
+                "if [ $herd_step_status -ne 0 ] && [ $herd_status -eq 0 ]; then",
+                "    herd_status=$herd_step_status",
+                "fi",
+                ]
+            if always:
+                lines += run_step
+            else:
+                lines.append("if [ $herd_status -eq 0 ]; then")
+                lines += run_step
+                lines.append("else")
+                lines.append('    echo "{} skip {}"'.format(self.token, name))
+                lines.append("fi")
+        lines.append("exit $herd_status")
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, output):
+        """ return a result dict per step from the script's output
+
+        each result has the step's name, exit_code (None if it was skipped or
+        never reported), whether it was skipped and output
+
+        """
+
+        results = dict(
+            (name, {'name': name, 'exit_code': None, 'skipped': False,
+                    'output': []})
+            for name, cmd, always
+            in self.steps
+            )
+        current = None
+        for line in output.splitlines():
+            line = line.rstrip('\r')
+            if line.startswith(self.token + ' '):
+                marker = line[len(self.token) + 1:].split(' ')
+                if marker[0] == 'begin':
+                    current = results.get(marker[1])
+                elif marker[0] == 'end' and marker[1] in results:
+                    results[marker[1]]['exit_code'] = int(marker[2])
+                    current = None
+                elif marker[0] == 'skip' and marker[1] in results:
+                    results[marker[1]]['skipped'] = True
+                continue
+            if current is not None:
+                current['output'].append(line)
+
+        ordered = [results[name] for name, cmd, always in self.steps]
+        for result in ordered:
+            result['output'] = '\n'.join(result['output'])
+        return ordered
@@ -1,19 +1,15 @@
 import os
+import csv
+import json
+import time
 import datetime
 import base64
-from itertools import islice
+import itertools
+import multiprocessing
+from importlib import import_module
 from ConfigParser import ConfigParser
 from StringIO import StringIO
 from fabric.api import *
-from sqlalchemy import (
-    create_engine,
-    Column,
-    Integer,
-    String,
-    DateTime,
-    )
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
 from helpers import *
 from config import (
@@ -21,30 +17,91 @@ from config import (
     config_path
     )
 import security
+import connections
+import batch
 
 env.use_ssh_config = True
 
+default_deploy_concurrency = 8
+default_releases_limit = 10
+default_releases_page_size = 100
+default_gc_hours = 24
+default_secret_index_path = "~/.herd/secret_index.db"
+# seconds before the local secret index is synced again
+default_secret_index_max_age = 60
+
+# images carry their manifest as herd.<section>.<option> labels
+manifest_label_prefix = "herd."
+
 
 def trivial(*args, **kwargs):
     pass
 
-Base = declarative_base()
 
+def open_release_store():
+    """ open the configured release store
+
+    the store module is imported here so commands that don't touch releases
+    don't pay for importing sqlalchemy
+
+    """
+    from store import ReleaseStore
+    return ReleaseStore(get_config()['release_store_db'])
+
+
+def open_secret_index():
+    """ open the local index of the configured secret store """
+    from store import SecretIndex
+    db_uri = get_config().get('security_secret_index_db')
+    if db_uri is None:
+        path = os.path.expanduser(default_secret_index_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0700)
+        db_uri = "sqlite:///{}".format(path)
+    return SecretIndex(
+        db_uri, get_config()['security_remote_secret_store'])
 
-def stage_config(release, host):
-    """ stage a config file on the a host """
+
+def decrypt_config(release):
+    """ fetch the release's config from the secret store and decrypt it """
     cypherfile = security.fetch_secret(release.config)
-    plaintext = security.decrypt_and_verify_file(cypherfile)
-    stage_name = base64.urlsafe_b64encode(os.urandom(32))
+    return security.decrypt_and_verify_file(cypherfile)
+
+
+def stage_config(release, host, plaintext=None):
+    """ stage a config file on the a host
+
+    if the plaintext is not given the release's config is fetched and
+    decrypted as it is uploaded, so it is never held in memory. A config that
+    fails verification once uploaded is wiped again.
+
+    """
+    stage_name = new_stage_name()
     config_stage_path = os.path.join(
         get_config()['deploy_config_stage_path'],
         stage_name,
         )
     with settings(host_string=host):
-        put(StringIO(plaintext), config_stage_path)
+        if plaintext is not None:
+            put(StringIO(plaintext), config_stage_path)
+            return stage_name
+
+        cypherfile = security.fetch_secret(release.config)
+        try:
+            put(security.decrypt_and_verify_stream(cypherfile),
+                config_stage_path)
+        except:
+            with settings(warn_only=True):
+                run("shred -u {}".format(config_stage_path))
+            raise
     return stage_name
 
 
+def new_stage_name():
+    """ a random, unguessable name for a staged config """
+    return base64.urlsafe_b64encode(os.urandom(32))
+
+
 def wipe_config(host, stage_name):
     """ wipe the staged config from the host """
     with settings(host_string=host):
@@ -56,16 +113,28 @@ def wipe_config(host, stage_name):
 
 
 def get_manifest(release, host):
-    """ return the port that the release will expose it's service on
+    """ return the manifest of the release's build
 
-    @TODO update this to use docker image labels when that's available
+    The manifest is read from the image's herd.<section>.<option> labels.
+    Legacy images without those labels fall back to reading /Manifest out of
+    a throwaway container.
 
     """
+    return read_manifest(release.build, host)
+
+
+def read_manifest(build, host):
+    """ pull the build on the host and return its manifest """
 
     with settings(host_string=host):
-        run("docker pull {}".format(release.build))
-        manifest_string = run(
-            "docker run {} cat /Manifest".format(release.build))
+        run("docker pull {}".format(build))
+        labels = run("docker inspect --format '{{{{json .Config.Labels}}}}' {}"
+                     .format(build))
+        manifest = manifest_from_labels(json.loads(labels) or {})
+        if manifest is not None:
+            return manifest
+
+        manifest_string = run("docker run --rm {} cat /Manifest".format(build))
 
         manifest = ConfigParser(allow_no_value=True)
         manifest_file = StringIO(manifest_string)
@@ -73,6 +142,62 @@ def get_manifest(release, host):
         return manifest
 
 
+def resolve_build(build_name, host=None):
+    """ return the manifest and image digest of a build
+
+    The build is pulled and inspected on the host, by default the first
+    configured build host. Nothing is built, so the pool isn't probed for
+    the least loaded host. The digest is the repo@sha256 reference of the
+    build, or None if the registry did not report one.
+
+    """
+
+    if host is None:
+        host = build_hosts()[0]
+    manifest = read_manifest(build_name, host)
+    with settings(host_string=host):
+        repo_digests = run(
+            "docker inspect --format '{{{{json .RepoDigests}}}}' {}".format(
+                build_name))
+    repo_digests = json.loads(repo_digests) or []
+
+    # prefer the digest from the repository the build was named by
+    repository = build_name
+    if ':' in build_name.split('/')[-1]:
+        repository = build_name.rsplit(':', 1)[0]
+    matching = [d for d in repo_digests if d.startswith(repository + '@')]
+    image_digest = (matching or repo_digests or [None])[0]
+    return manifest, image_digest
+
+
+def manifest_from_labels(labels):
+    """ build a manifest from image labels, None if there are no herd labels
+
+    herd.service.service_port=9418 becomes service_port in [Service] and
+    herd.dependencies.environment_name= becomes a valueless option in
+    [Dependencies].
+
+    """
+
+    manifest = ConfigParser(allow_no_value=True)
+    for label, value in sorted(labels.items()):
+        if not label.startswith(manifest_label_prefix):
+            continue
+        section, _, option = label[len(manifest_label_prefix):].partition('.')
+        if not option:
+            continue
+        section = section.capitalize()
+        if not manifest.has_section(section):
+            manifest.add_section(section)
+        manifest.set(section, option, value or None)
+
+    if not manifest.has_section("Service"):
+        return None
+    if not manifest.has_section("Dependencies"):
+        manifest.add_section("Dependencies")
+    return manifest
+
+
 def execute_release(release, host, port, stage_name):
     """ run the build on the host with the config
 
@@ -80,7 +205,22 @@ def execute_release(release, host, port, stage_name):
 
     """
 
-    manifest = get_manifest(release, host)
+    # releases configured with their manifest don't need the image inspected,
+    # but unless it is pinned by digest the tag may have moved since the host
+    # last pulled it
+    manifest = release.stored_manifest
+    if manifest is None:
+        manifest = get_manifest(release, host)
+    elif release.image_digest is None:
+        with settings(host_string=host):
+            run("docker pull {}".format(release.image))
+
+    with settings(host_string=host):
+        run(docker_run_command(release, manifest, port, stage_name))
+
+
+def docker_run_command(release, manifest, port, stage_name):
+    """ the docker run command for the release with the staged config """
 
     # create p flag
     service_port = manifest.get("Service", "service_port")
@@ -106,112 +246,540 @@ def execute_release(release, host, port, stage_name):
         p_flag=p_flag,
         envfile_flag=envfile_flag,
         e_flags=e_flags,
-        build_name=release.build,
+        build_name=release.image,
         )
-    with settings(host_string=host):
-        run(cmd)
+    return cmd
 
 
-def deploy(release_id, host):
-    """ look up the release, and deploy it """
-    release_store = ReleaseStore(get_config()['release_store_db'])
-    __deploy__(release_store.get(release_id), host)
+def batch_deploy(release, host, port, plaintext):
+    """ deploy the release on the host with a single remote script
 
+    Staging the config, pulling the image (only if it is missing when it is
+    pinned by digest), running it and wiping the config are done by one
+    script sent to the host. As with the step by step deploy a failed step
+    aborts the deploy, and the config is wiped regardless. A script that
+    stops before every step has reported, like when bash is missing or the
+    connection drops, aborts as well after wiping what it may have left.
+    Releases without a stored manifest have their image inspected first.
+    Returns the result of each step.
 
-def __deploy__(release, host):
-    """ deploy the release on the host """
-    # set host to host and port to port if port is in the host string
-    # and to None otherwise
-    host_port = host.split(':') + [None]
-    host, port = tuple(host_port[0:2])
-    stage_name = stage_config(release, host)
-    execute_release(release, host, port, stage_name)
-    wipe_config(host, stage_name)
-    print
-    print "---> Success,", release, "was executed on", "{}:{}".format(host, port)
+    """
 
+    manifest = release.stored_manifest
+    if manifest is None:
+        manifest = get_manifest(release, host)
 
-class Release(Base):
-    __tablename__ = 'releases'
+    stage_name = new_stage_name()
+    stage_path = os.path.join(
+        get_config()['deploy_config_stage_path'],
+        stage_name,
+        )
+    script_path = "{}.sh".format(stage_path)
+
+    script = batch.RemoteScript()
+    script.write_file("stage_config", stage_path, plaintext)
+    if release.image_digest is None:
+        # a tag may have moved since the host last pulled it
+        script.step("pull", "docker pull {}".format(release.image))
+    else:
+        script.step("pull", "docker inspect --type=image {0} >/dev/null 2>&1 "
+                    "|| docker pull {0}".format(release.image))
+    script.step("execute_release",
+                docker_run_command(release, manifest, port, stage_name))
+    script.step("wipe_config", "shred -u {}".format(stage_path), always=True)
+    script.step("wipe_script", "shred -u {}".format(script_path), always=True)
 
-    id_ = Column(Integer, primary_key=True)
-    build = Column(String(1024))
-    config = Column(String(1024))
-    created_datetime = Column(DateTime, default=datetime.datetime.utcnow)
+    with settings(host_string=host):
+        put(StringIO(script.render()), script_path, mode=0600)
+        with settings(warn_only=True):
+            output = run("bash {}".format(script_path))
+
+    results = script.parse(output)
+    unreported = [result['name'] for result in results
+                  if result['exit_code'] is None and not result['skipped']]
+    failed = [result for result in results if result['exit_code']]
+    if unreported or (output.failed and not failed):
+        # the script stopped before its end, so the config and the script
+        # may still be on the host
+        with settings(host_string=host, warn_only=True):
+            run("shred -u {} {}".format(stage_path, script_path))
+        abort("The deploy script did not finish on {}, exit status {}:\n{}"
+              .format(host, output.return_code, output))
+    if failed:
+        abort("{} failed on {}:\n{}".format(
+                failed[0]['name'], host, failed[0]['output']))
+    return results
+
+
+def deploy(release_id, *args):
+    """ look up the release, and deploy it to every host
+
+    herd deploy <release id> <host[:port]>... [--hosts-file PATH]
+        [--concurrency N] [--wave-size N] [--max-failures N] [--batch]
 
-    def __repr__(self):
-        return "<Release: build={}, config={}, id={} created_datetime={}>" \
-            .format(self.build, self.config, self.id_, self.created_datetime)
+    """
+    hosts, options = parse_options(
+        args,
+        concurrency=default_deploy_concurrency,
+        hosts_file=None,
+        wave_size=None,
+        max_failures=None,
+        batch=False,
+        )
+    if options['hosts_file']:
+        hosts += read_hosts_file(options['hosts_file'])
+    if not hosts:
+        raise ValueError("deploy requires at least one host")
+
+    def optional_int(value):
+        return None if value is None else int(value)
+
+    release_store = open_release_store()
+    results = rollout(
+        release_store.get(release_id),
+        hosts,
+        concurrency=int(options['concurrency']),
+        wave_size=optional_int(options['wave_size']),
+        max_failures=optional_int(options['max_failures']),
+        batched=options['batch'],
+        )
+    report_deploy(results)
 
-    def __str__(self):
-        return "Release {}: [{}] {}, {}".format(
-            self.id_, self.created_datetime, self.build, self.config)
+    failures = [result for result in results if not result['ok']]
+    if failures or len(results) < len(hosts):
+        abort("{} of {} hosts failed to deploy, {} were not attempted".format(
+                len(failures), len(hosts), len(hosts) - len(results)))
 
 
-class ReleaseStore(object):
-    """ stores build, release pairs """
+def read_hosts_file(path):
+    """ read host[:port] targets, one per line, skipping blanks and comments """
+    with open(path, 'r') as hostsfile:
+        lines = [line.split('#')[0].strip() for line in hostsfile]
+    return [line for line in lines if line]
 
-    def __init__(self, db_uri):
-        engine = create_engine(db_uri)
-        Base.metadata.create_all(engine)
-        self.session = sessionmaker(bind=engine)()
 
-    def put(self, build, config):
-        """ put a new release into the store """
+def rollout(release,
+            hosts,
+            concurrency=1,
+            wave_size=None,
+            max_failures=None,
+            batched=False,
+            ):
+    """ deploy the release to the hosts in waves of wave_size hosts
 
-        new_release = Release(build=build, config=config)
-        self.session.add(new_release)
-        self.session.commit()
-        return new_release
+    Each wave must finish before the next one starts, and the rollout stops
+    once more than max_failures hosts have failed. While a wave is deploying
+    the next wave's hosts pull the build so they are ready to start quickly.
+    Returns the results of every host that was attempted.
 
-    def get(self, id_):
-        """ get a release by it's id """
-        return self.session.query(Release).filter(
-            Release.id_==str(id_)).first()
+    """
 
-    def list(self, slice_start=0, slice_end=10):
-        return list(
-            islice(
-                self.session.query(Release).all(),
-                slice_start,
-                slice_end
-                )
-            )
+    waves = [
+        hosts[i:i + (wave_size or len(hosts))]
+        for i
+        in range(0, len(hosts), wave_size or len(hosts))
+        ]
+
+    # fork the pre-pull workers before the config is decrypted so they never
+    # hold a copy of it, the release was already read from the store though
+    prepull_pool = None
+    if len(waves) > 1:
+        prepull_pool = multiprocessing.Pool(concurrency, init_worker)
+
+    results = []
+    try:
+        # only a batch script needs the plaintext, otherwise stage_config
+        # streams it to each host
+        plaintext = decrypt_config(release) if batched else None
+        for index, wave in enumerate(waves):
+            print "---> Wave {} of {}: {}".format(
+                index + 1, len(waves), ', '.join(wave))
+            if index + 1 < len(waves):
+                prepull(release, waves[index + 1], prepull_pool)
+            results += deploy_to_hosts(
+                release, wave, concurrency, plaintext, batched)
+
+            failures = len([result for result in results if not result['ok']])
+            if max_failures is not None and failures > max_failures:
+                print "---> Stopping rollout, {} failures exceeds {}".format(
+                    failures, max_failures)
+                break
+    finally:
+        if prepull_pool is not None:
+            prepull_pool.terminate()
+            prepull_pool.join()
+    return results
+
+
+def prepull(release, hosts, pool):
+    """ start pulling the release's build on the hosts in the background """
+    pool.map_async(__prepull_job__, [(release, host) for host in hosts])
+
+
+def __prepull_job__(job):
+    """ pull a build on a host, failures are left for the deploy to report """
+    release, host = job
+    with settings(host_string=host.split(':')[0], warn_only=True):
+        capture_failure(run, "docker pull {}".format(release.image))
+
+
+def deploy_to_hosts(release, hosts, concurrency=1, plaintext=None,
+                    batched=False):
+    """ deploy the release to each host on a bounded pool of workers
+
+    Unless batched, each host's config is decrypted as it is uploaded, so the
+    plaintext is never held in memory. That costs a gpg run per host instead
+    of a single decrypt, the cyphertext is cached before the workers fork so
+    it is still fetched only once. A batched deploy writes the config into
+    its script, so it is decrypted once, unless it is given, and handed to
+    every worker. Workers are processes rather than threads because fabric
+    keeps the current host in its global env. Returns a result dict per host
+    in the order given.
+
+    """
+
+    if plaintext is None and batched:
+        plaintext = decrypt_config(release)
+    elif plaintext is None:
+        security.cache_secret(release.config)
+    jobs = [(release, host, plaintext, batched) for host in hosts]
+    if concurrency > 1 and len(jobs) > 1:
+        with worker_pool(min(concurrency, len(jobs))) as pool:
+            results = pool.map(__deploy_job__, jobs)
+        # connections made by the workers count towards this invocation
+        for result in results:
+            connections.stats.merge(result['connections'])
+        return results
+    return map(__deploy_job__, jobs)
+
+
+def __deploy_job__(job):
+    """ deploy one (release, host, plaintext, batched) job and report it """
+    release, host, plaintext, batched = job
+    start = time.time()
+    connections_before = connections.stats.snapshot()
+    _, error = capture_failure(__deploy__, release, host, plaintext, batched)
+    return {
+        'host': host,
+        'ok': error is None,
+        'error': error,
+        'seconds': time.time() - start,
+        'connections': connections.stats.since(connections_before),
+        }
+
+
+def report_deploy(results):
+    """ print the outcome and timing of each host's deploy """
+    print
+    for result in results:
+        if result['ok']:
+            status = "ok"
+        else:
+            status = "FAILED ({})".format(result['error'])
+        print "---> {} {} in {:.1f}s".format(
+            result['host'], status, result['seconds'])
+
+
+def __deploy__(release, host, plaintext=None, batched=False):
+    """ deploy the release on the host
+
+    when batched the remote steps are sent to the host as a single script
+
+    """
+    # set host to host and port to port if port is in the host string
+    # and to None otherwise
+    host_port = host.split(':') + [None]
+    host, port = tuple(host_port[0:2])
+    if batched:
+        if plaintext is None:
+            plaintext = decrypt_config(release)
+        batch_deploy(release, host, port, plaintext)
+    else:
+        stage_name = stage_config(release, host, plaintext)
+        execute_release(release, host, port, stage_name)
+        wipe_config(host, stage_name)
+    print
+    print "---> Success,", release, "was executed on", "{}:{}".format(host, port)
 
 
 def configure(build_name,
               config_path,
               deploy_keys=[],
               __security_module__=security,
-              __release_store__=None
+              __release_store__=None,
+              __resolve_build__=resolve_build,
               ):
-    """ create a release from a build and a path to a config file """
+    """ create a release from a build and a path to a config file
+
+    herd configure <build name> <config path>
+    herd configure --batch <csv of build name, config path rows>
+
+    The build's manifest and image digest are resolved once here and stored
+    with the release so deploys don't need to inspect the image again.
+
+    """
+    if build_name == '--batch':
+        return configure_batch(
+            config_path,
+            deploy_keys,
+            __security_module__=__security_module__,
+            __release_store__=__release_store__,
+            __resolve_build__=__resolve_build__,
+            )
+
     if __release_store__ is None:
-        __release_store__ = ReleaseStore(get_config()['release_store_db'])
+        __release_store__ = open_release_store()
 
     if deploy_keys == []:
-        deploy_keys = get_config()['security_deploy_fingerprints'].split(',')
+        deploy_keys = get_config().get_list('security_deploy_fingerprints')
     cypherpath = __security_module__.sign_then_encrypt_file(
         config_path,
         recipients = deploy_keys,
         )
     config_name = __security_module__.distribute_secret(cypherpath)
-    release = __release_store__.put(build_name, config_name)
+    manifest, image_digest = __resolve_build__(build_name)
+    release = __release_store__.put(
+        build_name,
+        config_name,
+        manifest=manifest,
+        image_digest=image_digest,
+        )
     print "---> New release, ", release
     return release
 
 
-def configs():
-    """ list available configs """
-    with settings(host_string=get_config()['security_remote_secret_store']):
-        run("ls /var/secret")
+def configure_batch(csv_path,
+                    deploy_keys=[],
+                    concurrency=None,
+                    __security_module__=security,
+                    __release_store__=None,
+                    __resolve_build__=resolve_build,
+                    ):
+    """ create a release for every build, config path row of a csv file
+
+    Configs are encrypted on a pool of processes, the secrets are uploaded
+    in one transfer and the releases are stored in one transaction. Prints
+    the new releases as a JSON list on the last line of stdout and returns
+    them.
+
+    """
+
+    with open(csv_path, 'r') as csv_file:
+        rows = [
+            [field.strip() for field in row]
+            for row
+            in csv.reader(csv_file)
+            if row and not row[0].startswith('#')
+            ]
+    if rows and rows[0] == ['build', 'config']:
+        rows = rows[1:]
+    for row in rows:
+        if len(row) != 2:
+            raise ValueError(
+                "Expected build name, config path rows, got {}".format(row))
+
+    if __release_store__ is None:
+        __release_store__ = open_release_store()
+    if deploy_keys == []:
+        deploy_keys = get_config().get_list('security_deploy_fingerprints')
+
+    cypherpaths = encrypt_configs(
+        [config_path for build_name, config_path in rows],
+        deploy_keys,
+        concurrency or multiprocessing.cpu_count(),
+        __security_module__=__security_module__,
+        )
+    distributed = __security_module__.distribute_secrets(cypherpaths)
+    config_names = distributed['names']
+    print "---> {} secrets uploaded, {} already in the store".format(
+        len(distributed['uploaded']), len(distributed['deduplicated']))
+
+    builds = {}
+    with hide('running', 'stdout'):
+        for build_name, config_path in rows:
+            if build_name not in builds:
+                builds[build_name] = __resolve_build__(build_name)
+
+    new_releases = __release_store__.put_many([
+            {
+                'build': build_name,
+                'config': config_name,
+                'manifest': builds[build_name][0],
+                'image_digest': builds[build_name][1],
+                }
+            for (build_name, config_path), config_name
+            in zip(rows, config_names)
+            ])
+    print json.dumps([
+            {'id': release.id_, 'build': release.build, 'config': release.config}
+            for release
+            in new_releases
+            ])
+    return new_releases
+
+
+def encrypt_configs(config_paths,
+                    recipients,
+                    concurrency=1,
+                    __security_module__=security,
+                    ):
+    """ sign then encrypt each config, on a pool of processes if concurrent
+
+    returns the paths of the encrypted files in the order of config_paths.
+    The pool's workers import the security module by its name.
+
+    """
+
+    if concurrency > 1 and len(config_paths) > 1:
+        jobs = [
+            (config_path, recipients, __security_module__.__name__)
+            for config_path
+            in config_paths
+            ]
+        with worker_pool(min(concurrency, len(jobs))) as pool:
+            return pool.map(__encrypt_job__, jobs)
+    return [
+        __security_module__.sign_then_encrypt_file(
+            config_path, recipients=recipients)
+        for config_path
+        in config_paths
+        ]
+
+
+def __encrypt_job__(job):
+    config_path, recipients, security_module = job
+    return import_module(security_module).sign_then_encrypt_file(
+        config_path, recipients=recipients)
+
+
+def configs(*args):
+    """ list available configs, newest first, from a local index
+
+    herd configs [--name PREFIX] [--latest] [--sync]
+
+    The index is synced from the secret store when it is older than
+    security_secret_index_max_age seconds, fetching only what changed since
+    the last sync. --sync forces a full sync, which also drops configs the
+    store no longer has. Each config is shown with the releases using it.
+
+    """
+    _, options = parse_options(args, name=None, latest=False, sync=False)
+    index = open_secret_index()
+    cursor = index.cursor()
+    max_age = get_config().get_int(
+        'security_secret_index_max_age', default_secret_index_max_age)
+    if (options['sync']
+        or cursor is None
+        or cursor.synced_datetime < datetime.datetime.utcnow()
+            - datetime.timedelta(seconds=max_age)):
+        sync_secret_index(index, full=options['sync'] or cursor is None)
+
+    secrets = index.find(name=options['name'], latest=options['latest'])
+    references = open_release_store().references(
+        [secret.name for secret in secrets])
+    for secret in secrets:
+        print "{} {:>8} bytes  {}  releases: {}".format(
+            secret.modified_datetime.strftime("%Y-%m-%d %H:%M:%S"),
+            secret.size,
+            secret.name,
+            ', '.join(str(id_) for id_ in references.get(secret.name, []))
+                or '-',
+            )
+
+
+def sync_secret_index(index, full=False):
+    """ bring the local secret index up to date with the secret store
+
+    Unless full only the secrets modified since the index's cursor are
+    listed, a second earlier to allow for files written during the last sync.
+
+    """
+
+    cursor = index.cursor()
+    cmd = "find /var/secret -maxdepth 1 -type f"
+    if not full and cursor is not None and cursor.mtime is not None:
+        cmd += " -newermt @{:.6f}".format(cursor.mtime - 1)
+    cmd += " -printf '%T@ %s %f\\n'"
+    with settings(host_string=index.store):
+        with hide('running', 'stdout'):
+            listing = run(cmd)
+
+    secrets = []
+    for line in listing.splitlines():
+        parts = line.strip().split(' ', 2)
+        if len(parts) == 3:
+            mtime, size, name = parts
+            secrets.append((name, int(size), float(mtime)))
+    index.update(secrets, full=full)
+    return secrets
 
 
-def releases():
-    """ list available releases """
-    release_store = ReleaseStore(get_config()['release_store_db'])
-    for r in release_store.list():
+def releases(*args):
+    """ list available releases, newest first
+
+    herd releases [--limit N] [--page N] [--before RELEASE_ID]
+        [--build PREFIX] [--config NAME] [--since YYYY-MM-DD]
+
+    Releases are printed as they are read, --limit 0 lists every match.
+
+    """
+    _, options = parse_options(
+        args,
+        limit=default_releases_limit,
+        page=1,
+        before=None,
+        build=None,
+        config=None,
+        since=None,
+        )
+    limit = int(options['limit'])
+    page = int(options['page'])
+    since = options['since']
+    if since is not None:
+        since = parse_datetime(since)
+    filters = {
+        'before': options['before'],
+        'build': options['build'],
+        'config': options['config'],
+        'since': since,
+        }
+    release_store = open_release_store()
+    if page > 1:
+        found = release_store.list(
+            limit=limit, offset=(page - 1) * limit, **filters)
+    else:
+        found = release_store.search(
+            page_size=min(limit, default_releases_page_size)
+            or default_releases_page_size,
+            **filters)
+        if limit:
+            found = itertools.islice(found, limit)
+
+    count = 0
+    for r in found:
         print r
+        count += 1
+    if limit and count == limit:
+        print "---> more releases with --before {}".format(r.id_)
+
+
+def migrate():
+    """ upgrade the release store's schema to the latest version """
+    import store
+    db_uri = get_config()['release_store_db']
+    old_version = store.migrate(store.get_engine(db_uri))
+    print "---> Release store schema migrated from version {} to {}".format(
+        old_version, store.latest_version)
+
+
+def parse_datetime(value):
+    """ parse a YYYY-MM-DD date or YYYY-MM-DDTHH:MM:SS datetime """
+    for date_format in ["%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError("Could not parse {} as a date".format(value))
 
 
 def setconfig(section, key, value):
@@ -230,12 +798,13 @@ def _unittest_(build_flag=None):
     Run the unit tests on the current state of the project root.
 
     this means making a build of the current state of the project, running the
-    test command inside that container and reporting the results.
+    test command inside that container (or containers, if the Manifest shards
+    the tests) and reporting the results.
 
     """
 
     build = make_as_if_committed(build_flag)
-    run_cmd_in(build, unittest_cmd())
+    run_unittests(build)
     return build
 
 
@@ -243,9 +812,8 @@ def unittest(*args):
     build_flag = ''
     if 'rebuild' in args:
         build_flag = "--no-cache "
-    build = _unittest_(build_flag)
+    _unittest_(build_flag)
     clean_up_runs()
-    remove_build(build)
 
 
 def localtest():
@@ -254,27 +822,136 @@ def localtest():
 
 
 def integrate(*args):
-    """ integrate the current HEAD with the hub repo """
+    """ integrate the current HEAD with the hub repo
+
+    The stages overlap where they can. The build context is shipped to the
+    build host while the hub repo is fetched, so the unit test stage only
+    ships what the merge changed, and the test containers are cleaned up in
+    the background on the build host after the push. Ends with the wall
+    clock time of each stage and the time overlapping saved.
+
+    """
+
     build_flag = ''
     if 'rebuild' in args:
         build_flag = "--no-cache "
-    pull()
-    build = _unittest_(build_flag)
-    push()
-    clean_up_runs()
-    remove_build(build)
+    start = time.time()
+    stages = []
+
+    # settled before forking so the shipping worker shares them
+    build_host()
+    connections.control_dir()
+    with worker_pool(1) as pool:
+        preship = pool.apply_async(__preship_job__, (build_context_path(),))
+        stages.append(timed("fetch", fetch_updates))
+        preshipped = preship.get()
+    if preshipped['error'] is not None:
+        print "---> Shipping ahead failed, unittest will ship it ({})".format(
+            preshipped['error'])
+    stages.append(("ship ahead", preshipped['seconds'], "overlapped fetch"))
+
+    stages.append(timed("merge", merge_updates))
+    stages.append(timed("unittest", _unittest_, build_flag))
+    stages.append(timed("push", push))
+    name, seconds = timed("clean up", clean_up_runs, True)
+    stages.append((name, seconds, "in background"))
     success()
+    report_stages(stages, time.time() - start)
+    return stages
+
+
+def timed(name, stage, *args):
+    """ run stage with args, return its name and how long it took """
+    start = time.time()
+    stage(*args)
+    return name, time.time() - start
+
+
+def __preship_job__(build_path):
+    """ ship the build context ahead of the build and report it """
+    def ship():
+        on_build_host("mkdir -p {}".format(build_path))
+        ship_context(build_path)
+
+    start = time.time()
+    _, error = capture_failure(ship)
+    return {'seconds': time.time() - start, 'error': error}
+
+
+def report_stages(stages, wall_clock):
+    """ print the time each stage took and what overlapping them saved """
+    print "---> Stages"
+    for stage in stages:
+        name, seconds, note = (stage + (None,))[:3]
+        print "    {:<12} {:>8.2f}s{}".format(
+            name, seconds, "  ({})".format(note) if note else "")
+    saved = sum(stage[1] for stage in stages) - wall_clock
+    print "    {:<12} {:>8.2f}s  ({:.2f}s saved by overlapping)".format(
+        "total", wall_clock, max(saved, 0))
+
+
+def gc(*args):
+    """ prune herd's stale containers and images on every build host
+
+    herd gc [--hours HOURS] [--all-users]
+
+    Stopped containers herd ran and kept builds unused for longer than
+    --hours (default 24) are removed, from all build hosts at once. Only your
+    own are pruned unless --all-users is given.
+
+    """
+
+    positional, options = parse_options(
+        args, hours=str(default_gc_hours), all_users=False)
+    hours = int(options['hours'])
+    jobs = [(host, hours, options['all_users']) for host in build_hosts()]
+    if len(jobs) > 1:
+        with worker_pool(len(jobs)) as pool:
+            results = pool.map(__gc_job__, jobs)
+    else:
+        results = map(__gc_job__, jobs)
+
+    for result in results:
+        if not result['ok']:
+            print "---> {} FAILED ({})".format(
+                result['host'], result.get('error', "see output"))
+            continue
+        print ("---> {}: removed {} containers and {} kept builds, "
+               "reclaimed {}").format(
+            result['host'], result['containers'], len(result['builds']),
+            ' + '.join(result['reclaimed']) or "0B")
+    if not all(result['ok'] for result in results):
+        abort("Pruning failed on some build hosts")
+    return results
+
+
+def __gc_job__(job):
+    """ prune one (host, hours, all_users) job and report it """
+    host, hours, all_users = job
+    result, error = capture_failure(gc_build_host, host, hours, all_users)
+    if error is not None:
+        return {'host': host, 'ok': False, 'error': error}
+    return result
 
 
 def pull():
     """ pull all changes for mainline and my branch from the hub repo """
+    fetch_updates()
+    merge_updates()
 
-    origin = get_config().get("dev_origin", "origin")
-    default_branch = get_config().get("dev_default_branch", "master")
 
-    # fetch remote branch references and deletes outdated remote branch names
+def fetch_updates():
+    """ fetch remote branch references, dropping outdated remote branches """
+    origin = get_config().get("dev_origin", "origin")
     local("git remote update --prune {}".format(origin))
 
+
+def merge_updates():
+    """ merge mainline and my branch's changes from the hub repo """
+
+    origin = get_config().get("dev_origin", "origin")
+    default_branch = get_config().get("dev_default_branch", "master")
+
     # Merge any new mainline changes
     local("git pull {} {}".format(origin, default_branch))
 
@@ -1,32 +1,75 @@
 import os
-import sys
 
 from ConfigParser import ConfigParser
 
 default_config_path = "~/.herdconfig"
 
+# parsed configs by path, with the file stamp they were parsed at
+_config_cache = {}
+
+
+class HerdConfig(dict):
+    """ The parsed config, keyed by <section>_<option>
+
+    Values are strings, the accessors below convert them. The same object is
+    shared by every caller until the file changes so treat it as read only.
+
+    """
+
+    def get_int(self, key, default=None):
+        value = self.get(key)
+        return default if value is None else int(value)
+
+    def get_list(self, key, default=None):
+        """ a comma separated value as a list of stripped strings """
+        value = self.get(key)
+        if value is None:
+            return [] if default is None else default
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    def get_path(self, key, default=None):
+        value = self.get(key, default)
+        return None if value is None else os.path.expanduser(value)
+
+
 def get_config():
     """ Reads the config file
 
     first tries to read from the path in the environment variable
     'herd_config_path' otherwise reads from the default config path
 
+    The file is only parsed again when the path or the file's modification
+    time or size changes.
+
     """
 
-    config = ConfigParser()
     cfg_path = config_path()
+    cached = _config_cache.get(cfg_path)
+    if cached is not None and cached[0] == _file_stamp(cfg_path):
+        return cached[1]
+
+    config = ConfigParser()
     if not config.read(cfg_path):
         print "Missing herd config file at {}".format(cfg_path)
         init()
         config.read(cfg_path)
 
-    config_dict = {}
+    config_dict = HerdConfig()
     for section in config.sections():
         for item in config.items(section):
             config_dict["{}_{}".format(section.lower(), item[0])] = item[1]
 
+    _config_cache[cfg_path] = (_file_stamp(cfg_path), config_dict)
     return config_dict
 
+def _file_stamp(path):
+    """ what identifies a version of the file, None if it doesn't exist """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
 def init():
     """ initalize the client configuration file """
 
@@ -46,5 +89,3 @@ def make_init_config(path, build_host):
 def config_path():
     return os.path.expanduser(
         os.environ.get("herd_config_path", default_config_path))
-
-CONFIG = get_config()
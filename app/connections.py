@@ -0,0 +1,160 @@
+import os
+import socket
+import shutil
+import httplib
+import tempfile
+import subprocess
+from collections import Counter
+
+from fabric import state
+from fabric.network import HostConnectionCache, normalize_to_string
+
+# how long an idle openssh master lingers if close_all is never reached
+control_persist_seconds = 300
+
+
+class ConnectionStats(object):
+    """ counts of ssh connections opened and reused, by host """
+
+    def __init__(self):
+        self.opened = Counter()
+        self.reused = Counter()
+
+    def record(self, host, reused):
+        if reused:
+            self.reused[host] += 1
+        else:
+            self.opened[host] += 1
+
+    def totals(self):
+        return sum(self.opened.values()), sum(self.reused.values())
+
+    def merge(self, other):
+        """ add counts reported by another process """
+        self.opened.update(other['opened'])
+        self.reused.update(other['reused'])
+
+    def since(self, before):
+        """ the counts recorded since a snapshot, in a picklable form """
+        return {
+            'opened': dict(self.opened - before['opened']),
+            'reused': dict(self.reused - before['reused']),
+            }
+
+    def snapshot(self):
+        return {'opened': Counter(self.opened), 'reused': Counter(self.reused)}
+
+    def summary(self):
+        opened, reused = self.totals()
+        return "{} ssh connections opened, {} reused".format(opened, reused)
+
+
+stats = ConnectionStats()
+
+
+class TrackedConnectionCache(HostConnectionCache):
+    """ fabric's per host connection cache, counting opens and reuses """
+
+    def __getitem__(self, key):
+        stats.record(normalize_to_string(key), key in self)
+        return HostConnectionCache.__getitem__(self, key)
+
+
+def track():
+    """ count every connection fabric makes for the rest of the invocation
+
+    fabric already keeps one connection per host string in its shared cache,
+    this swaps the cache's class so each use of it is counted.
+
+    """
+    state.connections.__class__ = TrackedConnectionCache
+
+
+_control_dir = []
+
+
+def control_dir():
+    """ the directory holding this invocation's openssh master sockets """
+    if not _control_dir:
+        _control_dir.append(tempfile.mkdtemp(prefix='herd-ssh-'))
+    return _control_dir[0]
+
+
+def ssh_options(host):
+    """ openssh options sharing one master connection to host
+
+    Subprocesses like rsync and scp pass these to ssh so their transfers to a
+    host during this invocation share one multiplexed openssh connection.
+    That connection is separate from fabric's paramiko connection to the
+    same host, so a host used both ways gets two connections, and both are
+    counted in stats.
+
+    """
+
+    host = host.split('@')[-1]
+    control_path = os.path.join(control_dir(), host)
+    stats.record(host, os.path.exists(control_path))
+    return ' '.join([
+            "-o ControlMaster=auto",
+            "-o ControlPath={}".format(control_path),
+            "-o ControlPersist={}".format(control_persist_seconds),
+            ])
+
+
+# kept alive https connections by process id and host
+_https_connections = {}
+
+
+def https_get(host, path):
+    """ GET https://<host><path> over a kept alive connection to host
+
+    Each process keeps one connection per host for the rest of the
+    invocation, replacing it once if the server has closed it. The response
+    must be read to its end before the next request to the same host.
+
+    """
+
+    key = (os.getpid(), host)
+    while True:
+        connection = _https_connections.get(key)
+        reused = connection is not None
+        if not reused:
+            connection = httplib.HTTPSConnection(host)
+            _https_connections[key] = connection
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            del _https_connections[key]
+            if reused:
+                continue
+            raise
+        if response.status != httplib.OK:
+            response.read()
+            raise IOError("GET https://{}{} failed: {} {}".format(
+                    host, path, response.status, response.reason))
+        return response
+
+
+def close_all():
+    """ close fabric's connections and any openssh masters we started """
+    for key in _https_connections.keys():
+        _https_connections.pop(key).close()
+
+    for key in list(state.connections.keys()):
+        dict.__getitem__(state.connections, key).close()
+        dict.__delitem__(state.connections, key)
+
+    if not _control_dir:
+        return
+    directory = _control_dir.pop()
+    with open(os.devnull, 'w') as devnull:
+        for host in os.listdir(directory):
+            subprocess.call(
+                ['ssh', '-o', 'ControlPath={}'.format(
+                        os.path.join(directory, host)), '-O', 'exit', host],
+                stdout=devnull,
+                stderr=devnull,
+                )
+    shutil.rmtree(directory, ignore_errors=True)
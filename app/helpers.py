@@ -1,11 +1,41 @@
 import os
-
-from ConfigParser import ConfigParser
+import re
+import sys
+import base64
+import time
+import pipes
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
 from uuid import uuid4 as uuid
+from contextlib import contextmanager
+
+from ConfigParser import ConfigParser, NoSectionError, NoOptionError
 
 from fabric.api import *
 
-from config import CONFIG, get_config
+from config import get_config
+import connections
+import batch
+
+default_build_cache_megabytes = 10240
+
+# how much busier, in load per cpu, the host with the last synced context may
+# be than the least loaded host and still be picked
+warm_host_load_margin = 0.5
+
+# labels marking the containers and images herd makes as herd's, the prefix
+# keeps them apart from the herd.<section>.<option> manifest labels
+owner_label_prefix = "io.herd."
+
+# the id labelling the containers run during this invocation
+_run_id = []
+
+# the build host picked from each configured pool, for the rest of the
+# invocation
+_picked_build_hosts = {}
 
 def manifest(section, option):
     config = ConfigParser(allow_no_value=True)
@@ -28,55 +58,624 @@ def service_name():
     """ return the service name from the manifest """
     return manifest("Service", "name")
 
+def parse_options(args, **defaults):
+    """ split command args into positional args and --name value options
+
+    only options named in defaults are accepted. Options with a boolean
+    default are flags and take no value, all others take the next arg.
+
+    """
+
+    positional = []
+    options = dict(defaults)
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith('--'):
+            positional.append(arg)
+            continue
+        name = arg[2:].replace('-', '_')
+        if name not in defaults:
+            raise ValueError("Unknown option {}".format(arg))
+        if isinstance(defaults[name], bool):
+            options[name] = True
+        elif not args:
+            raise ValueError("Option {} requires a value".format(arg))
+        else:
+            options[name] = args.pop(0)
+    return positional, options
+
+@contextmanager
+def worker_pool(processes):
+    """ a pool of processes for the block, closed and joined after it """
+    pool = multiprocessing.Pool(processes, init_worker)
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+def init_worker():
+    """ start a pool worker without the parent's database connections """
+    # only if this process has used the store, importing it is slow
+    store = sys.modules.get('store')
+    if store is not None:
+        store.reset_engines(forked=True)
+
+def capture_failure(operation, *args):
+    """ run operation with args, return its result and None, or None and the
+    error message if it failed
+
+    fabric aborts with SystemExit, which is caught too so a failing job
+    reports its failure rather than taking down its pool
+
+    """
+
+    try:
+        return operation(*args), None
+    except (Exception, SystemExit), e:
+        return None, str(e) or e.__class__.__name__
+
+def run_id():
+    """ the id of this invocation, labelling the containers it runs """
+    if not _run_id:
+        _run_id.append(uuid().hex[:12])
+    return _run_id[0]
+
+def owner_labels(**extra):
+    """ docker --label options marking an object as made by herd for the
+    current user and service, plus any extra labels """
+    labels = [('user', env.user), ('service', service_name().lower())]
+    return ' '.join(
+        "--label {}{}={}".format(owner_label_prefix, name, pipes.quote(value))
+        for name, value
+        in labels + sorted(extra.items())
+        )
+
+def owner_filters(**labels):
+    """ docker --filter options matching herd's objects with the labels """
+    return ' '.join(
+        "--filter label={}{}={}".format(
+            owner_label_prefix, name, pipes.quote(value))
+        for name, value
+        in sorted(labels.items())
+        )
+
 def on_host(host, cmd):
     with settings(host_string=host):
-        run(cmd)
+        return run(cmd)
 
 def on_build_host(cmd):
     """ run the command on the build host """
-    on_host(CONFIG['build_host'], cmd)
+    return on_host(build_host(), cmd)
+
+def build_host():
+    """ the build host for this invocation
+
+    [Build] hosts may list a pool of build hosts, otherwise [Build] host is
+    the only one. The host is picked from the pool once, see pick_build_host.
+
+    """
+
+    hosts = build_hosts()
+    if hosts not in _picked_build_hosts:
+        _picked_build_hosts[hosts] = pick_build_host(hosts)
+    return _picked_build_hosts[hosts]
+
+def build_hosts():
+    """ the configured pool of build hosts """
+    config = get_config()
+    return tuple(config.get_list('build_hosts') or [config['build_host']])
+
+def pick_build_host(hosts):
+    """ pick the build host to use out of hosts
+
+    Every host's load is probed at once. The host the build context was last
+    synced to is picked while it is within warm_host_load_margin load per cpu
+    of the least loaded host, so its kept builds and synced context get
+    reused, otherwise the least loaded host is. Hosts that can't be probed
+    are passed over. Reports the host picked and how long probing took.
+
+    """
+
+    if len(hosts) == 1:
+        return hosts[0]
+
+    start = time.time()
+    loads = probe_build_hosts(hosts)
+    probed = time.time() - start
+    if not loads:
+        abort("None of the build hosts could be reached: {}".format(
+                ', '.join(hosts)))
+
+    warm = last_build_host()
+    least = min(loads, key=lambda host: loads[host]['load'])
+    host = least
+    if warm in loads and (loads[warm]['load']
+                          <= loads[least]['load'] + warm_host_load_margin):
+        host = warm
+    print ("---> Building on {} ({:.2f} load per cpu, {} containers running"
+           "{}), probed {} hosts in {:.2f}s").format(
+        host, loads[host]['load'], loads[host]['containers'],
+        ", has the last build context" if host == warm else "",
+        len(hosts), probed)
+    return host
+
+def probe_build_hosts(hosts):
+    """ the load per cpu and running containers of each host, at once
+
+    hosts that fail to answer are left out
+
+    """
+
+    with open(os.devnull, 'w') as devnull:
+        probes = [
+            (host, subprocess.Popen(
+                    probe_command(host), shell=True, stdout=subprocess.PIPE,
+                    stderr=devnull))
+            for host
+            in hosts
+            ]
+        outputs = [(host, probe.communicate()[0], probe.returncode)
+                   for host, probe in probes]
+
+    loads = {}
+    for host, output, return_code in outputs:
+        lines = output.split()
+        if return_code != 0 or len(lines) < 3:
+            continue
+        try:
+            load, cpus, containers = float(lines[0]), int(lines[-2]), int(
+                lines[-1])
+        except ValueError:
+            continue
+        loads[host] = {
+            'load': load / max(cpus, 1),
+            'containers': containers,
+            }
+    return loads
+
+def probe_command(host):
+    """ the local command printing host's load, cpu and container counts """
+    return ("ssh {} -o BatchMode=yes -o ConnectTimeout=5 {} "
+            "'cat /proc/loadavg; nproc; docker ps -q | wc -l'"
+            ).format(connections.ssh_options(host), host)
+
+def last_build_host():
+    """ the build host the project's context was last synced to, or None """
+    with lcd(project_root()):
+        with settings(hide('everything'), warn_only=True):
+            host = local("git config --get herd.buildhost", capture=True)
+    return host.strip() if host.succeeded and host.strip() else None
+
+def remember_build_host(host):
+    """ record host as the one the project's context was last synced to """
+    with lcd(project_root()):
+        with settings(hide('everything'), warn_only=True):
+            local("git config herd.buildhost {}".format(pipes.quote(host)))
 
 def make_as_if_committed(build_flag):
     """
     make the project as if the current state were committed
 
-    rsync the current state of the project up to a workspace on the build server
+    ship the current state of the project up to a workspace on the build server
     then docker build that folder and return the name of the build container.
 
+    Builds are tagged by a hash of the build context and kept on the build
+    host, so if the context is unchanged since a kept build (and no rebuild
+    was asked for) that build is reused without syncing or building. Kept
+    builds are evicted least recently used first, see evict_builds.
+
     """
 
-    build_path = os.path.join(
-        CONFIG['build_base_path'],
+    build_path = build_context_path()
+    test_build_name = "herd-unittest-{}:{}".format(
+        service_name().lower(), context_hash()[:32])
+    marker = os.path.join(build_cache_path(), test_build_name.replace(':', '_'))
+
+    if not build_flag:
+        # reuse and mark as just used in one round trip
+        with settings(warn_only=True):
+            reused = on_build_host(
+                "docker image inspect {} >/dev/null 2>&1 && touch {}".format(
+                    test_build_name, marker)).succeeded
+        if reused:
+            print "---> build context unchanged, reusing", test_build_name
+            return test_build_name
+
+    on_build_host("mkdir -p {} {}".format(build_path, build_cache_path()))
+
+    ship_context(build_path)
+
+    with cd(build_path):
+        on_build_host("docker build {} {}-t {} .".format(
+                owner_labels(), build_flag, test_build_name))
+    on_build_host("echo {} > {}".format(test_build_name, marker))
+    evict_builds(keep=test_build_name)
+
+    return test_build_name
+
+def build_context_path():
+    """ where the build host keeps the project's build context """
+    return os.path.join(
+        get_config()['build_base_path'],
         env.user,
         service_name()
         )
-    on_build_host("mkdir -p {}".format(build_path))
 
-    rsync = "rsync -rlvz --filter=':- .gitignore' -e ssh --delete ./ {}:{}"
-    with cd(project_root()):
-        local(rsync.format(CONFIG['build_host'], build_path))
+def ship_context(build_path):
+    """ send the build context to build_path on the build host
 
-    test_build_name = "{}:unittesting".format(uuid())
+    build_context_mode picks how, rsync (the default) or git, see
+    ship_git_delta. Reports and returns the bytes sent and seconds taken.
 
-    with cd(build_path):
-        on_build_host("docker build {}-t {} .".format(
-                build_flag, test_build_name))
+    """
 
-    return test_build_name
+    start = time.time()
+    if get_config().get('build_context_mode', 'rsync') == 'git':
+        sent = ship_git_delta(build_path)
+    else:
+        sent = ship_rsync(build_path)
+    seconds = time.time() - start
+    if len(build_hosts()) > 1:
+        remember_build_host(build_host())
+    print "---> Shipped the build context, {} bytes in {:.2f}s".format(
+        sent, seconds)
+    return sent, seconds
+
+def ship_rsync(build_path):
+    """ rsync the project to build_path, return the bytes sent """
+    rsync = ("rsync -rlz --stats --filter=':- .gitignore' -e 'ssh {}' "
+             "--delete ./ {}:{}")
+    with lcd(project_root()):
+        output = local(rsync.format(
+                connections.ssh_options(build_host()),
+                build_host(),
+                build_path,
+                ), capture=True)
+    sent = re.search(r"Total bytes sent: ([\d,.]+)", output)
+    return int(re.sub(r"[,.]", "", sent.group(1))) if sent else 0
+
+def ship_git_delta(build_path):
+    """ send the commits the build host hasn't got plus local changes
+
+    The last commit shipped to each build host is kept in the local ref
+    refs/herd/shipped/<host>, with anything but letters, digits, dots and
+    dashes in the host string, like a port's colon, replaced by _. The
+    commits since then go as a git bundle, changes to tracked files as a
+    binary diff and untracked files as a tarball, all in one ssh command that
+    resets build_path to exactly that state. If the build host doesn't have
+    the last commit shipped any more all of history is sent instead. Returns
+    the bytes sent.
+
+    """
+
+    host = build_host()
+    ref = "refs/herd/shipped/{}".format(re.sub(r"[^\w.-]", "_", host))
+    ship_path = build_path.rstrip('/') + '.ship'
+    work = tempfile.mkdtemp(prefix='herd-ship-')
+    try:
+        with lcd(project_root()):
+            with hide('running', 'stdout'):
+                head = local("git rev-parse HEAD", capture=True)
+                with settings(warn_only=True):
+                    base = local("git rev-parse --verify -q {}".format(ref),
+                                 capture=True)
+                base = base if base.succeeded else None
+                sent, shipped = ship_git_package(
+                    work, host, build_path, ship_path, head, base)
+                if not shipped and base is not None:
+                    sent, shipped = ship_git_package(
+                        work, host, build_path, ship_path, head, None)
+                if not shipped:
+                    abort("Could not ship the build context to {}".format(
+                            host))
+                local("git update-ref {} {}".format(ref, head))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return sent
+
+def ship_git_package(work, host, build_path, ship_path, head, base):
+    """ package the context in work and apply it remotely
+
+    must run in the project root. Returns the bytes sent and whether the
+    build host could apply the package.
+
+    """
+
+    package = os.path.join(work, 'package')
+    shutil.rmtree(package, ignore_errors=True)
+    os.mkdir(package)
+    if base != head:
+        local("git bundle create {} HEAD{}".format(
+                os.path.join(package, 'commits.bundle'),
+                " ^{}".format(base) if base else ""))
+    local("git diff --binary HEAD > {}".format(
+            os.path.join(package, 'changes.patch')))
+    local("git ls-files --others --exclude-standard -z"
+          " | tar --null -T - -czf {}".format(
+            os.path.join(package, 'untracked.tar.gz')))
+    with open(os.path.join(package, 'apply.sh'), 'w') as script:
+        script.write(git_apply_script.format(
+                build_path=build_path,
+                ship_path=ship_path,
+                head=head,
+                ))
+
+    archive = os.path.join(work, 'package.tar.gz')
+    local("tar -czf {} -C {} .".format(archive, package))
+    remote = "rm -rf {0} && mkdir -p {0} && tar -xzf - -C {0} && sh {0}/apply.sh"
+    with settings(hide('warnings'), warn_only=True):
+        result = local("{} < {}".format(
+                ship_command(host, remote.format(ship_path)), archive),
+                capture=True)
+    if result.failed and result.return_code != 3:
+        abort("Applying the build context failed on {}:\n{}".format(
+                host, result.stderr))
+    return os.path.getsize(archive), result.succeeded
+
+def ship_command(host, remote_cmd):
+    """ the local command running remote_cmd on host with our stdin """
+    return "ssh {} {} {}".format(
+        connections.ssh_options(host), host, pipes.quote(remote_cmd))
+
+# resets the build path to the shipped state, exits 3 if the build path is
+# missing commits the package depends on
+git_apply_script = """set -e
+mkdir -p {build_path}
+cd {build_path}
+[ -d .git ] || git init -q
+if [ -f {ship_path}/commits.bundle ]; then
+    git bundle verify -q {ship_path}/commits.bundle >/dev/null 2>&1 || exit 3
+    git fetch -q {ship_path}/commits.bundle HEAD
+fi
+git cat-file -e {head}^{{commit}} 2>/dev/null || exit 3
+git reset -q --hard {head}
+git clean -qfdx
+if [ -s {ship_path}/changes.patch ]; then
+    git apply --binary {ship_path}/changes.patch
+fi
+tar -xzf {ship_path}/untracked.tar.gz
+rm -rf {ship_path}
+"""
+
+def context_hash():
+    """ a hash of the build context, the committed tree plus local changes
+
+    Changed and untracked files are hashed by content. Files git ignores are
+    left out, as they are when the context is synced to the build host.
+
+    """
+
+    root = project_root()
+    with lcd(root):
+        with hide('running'):
+            tree = local("git rev-parse HEAD^{tree}", capture=True)
+            changed = local(
+                "git diff HEAD --name-only -z; "
+                "git ls-files --others --exclude-standard -z",
+                capture=True,
+                )
+
+    context = hashlib.sha256(tree)
+    for path in sorted(set(name for name in changed.split('\0') if name)):
+        full_path = os.path.join(root, path)
+        context.update("\0{}\0".format(path))
+        if os.path.islink(full_path):
+            context.update("link:" + os.readlink(full_path))
+        elif os.path.isfile(full_path):
+            with open(full_path, 'rb') as changed_file:
+                for chunk in iter(lambda: changed_file.read(65536), ''):
+                    context.update(chunk)
+        else:
+            context.update("deleted")
+    return context.hexdigest()
+
+def build_cache_path():
+    """ where the build host keeps a marker per kept build, touched on use """
+    return os.path.join(
+        get_config()['build_base_path'], env.user, '.herd_build_cache')
+
+def evict_builds(keep=None):
+    """ remove the least recently used kept builds over the disk budget
+
+    The budget is build_cache_megabytes (default 10240). Image sizes include
+    layers shared with other images, so the budget errs on the side of
+    keeping less.
+
+    """
+
+    budget = get_config().get_int(
+        'build_cache_megabytes', default_build_cache_megabytes) * 1024 * 1024
+    with settings(host_string=build_host(), warn_only=True):
+        with hide('running', 'stdout'):
+            listing = run(
+                "cd {} && for marker in $(ls -t); do "
+                "build=$(cat $marker); "
+                "echo $marker $build $(docker image inspect "
+                "--format '{{{{.Size}}}}' $build 2>/dev/null || echo 0); "
+                "done".format(build_cache_path()))
+
+    if listing.failed:
+        return []
+
+    used = 0
+    evict = []
+    for line in listing.splitlines():
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        marker, build, size = parts
+        used += int(size)
+        if used > budget and build != keep:
+            evict.append((marker, build))
+    if evict:
+        with settings(warn_only=True):
+            on_build_host("docker rmi {}; cd {} && rm -f {}".format(
+                    ' '.join(build for marker, build in evict),
+                    build_cache_path(),
+                    ' '.join(marker for marker, build in evict),
+                    ))
+    return [build for marker, build in evict]
 
-def clean_up_runs():
-    """ remove all stoped containers """
-    with settings(warn_only=True):
-        on_build_host("docker rm $(docker ps -aq)")
+def clean_up_runs(background=False):
+    """ remove the containers this invocation ran, all at once
 
-def remove_build(build):
-    """ remove the image of build """
-    with settings(warn_only=True):
-        on_build_host("docker rmi {}".format(build))
+    in the background the removal is left running on the build host
+
+    """
+
+    cmd = "docker ps -aq {} | xargs -r docker rm -f".format(
+        owner_filters(run=run_id()))
+    if background:
+        cmd = "nohup sh -c {} >/dev/null 2>&1 </dev/null &".format(
+            pipes.quote(cmd))
+    with settings(warn_only=True, always_use_pty=False):
+        on_build_host(cmd)
 
 def run_cmd_in(build, cmd):
     """ run the command in the build """
-    on_build_host("docker run {} {}".format(build, cmd))
+    on_build_host("docker run {} {} {}".format(
+            owner_labels(run=run_id()), build, cmd))
+
+def run_unittests(build):
+    """ run the Manifest's unit tests in the build, sharded if it says so """
+    shards = unittest_shards()
+    if shards is None:
+        run_cmd_in(build, unittest_cmd())
+    else:
+        run_sharded(build, *shards)
+
+def run_sharded(build, shards, shard_cmd):
+    """ run shard_cmd in a container per shard at once on the build host
+
+    shard_cmd is formatted with the shard's index, from 0, as {shard} and the
+    number of shards as {shards}. Every shard runs to the end, then their
+    output and a merged report are printed. Aborts if any shard failed,
+    otherwise returns a result dict per shard.
+
+    """
+
+    script = batch.RemoteScript()
+    names = [
+        "herd-shard-{}-{}".format(script.token[-12:].lower(), shard)
+        for shard
+        in range(shards)
+        ]
+    script.step("start", "\n".join(
+            "docker run -d --name {} {} {} {} >/dev/null".format(
+                name, owner_labels(run=run_id()), build,
+                shard_cmd.format(shard=shard, shards=shards))
+            for shard, name
+            in enumerate(names)
+            ))
+    for shard, name in enumerate(names):
+        # always, so containers that did start are waited on and removed
+        script.step(
+            "shard_{}".format(shard),
+            "herd_code=$(docker wait {0}); docker logs {0}; "
+            "docker rm {0} >/dev/null; exit $herd_code".format(name),
+            always=True,
+            )
+
+    start = time.time()
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = on_build_host("echo {} | base64 -d | bash".format(
+                base64.b64encode(script.render())))
+    seconds = time.time() - start
+
+    results = script.parse(output)
+    if results[0]['exit_code']:
+        print results[0]['output']
+    failed = []
+    for shard, result in enumerate(results[1:]):
+        passed = result['exit_code'] == 0
+        print
+        print "---> shard {} of {} {} (exit code {})".format(
+            shard + 1, shards, "passed" if passed else "FAILED",
+            result['exit_code'])
+        print result['output']
+        if not passed:
+            failed.append(str(shard + 1))
+
+    print
+    print "---> {} shards ran in {:.1f}s: {} passed, {} failed".format(
+        shards, seconds, shards - len(failed), len(failed))
+    if failed or results[0]['exit_code']:
+        abort("Unit tests failed, failed shards: {} of {}".format(
+                ', '.join(failed) or "none started", shards))
+    return [
+        {'shard': shard, 'exit_code': result['exit_code'],
+         'output': result['output']}
+        for shard, result
+        in enumerate(results[1:])
+        ]
+
+def gc_build_host(host, hours, all_users=False):
+    """ prune herd's objects on host unused for longer than hours
+
+    Removes the stopped containers herd ran, the kept builds that haven't
+    been used and herd's dangling images, all in one round trip. Only the
+    current user's objects are pruned unless all_users. Returns a result
+    dict with the host, whether pruning worked and what was removed.
+
+    """
+
+    if all_users:
+        filters = "--filter label={}service".format(owner_label_prefix)
+        caches = os.path.join(
+            get_config()['build_base_path'], '*',
+            os.path.basename(build_cache_path()))
+    else:
+        filters = owner_filters(user=env.user)
+        caches = build_cache_path()
+
+    script = batch.RemoteScript()
+    script.step("containers", "docker container prune -f {} "
+                "--filter until={}h".format(filters, hours))
+    script.step("builds", "for marker in $(find {} -maxdepth 1 -type f "
+                "-mmin +{} 2>/dev/null); do build=$(cat $marker); "
+                "{{ docker rmi $build || ! docker image inspect $build; }} "
+                ">/dev/null 2>&1 && rm -f $marker && echo $build || true; "
+                "done".format(caches, hours * 60))
+    script.step("images", "docker image prune -f {} --filter until={}h".format(
+            filters, hours))
+
+    with settings(hide('running', 'stdout'), host_string=host,
+                  warn_only=True):
+        output = run("echo {} | base64 -d | bash".format(
+                base64.b64encode(script.render())))
+
+    results = script.parse(output)
+    containers, builds, images = results
+    return {
+        'host': host,
+        'ok': all(result['exit_code'] == 0 for result in results),
+        'containers': len(re.findall(
+            r"^[0-9a-f]{64}$", containers['output'], re.M)),
+        'builds': builds['output'].split(),
+        'reclaimed': re.findall(
+            r"^Total reclaimed space: (\S+)",
+            containers['output'] + '\n' + images['output'], re.M),
+        }
+
+def unittest_shards():
+    """ the Manifest's shard count and per shard command, None if unsharded
+
+    [Service]
+    unittest_shards=4
+    unittest_shard_cmd=python -m pytest --shard-id={shard} --num-shards={shards}
+
+    """
+
+    try:
+        shards = int(manifest("Service", "unittest_shards"))
+        shard_cmd = manifest("Service", "unittest_shard_cmd")
+    except (NoSectionError, NoOptionError):
+        return None
+    if shards < 2:
+        return None
+    return shards, shard_cmd
 
 def success():
     if os.path.exists("./success_art.txt"):
@@ -1,12 +1,29 @@
 import os
 import sys
 import argparse
-import commands
 
 from config import default_config_path
 
 __version__ = (1, 0, 0, 'rc1')
 
+# herd commands and the module implementing each. A module is only imported
+# when one of its commands runs, so --version and mistyped commands don't pay
+# for importing fabric, sqlalchemy or gnupg.
+command_modules = {
+    'configure': 'commands',
+    'configs': 'commands',
+    'releases': 'commands',
+    'pull': 'commands',
+    'integrate': 'commands',
+    'localtest': 'commands',
+    'unittest': 'commands',
+    'deploy': 'commands',
+    'setconfig': 'commands',
+    'migrate': 'commands',
+    'trivial': 'commands',
+    'gc': 'commands',
+    }
+
 def fmt_version(type='long', v=__version__):
     """ format the version in long or short form """
     if type == 'long':
@@ -18,6 +35,11 @@ def fmt_version(type='long', v=__version__):
     else:
         raise NameError("unknown version format type {}".format(type))
 
+def load_command(name):
+    """ import the module implementing the command and return the command """
+    module = __import__(command_modules[name], globals())
+    return getattr(module, name)
+
 def main():
     """
     Main command-line execution loop.
@@ -29,9 +51,15 @@ def main():
     parser.add_argument('--version', dest='version', action='store_const',
                          const=True, help='Print the version and exit.')
 
+    parser.add_argument('--trace', dest='trace', metavar='PATH',
+                        help='Write a Chrome trace of every step to PATH.')
+    parser.add_argument('--profile', dest='profile', action='store_const',
+                        const=True,
+                        help='Print where the time went when done.')
+
     parser.add_argument('command', nargs='?', help='herd command to execute')
-    parser.add_argument('command_args', nargs='*',
-                         help='arguments for the command')
+    parser.add_argument('command_args', nargs=argparse.REMAINDER,
+                         help='arguments and --options for the command')
 
     args = parser.parse_args()
 
@@ -40,18 +68,7 @@ def main():
         print "herd version", fmt_version()
         sys.exit()
 
-    allowed_commands = ['configure',
-                        'configs',
-                        'releases',
-                        'pull',
-                        'integrate',
-                        'localtest',
-                        'unittest',
-                        'deploy',
-                        'setconfig',
-                        'trivial',
-                        ]
-    if args.command in allowed_commands:
+    if args.command in command_modules:
         # don't allow any arguments to include illegal characters
         for illegal in ['&', ';', '|', '>', '<']:
             try:
@@ -63,6 +80,22 @@ def main():
                 raise ValueError(
                     "Illegal character '{}' found in argument".format(illegal))
 
-        getattr(commands, args.command)(*args.command_args)
+        import timing
+        if args.trace or args.profile:
+            # before loading the command so its fabric operations are traced
+            timing.start()
+        command = load_command(args.command)
+        import connections
+        connections.track()
+        try:
+            with timing.span("herd {}".format(args.command), 'command',
+                             command=' '.join(args.command_args)):
+                command(*args.command_args)
+        finally:
+            connections.close_all()
+            if any(connections.stats.totals()):
+                # on stderr so stdout stays the command's own output
+                print >> sys.stderr, "--->", connections.stats.summary()
+            timing.finish(args.trace, args.profile)
     else:
         print '"{}" is not a valid herd command.'.format(args.command)
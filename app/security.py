@@ -1,28 +1,205 @@
 import os
 import re
-from urllib2 import urlopen
-from itertools import dropwhile
-import gnupg
+import codecs
+import pipes
+import hashlib
+import subprocess
+import tempfile
+import time
+import threading
+from importlib import import_module
+from urlparse import urlparse
+from functools import partial
+from collections import deque
 
 from config import get_config
+import connections
+import timing
 
-# we import both Crypto.Hash and then everything inside it because of
-# the way the crypto library interacts with getattr
-import Crypto.Hash
-from Crypto.Hash import *
-# keep both these imports here
+# gnupg and Crypto are imported where they are used so that herd commands
+# which don't touch secrets start quickly
 
 default_hash_algo = "SHA256"
 
 
-def calculate_digest(data):
+# bytes read from gpg, or from a file being hashed, at a time
+chunk_size = 64 * 1024
+
+
+_hash_constructors = {}
+
+
+def new_hasher():
+    """ a new hash object using the configured security_hash_algo
+
+    hashlib's implementation is used when it has the algorithm, otherwise
+    the hash of that name from the Crypto library, eg BLAKE2b. Either way the
+    hex digests are the same.
+
+    """
+
     hash_algo = get_config().get("security_hash_algo", default_hash_algo)
-    hasher = getattr(Crypto.Hash, hash_algo)
-    h = hasher.new()
+    if hash_algo not in _hash_constructors:
+        try:
+            hashlib.new(hash_algo.lower())
+            constructor = partial(hashlib.new, hash_algo.lower())
+        except ValueError:
+            constructor = import_module(
+                "Crypto.Hash.{}".format(hash_algo)).new
+        _hash_constructors[hash_algo] = constructor
+    return _hash_constructors[hash_algo]()
+
+
+def calculate_digest(data):
+    h = new_hasher()
     h.update(data)
     return h.hexdigest()
 
 
+class GPGSession(object):
+    """ a gnupg.GPG for one keyring, reused for every operation on it
+
+    Building a gnupg.GPG runs gpg to check its version and keyrings, so herd
+    builds one per homedir and binary and shares it for the whole invocation.
+    The session also remembers how far each signer is trusted.
+
+    """
+
+    # key validity in gpg's --with-colons listing, by name of trust level
+    validity_levels = {
+        'n': 'TRUST_NEVER',
+        'm': 'TRUST_MARGINAL',
+        'f': 'TRUST_FULLY',
+        'u': 'TRUST_ULTIMATE',
+        }
+
+    def __init__(self, homedir, binary):
+        import gnupg
+        self.gpg = gnupg.GPG(homedir=homedir, binary=binary)
+        self.trust_levels = {}
+
+    def trust_level(self, verified):
+        """ the trust level of the signer of a decrypt or verify result
+
+        Uses the level gpg reported with the result. If gpg didn't report one
+        the keyring is read, once per session, for every key's validity.
+
+        """
+
+        fingerprint = verified.fingerprint
+        if fingerprint not in self.trust_levels:
+            if verified.trust_level is not None:
+                self.trust_levels[fingerprint] = verified.trust_level
+            else:
+                self.read_trust_levels(verified)
+        return self.trust_levels.get(fingerprint)
+
+    def pipe(self, args, instream, on_result=None):
+        """ pipe instream through gpg run with args, see GPGStream """
+        return GPGStream(self.gpg, args, instream, on_result)
+
+    def read_trust_levels(self, verified):
+        with timing.span("gpg --list-keys", 'gpg'):
+            keys = self.gpg.list_keys()
+        for key in keys:
+            level = verified.TRUST_LEVELS.get(
+                self.validity_levels.get(key['trust']), verified.TRUST_UNDEFINED)
+            self.trust_levels.setdefault(key['fingerprint'], level)
+
+
+class GPGStream(object):
+    """ the output of a gpg process, readable as gpg produces it
+
+    A thread feeds instream to gpg and another parses gpg's status as it runs,
+    so neither the input nor the output is held in memory. Once the output is
+    exhausted the process's result is passed to on_result, which may raise, so
+    a reader only reaches the end of the stream if gpg's result is accepted.
+
+    The stream can only be read forward. seek only accepts the current
+    position, or once the stream is read through any position, as a no-op,
+    since fabric's put seeks back to where it started after uploading.
+
+    """
+
+    def __init__(self, gpg, args, instream, on_result=None):
+        from gnupg import _util
+        self.args = args
+        self.started = time.time()
+        self.result = gpg._result_map['crypt'](gpg)
+        self.on_result = on_result
+        self.position = 0
+        self.finished = False
+        self.process = gpg._open_subprocess(args)
+        self.writer = _util._threaded_copy_data(instream, self.process.stdin)
+        self.reader = threading.Thread(
+            target=gpg._read_response,
+            args=(codecs.getreader(gpg._encoding)(self.process.stderr),
+                  self.result),
+            )
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def read(self, size=-1):
+        if self.finished:
+            return ''
+        data = self.process.stdout.read(size)
+        self.position += len(data)
+        if size < 0 or not data:
+            self.close()
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(chunk_size), '')
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if self.finished:
+            return
+        if (whence, offset) not in [(0, self.position), (1, 0)]:
+            raise IOError("gpg output can only be read forward")
+
+    def close(self):
+        """ wait for gpg to exit then check its result """
+        if self.finished:
+            return
+        self.finished = True
+        self.process.stdout.close()
+        self.writer.join()
+        self.reader.join()
+        self.process.wait()
+        self.process.stderr.close()
+        timing.record(
+            "gpg {}".format(' '.join(self.args)), 'gpg', self.started,
+            time.time() - self.started, bytes=self.position)
+        if self.on_result is not None:
+            self.on_result(self.result)
+
+
+_gpg_sessions = {}
+_gpg_binaries = {}
+
+
+def gpg_session(homedir=None, binary='gpg'):
+    """ the shared GPGSession for homedir, security_gnupg_home by default """
+    import gnupg
+    if homedir is None:
+        homedir = get_config().get('security_gnupg_home', '~/.gnupg')
+    if binary not in _gpg_binaries:
+        _gpg_binaries[binary] = gnupg._util._which(binary)[0]
+    key = (homedir, _gpg_binaries[binary])
+    if key not in _gpg_sessions:
+        _gpg_sessions[key] = GPGSession(*key)
+    return _gpg_sessions[key]
+
+
+def reset_gpg_sessions():
+    """ forget shared gpg sessions and the trust levels they remember """
+    _gpg_sessions.clear()
+    _gpg_binaries.clear()
+
+
 def sign_then_encrypt_file(path,
                            signer=None,
                            recipients=[],
@@ -32,6 +209,9 @@ def sign_then_encrypt_file(path,
 
     return a path to the encrypted file
 
+    The file is piped through gpg and the cyphertext is hashed as it is
+    written, so neither is held in memory.
+
     """
 
     # set up the secret human readable name
@@ -41,21 +221,42 @@ def sign_then_encrypt_file(path,
     if not signer:
         signer = get_config()['security_my_fingerprint']
 
-    gpg = gnupg.GPG(homedir=get_config().get('security_gnupg_home', '~/.gnupg'),
-                    binary=gnupg._util._which('gpg')[0])
-
-    with open(path, 'r') as plainfile:
-        crypt = gpg.encrypt(plainfile.read(), *recipients, default_key=signer)
-        print crypt.stderr
-        assert crypt.ok
-        cyphertext = crypt.data
-        digest = calculate_digest(cyphertext)
-
-    # infer the filename
-    sec_filename = "{}.{}.sec".format(secret_name, digest)
-    sec_path = os.path.join(os.path.dirname(path), sec_filename)
-    with open(sec_path, 'w') as cypherfile:
-        cypherfile.write(cyphertext)
+    args = [
+        '--armor',
+        '--always-trust',
+        '--cipher-algo AES256',
+        '--compress-algo ZLIB',
+        '--sign',
+        '--default-key {}'.format(signer),
+        '--digest-algo SHA512',
+        '--encrypt',
+        ] + ['--recipient {}'.format(recipient) for recipient in recipients]
+
+    hasher = new_hasher()
+    cypherfile = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(secret_name),
+        delete=False,
+        )
+    try:
+        with open(path, 'rb') as plainfile:
+            crypt = gpg_session().pipe(args, plainfile)
+            for chunk in crypt:
+                hasher.update(chunk)
+                cypherfile.write(chunk)
+        cypherfile.close()
+        print crypt.result.stderr
+        assert crypt.result.ok
+
+        # infer the filename
+        sec_filename = "{}.{}.sec".format(secret_name, hasher.hexdigest())
+        sec_path = os.path.join(os.path.dirname(path), sec_filename)
+        os.rename(cypherfile.name, sec_path)
+    except:
+        cypherfile.close()
+        if os.path.exists(cypherfile.name):
+            os.remove(cypherfile.name)
+        raise
 
     return os.path.abspath(sec_path)
 
@@ -65,36 +266,214 @@ def decrypt_and_verify_file(cypherfile):
     File -> String
 
     """
-    gpg = gnupg.GPG(homedir=get_config().get('security_gnupg_home', '~/.gnupg'),
-                    binary=gnupg._util._which('gpg')[0])
-    plain = gpg.decrypt_file(cypherfile)
-    print plain.stderr
+    return decrypt_and_verify_stream(cypherfile).read()
+
+
+def decrypt_and_verify_stream(cypherfile):
+    """ decrypt the encrypted secret as it is read, verifying it at the end
+
+    File -> GPGStream
+
+    Reading the last of the plaintext raises DecryptionError or
+    NotTrustedError if the secret could not be decrypted or wasn't signed by
+    a fully trusted key, so a consumer must discard what it read if reading
+    fails.
+
+    """
+
+    session = gpg_session()
 
-    try: assert plain.ok
-    except: raise DecryptionError
+    def verify(plain):
+        print plain.stderr
 
-    try: assert plain.valid
-    except: raise NotTrustedError("Invalid signiture")
+        try: assert plain.ok
+        except: raise DecryptionError
 
-    try: assert plain.trust_level >= plain.TRUST_FULLY
-    except: raise NotTrustedError("{} not fully trusted".format(plain.username))
+        try: assert plain.valid
+        except: raise NotTrustedError("Invalid signiture")
 
-    return plain.data
+        try: assert session.trust_level(plain) >= plain.TRUST_FULLY
+        except: raise NotTrustedError(
+            "{} not fully trusted".format(plain.username))
 
+    return session.pipe(['--decrypt'], cypherfile, on_result=verify)
 
-def fetch_secret(secret_name, fetcher=urlopen):
+
+def fetch_secret(secret_name, fetcher=None):
     """ Return a secret fetched from the secret store
 
     String -> File
 
+    Secrets named <name>.<digest>.sec can't change, so they are kept in the
+    local SecretCache and only fetched from the store once.
+
+    """
+    path = cache_secret(secret_name, fetcher)
+    if path is None:
+        return (fetcher or fetch_url)(secret_url(secret_name))
+    return open(path, 'rb')
+
+
+def cache_secret(secret_name, fetcher=None):
+    """ the path of the secret in the local SecretCache, fetching it into the
+    cache unless it is there already
+
+    None if the secret has no digest in its name or the cache is off. The
+    cache checks entries with the configured security_hash_algo, so it is
+    passed over for a secret named with a digest of another length, like one
+    configured before the algorithm was changed.
+
     """
+
+    digest = secret_digest(secret_name)
+    cache = secret_cache()
+    if digest is None or cache is None:
+        return None
+    if len(digest) != new_hasher().digest_size * 2:
+        return None
+    path = cache.get(digest)
+    if path is None:
+        path = cache.put(
+            digest, (fetcher or fetch_url)(secret_url(secret_name)))
+    return path
+
+
+def secret_url(secret_name):
+    """ the url of the secret on the configured secret store """
     store = get_config()['security_remote_secret_store']
-    url = "https://{}/secret/{}".format(store, secret_name)
-    return fetcher(url)
+    return "https://{}/secret/{}".format(store, secret_name)
 
 
-def distribute_secret(path):
-    """ upload the secret file to the secret store.
+def fetch_url(url):
+    """ GET an https url over a kept alive connection to its host
+
+    the request's span ends once the body is read
+
+    """
+
+    parts = urlparse(url)
+    started = time.time()
+    return timing.ReadSpan(
+        connections.https_get(parts.netloc, parts.path),
+        "GET {}".format(url), 'https', started, host=parts.netloc)
+
+
+def secret_digest(secret_name):
+    """ the digest in a secret named <name>.<digest>.sec, otherwise None """
+    parts = secret_name.split('.')
+    if len(parts) < 3 or parts[-1] != 'sec':
+        return None
+    if not re.match("^[0-9a-f]+$", parts[-2]):
+        return None
+    return parts[-2]
+
+
+def file_digest(path):
+    """ the digest of a file, read a chunk at a time """
+    hasher = new_hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class SecretCache(object):
+    """ cyphertexts fetched from the secret store, on disk by digest
+
+    An entry is checked against its digest whenever it is read. Once the
+    entries take up more than max_bytes the least recently used are evicted.
+
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def entry_path(self, digest):
+        return os.path.join(self.path, digest)
+
+    def get(self, digest):
+        """ the path of the cyphertext with digest, None if not cached """
+        path = self.entry_path(digest)
+        if not os.path.exists(path):
+            return None
+        if file_digest(path) != digest:
+            os.remove(path)
+            return None
+        os.utime(path, None)
+        return path
+
+    def put(self, digest, cypherfile):
+        """ cache the cyphertext read from cypherfile, return its path
+
+        raises SecretMismatchError if the cyphertext doesn't have the digest
+
+        """
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0700)
+        hasher = new_hasher()
+        entry = tempfile.NamedTemporaryFile(
+            dir=self.path, prefix='.{}.'.format(digest), delete=False)
+        try:
+            with entry:
+                for chunk in iter(lambda: cypherfile.read(chunk_size), ''):
+                    hasher.update(chunk)
+                    entry.write(chunk)
+            if hasher.hexdigest() != digest:
+                raise SecretMismatchError(
+                    "Fetched secret doesn't match its digest {}".format(digest))
+            os.rename(entry.name, self.entry_path(digest))
+        finally:
+            if os.path.exists(entry.name):
+                os.remove(entry.name)
+        self.evict(keep=digest)
+        return self.entry_path(digest)
+
+    def evict(self, keep=None):
+        """ remove least recently used entries until under max_bytes """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            stat = os.stat(self.entry_path(name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            os.remove(self.entry_path(name))
+            total -= size
+
+
+default_secret_cache_path = "~/.herd/secret_cache"
+default_secret_cache_megabytes = 100
+
+
+def secret_cache():
+    """ the configured SecretCache, None if its size is set to 0 """
+    config = get_config()
+    megabytes = config.get_int(
+        'security_secret_cache_size', default_secret_cache_megabytes)
+    if megabytes <= 0:
+        return None
+    return SecretCache(
+        config.get_path(
+            'security_secret_cache_path', default_secret_cache_path),
+        megabytes * 1024 * 1024,
+        )
+
+
+armor_header_line = "-----BEGIN PGP MESSAGE-----\n"
+armor_tail_line = "-----END PGP MESSAGE-----\n"
+armor_whitespace = re.compile("[ \t]")
+
+
+def check_secret_file(path):
+    """ raise DistributeMalformedError unless path looks like a secret file
 
     Make an attempt to only upload encrypted files. We are going
     to rely on a few conventions to guard against distributing a
@@ -105,85 +484,211 @@ def distribute_secret(path):
     filename <human name>.<hash digest>.sec
     file should be in ascii armor format
 
+    This check is not intended to defend against any dedicated attacker. It
+    is simply here to assist Alice. If she attempts to distribute a file she
+    thought was cyphertext, but was instead plaintext, this should trigger
+    and let her know. Eve could still distribute a secret through this
+    function, however Eve would need to be able to manipulate the text in the
+    secret file to conform to these checks in order to do so.
+
+    The file is read once, a line at a time, checking the armor and hashing
+    the file as it goes.
+
     """
 
-    def assert_correct_hash(path):
-        """ The hash in the filename should verify the file's consistency """
-        # grab the hash digest, the thing between the last two dots
-        hash_claim = os.path.basename(path).split('.')[-2]
-        with open(path, 'r') as f:
-            if hash_claim != calculate_digest(f.read()):
-                print "Hash missmatch"
-                raise DistributeMalformedError("Hash missmatch")
-
-    def assert_filename_extension(path):
-        """ path should end with .sec """
-        if path[-4:] != ".sec":
-            print "filename ({}) should end in '.sec'".format(path)
-            raise DistributeMalformedError
-
-    def assert_armord_message(path):
-        """ return True if data is OpenPGP ascii armor and False otherwise
-
-        This check is not intended to defend against any dedicated attacker. It
-        is simply here to assist Alice. If she attempts to distribute a file
-        she thought was cyphertext, but was instead plaintext, this should
-        trigger and let her know. Eve could still distribute a secret through
-        this function, however Eve would need to be able to manipulate the text
-        in the secret file to conform to these checks in order to do so.
+    if path[-4:] != ".sec":
+        print "filename ({}) should end in '.sec'".format(path)
+        raise DistributeMalformedError
 
-        """
+    hasher = new_hasher()
+    with open(path, 'r') as f:
+        problems = scan_armor(f, hasher.update)
+    if problems:
+        potential_problem = problems[0]
+        print "{} should be in ASCII-Armor format [{}]".format(
+            path, potential_problem)
+        raise DistributeMalformedError(potential_problem)
 
-        potential_problem = "Unknown error"
-        with open(path, 'r') as f:
-            lines = f.readlines()
-            try:
-                potential_problem = "Missing or malformed Armor Header Line"
-                assert lines[0] == "-----BEGIN PGP MESSAGE-----\n"
-
-                potential_problem = "Missing or malformed Armor Tail"
-                assert lines[-1] == "-----END PGP MESSAGE-----\n"
-
-                potential_problem = "Line longer than 78 characters"
-                for line in lines:
-                    assert len(line) < 79
-
-                potential_problem = "Missing blank line"
-                body_lines = list(dropwhile(lambda l: l!='\n', lines[:-1]))
-                assert body_lines[0] == "\n"
-
-                potential_problem = "No ASCII-Armored data"
-                assert len(body_lines) > 2
-
-                potential_problem = "Whitespace in ASCII-Armored data"
-                # lines after the first blank line and before the last
-                # line should not have whitespace
-                for line in body_lines[1:-2]:
-                    assert not re.search("[ \t]+", line)
-            except Exception, e:
-                print "{} should be in ASCII-Armor format [{}]".format(
-                    path, potential_problem)
-                raise DistributeMalformedError(potential_problem)
-
-    assert_filename_extension(path)
-    assert_armord_message(path)
-    assert_correct_hash(path)
-
-    remote_path = "{}:/var/secret/{}".format(
-        get_config()['security_remote_secret_store'],
-        os.path.basename(path)
-        )
-    os.system("scp {} {}".format(path, remote_path))
-    return os.path.basename(path)
+    # The hash in the filename should verify the file's consistency
+    # grab the hash digest, the thing between the last two dots
+    hash_claim = os.path.basename(path).split('.')[-2]
+    if hash_claim != hasher.hexdigest():
+        print "Hash missmatch"
+        raise DistributeMalformedError("Hash missmatch")
+
+
+def scan_armor(lines, on_line=None):
+    """ the ways an OpenPGP ascii armored message's lines are malformed
+
+    Returns a list of problems in the order they should be reported, empty if
+    the message is well formed. on_line is called with every line read.
+
+    """
+
+    first_line = None
+    last_line = None
+    too_long = False
+    # the lines from the first blank line on, holding back the last three
+    # since the tail, checksum and last line of data may contain whitespace
+    in_body = False
+    body_length = 0
+    held_back = deque()
+    whitespace = False
+
+    for line in lines:
+        if on_line is not None:
+            on_line(line)
+        if first_line is None:
+            first_line = line
+        last_line = line
+        too_long = too_long or len(line) >= 79
+
+        if not in_body and line == "\n":
+            in_body = True
+        if in_body:
+            body_length += 1
+            held_back.append(line)
+            if len(held_back) > 3:
+                line = held_back.popleft()
+                # skip the blank line opening the body
+                if body_length > 4:
+                    whitespace = whitespace or bool(
+                        armor_whitespace.search(line))
+
+    # the tail isn't part of the body
+    if in_body and last_line == held_back[-1]:
+        body_length -= 1
+        if body_length == 0:
+            in_body = False
+
+    problems = []
+    if first_line != armor_header_line:
+        problems.append("Missing or malformed Armor Header Line")
+    if last_line != armor_tail_line:
+        problems.append("Missing or malformed Armor Tail")
+    if too_long:
+        problems.append("Line longer than 78 characters")
+    if not in_body:
+        problems.append("Missing blank line")
+    if body_length <= 2:
+        problems.append("No ASCII-Armored data")
+    if whitespace:
+        problems.append("Whitespace in ASCII-Armored data")
+    return problems
+
+
+def distribute_secret(path):
+    """ upload the secret file to the secret store.
+
+    the file is checked with check_secret_file first and isn't uploaded if
+    the store already has it
+
+    """
+
+    return distribute_secrets([path])['names'][0]
+
+
+def distribute_secrets(paths):
+    """ upload many secret files to the secret store in one transfer
+
+    Every file is checked before any is uploaded. The store is asked which
+    of the secrets it already has, with matching digests, in one round trip
+    and only the others are uploaded, together.
+
+    Returns a dict of the secret names in the order of paths, the names
+    uploaded and the names deduplicated because the store had them. Raises
+    DistributeFailedError if the upload fails.
+
+    """
+
+    map(check_secret_file, paths)
+    names = [os.path.basename(path) for path in paths]
+    result = {'names': names, 'uploaded': [], 'deduplicated': []}
+    if not paths:
+        return result
+
+    store = get_config()['security_remote_secret_store']
+    stored = stored_secret_digests(store, sorted(set(names)))
+    to_upload = []
+    for path, name in zip(paths, names):
+        if name in result['uploaded'] or name in result['deduplicated']:
+            continue
+        if stored.get(name) == secret_digest(name):
+            result['deduplicated'].append(name)
+        else:
+            result['uploaded'].append(name)
+            to_upload.append(path)
+
+    if to_upload:
+        status = os.system("scp {} {} {}:/var/secret/".format(
+                connections.ssh_options(store), ' '.join(to_upload), store))
+        if status != 0:
+            raise DistributeFailedError(
+                "scp to {} exited with status {}, none of {} may be "
+                "stored".format(store, status, ', '.join(result['uploaded'])))
+    if result['deduplicated']:
+        print "---> {} already in the secret store".format(
+            ', '.join(result['deduplicated']))
+    return result
+
+
+# commands printing "<digest>  <file>" for a hash on the secret store
+digest_commands = {
+    'MD5': 'md5sum',
+    'SHA1': 'sha1sum',
+    'SHA224': 'sha224sum',
+    'SHA256': 'sha256sum',
+    'SHA384': 'sha384sum',
+    'SHA512': 'sha512sum',
+    'BLAKE2b': 'b2sum',
+    }
+
+
+def stored_secret_digests(store, names):
+    """ the digests of those of the named secrets the store has
+
+    One ssh command, over the store's shared connection, hashes whichever of
+    the secrets exist. Returns a dict of digest by secret name.
+
+    """
+
+    hash_algo = get_config().get("security_hash_algo", default_hash_algo)
+    digest_command = digest_commands.get(hash_algo)
+    if digest_command is None or not names:
+        return {}
+
+    cmd = "cd /var/secret && {} -- {} 2>/dev/null".format(
+        digest_command, ' '.join(pipes.quote(name) for name in names))
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.Popen(
+            ['ssh'] + connections.ssh_options(store).split() + [store, cmd],
+            stdout=subprocess.PIPE,
+            stderr=devnull,
+            ).communicate()[0]
+
+    digests = {}
+    for line in output.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            digests[parts[1].lstrip('*')] = parts[0]
+    return digests
 
 
 class DistributeMalformedError(Exception):
     """ attempted to distribute an incorrect secret file """
 
 
+class DistributeFailedError(Exception):
+    """ secret files could not be uploaded to the secret store """
+
+
 class NotTrustedError(Exception):
     """ signiture not trusted """
 
 
+class SecretMismatchError(Exception):
+    """ a fetched secret doesn't match the digest in its name """
+
+
 class DecryptionError(Exception):
     """ Decryption did not complete successfully """
@@ -0,0 +1,592 @@
+import datetime
+import threading
+from contextlib import contextmanager
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+from sqlalchemy import (
+    create_engine,
+    inspect,
+    and_,
+    or_,
+    Table,
+    Index,
+    Column,
+    Integer,
+    Float,
+    String,
+    Text,
+    DateTime,
+    )
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+Base = declarative_base()
+# the local secret index is a cache, kept apart from the release store schema
+IndexBase = declarative_base()
+
+# one engine (and connection pool) per database for the whole process
+_engines = {}
+# databases whose schema version has been checked by this process
+_checked_schemas = set()
+# engines inherited from the parent process, kept so their connections are
+# never closed from this one
+_forked_engines = []
+_lock = threading.Lock()
+
+
+class Release(Base):
+    __tablename__ = 'releases'
+    # searches filter on a name and page newest first
+    __table_args__ = (
+        Index('ix_releases_service_created_datetime',
+              'service', 'created_datetime'),
+        Index('ix_releases_config_name_created_datetime',
+              'config_name', 'created_datetime'),
+        )
+
+    id_ = Column(Integer, primary_key=True)
+    build = Column(String(1024))
+    config = Column(String(1024))
+    created_datetime = Column(
+        DateTime,
+        default=datetime.datetime.utcnow,
+        index=True,
+        )
+    manifest = Column(Text, nullable=True)
+    image_digest = Column(String(1024), nullable=True)
+    service = Column(String(255), nullable=True)
+    config_name = Column(String(255), nullable=True)
+
+    @property
+    def stored_manifest(self):
+        """ the manifest captured at configure time, None if there isn't one """
+        if not self.manifest:
+            return None
+        manifest = ConfigParser(allow_no_value=True)
+        manifest.readfp(StringIO(self.manifest))
+        return manifest
+
+    @property
+    def image(self):
+        """ the exact image to run, pinned by digest when it is known """
+        return self.image_digest or self.build
+
+    def __repr__(self):
+        return "<Release: build={}, config={}, id={} created_datetime={}>" \
+            .format(self.build, self.config, self.id_, self.created_datetime)
+
+    def __str__(self):
+        return "Release {}: [{}] {}, {}".format(
+            self.id_, self.created_datetime, self.build, self.config)
+
+
+def service_of(build):
+    """ the service name in a build name
+
+    r.iadops.com/herd:1.0_build.abc1234 is a build of the herd service
+
+    """
+    name = build.split('@')[0].split('/')[-1]
+    return name.split(':')[0]
+
+
+def config_name_of(config):
+    """ the human readable name of a secret named <name>.<digest>.sec """
+    if config.endswith('.sec') and config.count('.') >= 2:
+        return config.rsplit('.', 2)[0]
+    return config
+
+
+def secret_digest_of(config):
+    """ the digest in a secret named <name>.<digest>.sec, None otherwise """
+    if config.endswith('.sec') and config.count('.') >= 2:
+        return config.split('.')[-2]
+    return None
+
+
+class SchemaOutOfDateError(Exception):
+    """ the release store's schema needs migrating """
+
+
+def get_engine(db_uri):
+    """ the process wide engine for the database, created on first use """
+    with _lock:
+        if db_uri not in _engines:
+            options = {}
+            if db_uri in ('sqlite://', 'sqlite:///:memory:'):
+                # every connection must see the same in memory database
+                options = {
+                    'poolclass': StaticPool,
+                    'connect_args': {'check_same_thread': False},
+                    }
+            elif not db_uri.startswith('sqlite'):
+                options = {'pool_pre_ping': True}
+            _engines[db_uri] = create_engine(db_uri, **options)
+        return _engines[db_uri]
+
+
+def make_release(build, config, manifest=None, image_digest=None):
+    """ a new Release with the names it is searched by filled in """
+    if isinstance(manifest, ConfigParser):
+        manifest_file = StringIO()
+        manifest.write(manifest_file)
+        manifest = manifest_file.getvalue()
+    return Release(
+        build=build,
+        config=config,
+        manifest=manifest,
+        image_digest=image_digest,
+        service=service_of(build),
+        config_name=config_name_of(config),
+        )
+
+
+def reset_engines(forked=False):
+    """ forget every engine and which schemas were checked
+
+    for use when a database has been removed, or with forked in a process
+    forked from one that may have used the engines. Their pooled connections
+    are the parent's, so a forked process sets them aside unused and unclosed
+    rather than disposing of them, which would close them under the parent.
+
+    """
+    with _lock:
+        for engine in _engines.values():
+            if forked:
+                _forked_engines.append(engine)
+            else:
+                engine.dispose()
+        _engines.clear()
+        _checked_schemas.clear()
+
+
+class SessionStore(object):
+    """ a store on a database whose operations each run in their own session
+
+    Stores for the same database share one engine and connection pool, and a
+    store can be shared by threads.
+
+    """
+
+    def __init__(self, db_uri):
+        self.engine = get_engine(db_uri)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    @contextmanager
+    def session_scope(self):
+        """ a session committed if the block succeeds, rolled back if not """
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+class ReleaseStore(SessionStore):
+    """ stores build, release pairs """
+
+    def __init__(self, db_uri):
+        SessionStore.__init__(self, db_uri)
+        check_schema(self.engine)
+
+    def put(self, build, config, manifest=None, image_digest=None):
+        """ put a new release into the store
+
+        manifest may be a ConfigParser or the text of a Manifest
+
+        """
+
+        new_release = make_release(build, config, manifest, image_digest)
+        with self.session_scope() as session:
+            session.add(new_release)
+        return new_release
+
+    def put_many(self, releases):
+        """ put many releases into the store in one transaction
+
+        releases are dicts of put's arguments. Either every release is
+        stored or, if any fails, none are.
+
+        """
+
+        new_releases = [make_release(**release) for release in releases]
+        with self.session_scope() as session:
+            session.add_all(new_releases)
+        return new_releases
+
+    def get(self, id_):
+        """ get a release by it's id """
+        with self.session_scope() as session:
+            return session.query(Release).filter(
+                Release.id_==int(id_)).first()
+
+    def list(self,
+             limit=10,
+             offset=0,
+             before=None,
+             build=None,
+             config=None,
+             since=None,
+             ):
+        """ list releases newest first
+
+        Skips offset releases, or when before is a release id starts with the
+        releases created before that one. Paging with before stays fast
+        however deep into the history it goes. See search for the filters.
+
+        """
+
+        cursor = None
+        if before is not None:
+            cursor = self.get(before)
+            if cursor is None:
+                return []
+        with self.session_scope() as session:
+            query = self._filter(session, build, config, since)
+            return self._page(query, limit, offset, cursor)
+
+    def search(self,
+               build=None,
+               config=None,
+               since=None,
+               before=None,
+               page_size=100,
+               ):
+        """ yield every matching release newest first, a page at a time
+
+        build is a prefix of the service name, or of the whole build name if
+        it has a registry or tag in it. config is a config's human readable
+        name and since a datetime. Each page is one indexed query so the
+        first results come back quickly however many releases match.
+
+        """
+
+        cursor = None
+        if before is not None:
+            cursor = self.get(before)
+            if cursor is None:
+                return
+        while True:
+            with self.session_scope() as session:
+                query = self._filter(session, build, config, since)
+                page = self._page(query, page_size, 0, cursor)
+            for release in page:
+                yield release
+            if len(page) < page_size:
+                return
+            cursor = page[-1]
+
+    def references(self, configs, batch_size=500):
+        """ the ids of the releases using each of the configs, newest first
+
+        returns a dict of lists of release ids by config
+
+        """
+
+        configs = list(configs)
+        referenced = {}
+        with self.session_scope() as session:
+            for i in range(0, len(configs), batch_size):
+                rows = session.query(Release.config, Release.id_).filter(
+                    Release.config.in_(configs[i:i + batch_size])
+                    ).order_by(Release.id_.desc())
+                for config, id_ in rows:
+                    referenced.setdefault(config, []).append(id_)
+        return referenced
+
+    def _filter(self, session, build=None, config=None, since=None):
+        query = session.query(Release)
+        if build is not None:
+            # narrow by the indexed service name first
+            name = build.split('/')[-1]
+            tagged = ':' in name or '@' in name
+            if tagged:
+                query = query.filter(Release.service == service_of(build))
+            else:
+                query = query.filter(starts_with(Release.service, name))
+            if tagged or build != name:
+                query = query.filter(starts_with(Release.build, build))
+        if config is not None:
+            query = query.filter(Release.config_name == config)
+        if since is not None:
+            query = query.filter(Release.created_datetime >= since)
+        return query
+
+    def _page(self, query, limit, offset, cursor):
+        """ a page of the query ordered newest first, after the cursor """
+        if cursor is not None:
+            query = query.filter(or_(
+                    Release.created_datetime < cursor.created_datetime,
+                    and_(Release.created_datetime == cursor.created_datetime,
+                         Release.id_ < cursor.id_),
+                    ))
+        return query.order_by(
+            Release.created_datetime.desc(),
+            Release.id_.desc(),
+            ).offset(offset).limit(limit).all()
+
+
+def starts_with(column, prefix):
+    """ a condition that column starts with prefix
+
+    a range rather than LIKE so an index on column is used, and so % and _
+    in the prefix are not wildcards
+
+    """
+    prefix = unicode(prefix)
+    return and_(column >= prefix, column < prefix + u'\uffff')
+
+
+class IndexedSecret(IndexBase):
+    __tablename__ = 'secrets'
+
+    store = Column(String(255), primary_key=True)
+    name = Column(String(1024), primary_key=True)
+    config_name = Column(String(255), index=True)
+    digest = Column(String(255), nullable=True)
+    size = Column(Integer)
+    mtime = Column(Float, index=True)
+
+    @property
+    def modified_datetime(self):
+        return datetime.datetime.utcfromtimestamp(self.mtime)
+
+    def __repr__(self):
+        return "<IndexedSecret: store={}, name={}>".format(self.store, self.name)
+
+
+class SecretIndexCursor(IndexBase):
+    __tablename__ = 'secret_index_cursors'
+
+    store = Column(String(255), primary_key=True)
+    # the newest modification time synced from the store
+    mtime = Column(Float, nullable=True)
+    synced_datetime = Column(DateTime, nullable=True)
+
+
+class SecretIndex(SessionStore):
+    """ a local index of the secrets in a secret store
+
+    Holds each secret's name, digest, size and modification time so configs
+    can be listed and searched without asking the store. The cursor records
+    how far the index has been synced.
+
+    """
+
+    def __init__(self, db_uri, store):
+        SessionStore.__init__(self, db_uri)
+        IndexBase.metadata.create_all(self.engine)
+        self.store = store
+
+    def cursor(self):
+        """ the store's SecretIndexCursor, None if it was never synced """
+        with self.session_scope() as session:
+            return session.query(SecretIndexCursor).get(self.store)
+
+    def update(self, secrets, full=False):
+        """ record the (name, size, mtime) of secrets listed by the store
+
+        After a full listing secrets the store no longer has are dropped.
+
+        """
+
+        with self.session_scope() as session:
+            cursor = session.query(SecretIndexCursor).get(self.store)
+            if cursor is None:
+                cursor = SecretIndexCursor(store=self.store)
+                session.add(cursor)
+            if full:
+                session.query(IndexedSecret).filter(
+                    IndexedSecret.store == self.store).delete()
+                session.flush()
+            for name, size, mtime in secrets:
+                session.merge(IndexedSecret(
+                        store=self.store,
+                        name=name,
+                        config_name=config_name_of(name),
+                        digest=secret_digest_of(name),
+                        size=size,
+                        mtime=mtime,
+                        ))
+                cursor.mtime = max(mtime, cursor.mtime or mtime)
+            cursor.synced_datetime = datetime.datetime.utcnow()
+
+    def find(self, name=None, latest=False):
+        """ indexed secrets newest first
+
+        name is a prefix of the secrets' human readable names. If latest only
+        the newest secret with each name is included.
+
+        """
+
+        with self.session_scope() as session:
+            query = session.query(IndexedSecret).filter(
+                IndexedSecret.store == self.store)
+            if name is not None:
+                query = query.filter(
+                    starts_with(IndexedSecret.config_name, name))
+            secrets = query.order_by(
+                IndexedSecret.mtime.desc(),
+                IndexedSecret.name,
+                ).all()
+        if latest:
+            seen = set()
+            newest = []
+            for secret in secrets:
+                if secret.config_name not in seen:
+                    seen.add(secret.config_name)
+                    newest.append(secret)
+            secrets = newest
+        return secrets
+
+
+schema_version = Table(
+    'herd_schema_version',
+    Base.metadata,
+    Column('version', Integer, nullable=False),
+    )
+
+
+def add_column(engine, column):
+    """ add a column of the releases table if it isn't there already """
+    table = Release.__table__
+    existing = [c['name'] for c in inspect(engine).get_columns(table.name)]
+    if column.name not in existing:
+        engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                table.name,
+                column.name,
+                column.type.compile(engine.dialect),
+                ))
+
+
+def add_index(engine, name):
+    """ add an index of the releases table if it isn't there already """
+    table = Release.__table__
+    existing = [i['name'] for i in inspect(engine).get_indexes(table.name)]
+    if name not in existing:
+        [index] = [i for i in table.indexes if i.name == name]
+        index.create(engine)
+
+
+def drop_index(engine, name):
+    """ drop an index of the releases table if it is there """
+    table = Release.__table__
+    existing = [i['name'] for i in inspect(engine).get_indexes(table.name)]
+    if name in existing:
+        engine.execute("DROP INDEX {}".format(name))
+
+
+def migrate_to_2(engine):
+    """ releases keep the manifest and digest of their build """
+    add_column(engine, Release.__table__.c.manifest)
+    add_column(engine, Release.__table__.c.image_digest)
+
+
+def migrate_to_3(engine):
+    """ releases are listed newest first """
+    add_index(engine, 'ix_releases_created_datetime')
+
+
+def migrate_to_4(engine):
+    """ releases are searchable by service and config name """
+    add_column(engine, Release.__table__.c.service)
+    add_column(engine, Release.__table__.c.config_name)
+    backfill_search_columns(engine)
+    # indexed by migrate_to_5
+
+
+def migrate_to_5(engine):
+    """ searches by service or config name use one index to filter and page """
+    add_index(engine, 'ix_releases_service_created_datetime')
+    add_index(engine, 'ix_releases_config_name_created_datetime')
+    drop_index(engine, 'ix_releases_service')
+    drop_index(engine, 'ix_releases_config_name')
+
+
+# migrations[n] brings a version n + 1 schema to version n + 2, version 1 is
+# the releases table as it was before schemas were versioned
+migrations = [
+    migrate_to_2,
+    migrate_to_3,
+    migrate_to_4,
+    migrate_to_5,
+    ]
+latest_version = len(migrations) + 1
+
+
+def get_schema_version(engine):
+    """ the schema version, 1 if unversioned and 0 for an empty database """
+    tables = inspect(engine).get_table_names()
+    if schema_version.name in tables:
+        version = engine.execute(schema_version.select()).scalar()
+        if version is not None:
+            return version
+    return 1 if Release.__tablename__ in tables else 0
+
+
+def set_schema_version(engine, version):
+    with engine.begin() as connection:
+        connection.execute(schema_version.delete())
+        connection.execute(schema_version.insert(), version=version)
+
+
+def migrate(engine):
+    """ bring the schema up to the latest version, return the old version """
+    version = get_schema_version(engine)
+    if version == 0:
+        Base.metadata.create_all(engine)
+        set_schema_version(engine, latest_version)
+        return version
+
+    schema_version.create(engine, checkfirst=True)
+    for to_version, migration in enumerate(migrations, 2):
+        if version < to_version:
+            migration(engine)
+            set_schema_version(engine, to_version)
+    return version
+
+
+def check_schema(engine):
+    """ make sure the schema is current, once per database per process
+
+    An empty database is created at the latest version. An older schema
+    raises SchemaOutOfDateError since migrating it should be done on purpose
+    with herd migrate.
+
+    """
+
+    key = str(engine.url)
+    if key in _checked_schemas:
+        return
+    with _lock:
+        if key in _checked_schemas:
+            return
+        version = get_schema_version(engine)
+        if version == 0:
+            migrate(engine)
+        elif version < latest_version:
+            raise SchemaOutOfDateError(
+                "The release store schema is at version {} and needs to be "
+                "at {}, run `herd migrate` to upgrade it".format(
+                    version, latest_version))
+        _checked_schemas.add(key)
+
+
+def backfill_search_columns(engine, batch_size=500):
+    """ derive service and config_name for releases stored without them """
+    session = sessionmaker(bind=engine)()
+    while True:
+        releases = session.query(Release).filter(
+            Release.service == None).limit(batch_size).all()
+        for release in releases:
+            release.service = service_of(release.build or '')
+            release.config_name = config_name_of(release.config or '')
+        session.commit()
+        if len(releases) < batch_size:
+            break
+    session.close()
@@ -8,6 +8,7 @@ from commands import setconfig
 from config import (
     make_init_config,
     config_path,
+    get_config,
     )
 
 
@@ -50,6 +51,49 @@ class HerdConfigTests(unittest.TestCase):
             self.assertEqual(config.get("Build", "base_path"),
                              "/var/herd/build")
 
+    def test_get_config_is_cached(self):
+        """ the config should only be parsed again when the file changes """
+        # Run SUT
+        first = get_config()
+        second = get_config()
+
+        self.assertEqual(first['mock_mockopt'], "mockval")
+        self.assertTrue(first is second)
+
+        # changing the file invalidates the cached config
+        setconfig("Other", "otheropt", "otherval")
+        stat = os.stat(self.test_config_path)
+        os.utime(self.test_config_path, (stat.st_atime, stat.st_mtime + 1))
+        third = get_config()
+        self.assertFalse(third is first)
+        self.assertEqual(third['other_otheropt'], "otherval")
+
+        # so does pointing herd at another file
+        other_path = "./{}".format(str(uuid()))
+        make_init_config(other_path, "other.host.io")
+        os.environ['herd_config_path'] = other_path
+        try:
+            self.assertEqual(get_config()['build_host'], "other.host.io")
+        finally:
+            os.environ['herd_config_path'] = self.test_config_path
+            os.remove(other_path)
+        self.assertTrue(get_config() is third)
+
+    def test_typed_accessors(self):
+        """ config values should be readable as ints, lists and paths """
+        with open(self.test_config_path, 'w') as configfile:
+            configfile.write("[Typed]\nint=42\nlist=a, b,,c\npath=~/herd\n")
+
+        # Run SUT
+        config = get_config()
+
+        self.assertEqual(config.get_int('typed_int'), 42)
+        self.assertEqual(config.get_int('typed_missing', 7), 7)
+        self.assertEqual(config.get_list('typed_list'), ['a', 'b', 'c'])
+        self.assertEqual(config.get_list('typed_missing'), [])
+        self.assertEqual(config.get_path('typed_path'),
+                         os.path.expanduser('~/herd'))
+
     def test_config_path_helper(self):
 
         # if it's none, return the default
@@ -5,7 +5,7 @@ from StringIO import StringIO
 from uuid import uuid4 as uuid
 from ConfigParser import ConfigParser
 
-from commands import Release
+from store import Release
 
 
 class HerdDeployTests(unittest.TestCase):
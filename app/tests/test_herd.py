@@ -1,13 +1,20 @@
 import sys
 import unittest
+import subprocess
+from StringIO import StringIO
+from mock import patch
 
 from main import main, fmt_version
+from helpers import parse_options
 
 from test_herd_sec import HerdSecretsTest
 from test_herd_unittest import HerdUnittestTests
 from test_config_herd import HerdConfigTests
 from test_herd_configure import HerdConfigureTests
 from test_herd_deploy import HerdDeployTests
+from test_herd_connections import HerdConnectionsTests
+from test_herd_batch import HerdBatchTests
+from test_herd_timing import HerdTimingTests
 
 
 class HerdMainTests(unittest.TestCase):
@@ -26,6 +33,69 @@ class HerdMainTests(unittest.TestCase):
         except ValueError:
             self.fail("main() raised ValueError unexpectedly")
 
+    def test_parse_options(self):
+        """ command args should split into positional args and options """
+        args, options = parse_options(
+            ['1', 'a', '--concurrency', '4', 'b', '--latest'],
+            concurrency=8,
+            latest=False,
+            name=None,
+            )
+        self.assertEqual(args, ['1', 'a', 'b'])
+        self.assertEqual(options,
+                         {'concurrency': '4', 'latest': True, 'name': None})
+
+        with self.assertRaises(ValueError):
+            parse_options(['--unknown', 'x'], concurrency=8)
+        with self.assertRaises(ValueError):
+            parse_options(['--concurrency'], concurrency=8)
+
+    def test_fast_start(self):
+        """ --version and unknown commands should not import heavy modules
+
+        this is the startup budget check, if it fails something imported at
+        module level by main made herd slow to start
+
+        """
+
+        budget_ms = 50
+        startup = "\n".join([
+            "import sys, time",
+            "start = time.time()",
+            "sys.argv = ['herd'] + sys.argv[1:]",
+            "import main",
+            "try:",
+            "    main.main()",
+            "except SystemExit:",
+            "    pass",
+            "heavy = [m for m in ('fabric', 'sqlalchemy', 'gnupg', 'Crypto')",
+            "         if m in sys.modules]",
+            "sys.stderr.write(repr(((time.time() - start) * 1000, heavy)))",
+            ])
+        for args in [['--version'], ['nosuchcommand']]:
+            process = subprocess.Popen(
+                [sys.executable, '-c', startup] + args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                )
+            elapsed_ms, heavy = eval(process.communicate()[1])
+            self.assertEqual(heavy, [])
+            self.assertTrue(
+                elapsed_ms < budget_ms,
+                "herd {} took {:.0f}ms to start".format(args[0], elapsed_ms))
+
+    def test_command_output_ends_stdout(self):
+        """ herd's own summaries should not follow a command's output """
+        def command():
+            print "[]"
+        stdout = StringIO()
+        sys.argv = ['herd', 'trivial']
+        with patch('commands.trivial', command):
+            with patch('connections.stats.totals', return_value=(1, 2)):
+                with patch('sys.stdout', stdout), patch('sys.stderr'):
+                    main()
+        self.assertEqual(stdout.getvalue().splitlines()[-1], "[]")
+
     def test_fmt_version(self):
         """ a version 5-tuple should be formatted in the 3 appropriate ways """
         self.assertEqual(fmt_version('long', (1, 2, 3, 't')), '1.2.3-t')
@@ -0,0 +1,86 @@
+import os
+import unittest
+import subprocess
+from uuid import uuid4
+
+from batch import RemoteScript
+
+
+class HerdBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.remove = []
+
+    def tearDown(self):
+        for p in self.remove:
+            try:
+                os.remove(p)
+            except:
+                pass
+
+    def run_script(self, script):
+        """ run the script with bash the way a remote host would """
+        process = subprocess.Popen(
+            ['bash', '-c', script.render()],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            )
+        output = process.communicate()[0]
+        return process.returncode, script.parse(output)
+
+    def test_steps_run_in_order(self):
+        """ every step should run and report its exit code and output """
+        # Set up
+        path = str(uuid4())
+        self.remove.append(path)
+        secret = "a={}\nb='$HOME'".format(uuid4())
+        script = RemoteScript()
+        script.write_file("write", path, secret)
+        script.step("read", "cat {}".format(path))
+        script.step("cleanup", "rm {}".format(path), always=True)
+
+        # Run SUT
+        status, results = self.run_script(script)
+
+        self.assertEqual(status, 0)
+        self.assertEqual([r['name'] for r in results],
+                         ["write", "read", "cleanup"])
+        self.assertEqual([r['exit_code'] for r in results], [0, 0, 0])
+        # the file content should be written verbatim
+        self.assertEqual(results[1]['output'], secret)
+        self.assertFalse(os.path.exists(path))
+
+    def test_failed_step_skips_the_rest(self):
+        """ a failed step should skip later steps but not always steps """
+        # Set up
+        script = RemoteScript()
+        script.step("pull", "echo no such image; exit 3")
+        script.step("run", "echo should not run")
+        script.step("wipe", "echo wiped", always=True)
+        script.step("wipe_again", "exit 1", always=True)
+
+        # Run SUT
+        status, results = self.run_script(script)
+
+        # the first failure is the script's exit status
+        self.assertEqual(status, 3)
+        self.assertEqual([r['exit_code'] for r in results], [3, None, 0, 1])
+        self.assertEqual([r['skipped'] for r in results],
+                         [False, True, False, False])
+        self.assertEqual(results[0]['output'], "no such image")
+        self.assertEqual(results[1]['output'], "")
+        self.assertEqual(results[2]['output'], "wiped")
+
+    def test_parse_pty_output(self):
+        """ output collected over a pty has carriage returns to strip """
+        # Set up
+        script = RemoteScript()
+        script.step("one", "true")
+        output = "{0} begin one\r\nhello\r\n{0} end one 0\r\n".format(
+            script.token)
+
+        # Run SUT
+        results = script.parse(output)
+
+        self.assertEqual(results, [{'name': 'one', 'exit_code': 0,
+                                    'skipped': False, 'output': 'hello'}])
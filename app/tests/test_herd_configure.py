@@ -1,20 +1,62 @@
 import os
+import sys
+import types
+import datetime
 import unittest
 from uuid import uuid4
+from ConfigParser import ConfigParser
 from mock import MagicMock as Mock
-from sqlalchemy import create_engine
+from mock import patch
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from commands import (
     configure,
+    configure_batch,
+    encrypt_configs,
+    configs,
+    open_release_store,
+    releases,
+    )
+from helpers import worker_pool
+from store import (
     ReleaseStore,
-    Release
+    SecretIndex,
+    Release,
+    SchemaOutOfDateError,
+    service_of,
+    config_name_of,
+    get_engine,
+    get_schema_version,
+    latest_version,
+    migrate,
+    reset_engines,
     )
 
 Base = declarative_base()
 
 
+def set_created(release_store, release, created_datetime):
+    """ backdate a release """
+    with release_store.session_scope() as session:
+        session.query(Release).filter(Release.id_ == release.id_).update(
+            {'created_datetime': created_datetime})
+
+
+def encrypt_in_worker(path, recipients):
+    """ sign_then_encrypt_file of a fake security module, see
+    test_encrypt_configs_pool """
+    return "{}.{}.{}.sec".format(path, ','.join(recipients), os.getpid())
+
+
+def engine_in_worker(db_uri):
+    """ the engine a pool worker uses for db_uri, and its first release """
+    engine = get_engine(db_uri)
+    return id(engine), ReleaseStore(db_uri).get(1).build
+
+
 class HerdConfigureTests(unittest.TestCase):
     """ Tests the herd configure command """
 
@@ -50,20 +92,30 @@ class HerdConfigureTests(unittest.TestCase):
         mock_sec.distribute_secret.return_value = mock_conf_filename
         mock_sec.sign_then_encrypt_file.return_value = mock_conf_filename
         mock_release_store = Mock()
+        mock_manifest = Mock()
+        mock_digest = "{}@sha256:{}".format(build_name, uuid4().hex)
+        mock_resolve_build = Mock(return_value=(mock_manifest, mock_digest))
 
         # run SUT
         configure(build_name,
                   conf_path,
                   __security_module__=mock_sec,
                   __release_store__=mock_release_store,
+                  __resolve_build__=mock_resolve_build,
                   )
 
         # check assumptions
 
-        # build name and the conf filename put into the release store
+        # the build's manifest and digest were resolved once
+        mock_resolve_build.assert_called_once_with(build_name)
+
+        # build name, the conf filename, the manifest and the image digest
+        # put into the release store
         mock_release_store.put.assert_called_once_with(
             build_name,
             mock_conf_filename,
+            manifest=mock_manifest,
+            image_digest=mock_digest,
             )
 
         # the security module was used to sign then encrypt the conf
@@ -128,5 +180,471 @@ class HerdConfigureTests(unittest.TestCase):
                 Release.id_==second_release_id).first().build
             )
             
+    def test_release_store_list(self):
+        """ releases should be listed newest first a page at a time """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+        start = datetime.datetime(2015, 1, 1)
+        releases = []
+        for day in [3, 1, 2, 2, 0]:
+            release = release_store.put(str(uuid4()), str(uuid4()))
+            set_created(release_store, release,
+                        start + datetime.timedelta(days=day))
+            releases.append(release.id_)
+        # newest first, ties broken by newest id
+        newest_first = [releases[i] for i in [0, 3, 2, 1, 4]]
+
+        # run SUT
+        def ids(**kwargs):
+            return [r.id_ for r in release_store.list(**kwargs)]
+
+        self.assertEqual(ids(), newest_first)
+        self.assertEqual(ids(limit=2), newest_first[:2])
+        self.assertEqual(ids(limit=2, offset=2), newest_first[2:4])
+        self.assertEqual(ids(limit=2, before=newest_first[1]),
+                         newest_first[2:4])
+        self.assertEqual(ids(before=str(newest_first[-1])), [])
+        self.assertEqual(ids(before=9999), [])
+
+        # ids given as strings on the command line still find releases
+        self.assertEqual(release_store.get(str(releases[0])).id_, releases[0])
+
+    def test_release_store_search(self):
+        """ releases should be searchable by service, config and date """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+        start = datetime.datetime(2015, 1, 1)
+        for day, build, config in [
+                (0, "r.mock.com/api:1.0", "api.1a2b.sec"),
+                (1, "r.mock.com/web:1.0", "web.prod.3c4d.sec"),
+                (2, "r.mock.com/api:1.1", "api.5e6f.sec"),
+                (3, "r.mock.com/apigw:1.0", "api.7a8b.sec"),
+                (4, "r.mock.com/api:1.2", "api.staging.9c0d.sec"),
+                ]:
+            release = release_store.put(build, config)
+            set_created(release_store, release,
+                        start + datetime.timedelta(days=day))
+
+        # run SUT
+        def builds(**kwargs):
+            return [r.build for r in release_store.search(**kwargs)]
+
+        self.assertEqual(builds(build="api", config="api"),
+                         ["r.mock.com/apigw:1.0", "r.mock.com/api:1.1",
+                          "r.mock.com/api:1.0"])
+        self.assertEqual(builds(build="r.mock.com/api:"),
+                         ["r.mock.com/api:1.2", "r.mock.com/api:1.1",
+                          "r.mock.com/api:1.0"])
+        self.assertEqual(builds(config="web.prod"), ["r.mock.com/web:1.0"])
+        self.assertEqual(
+            builds(build="api", since=start + datetime.timedelta(days=2)),
+            ["r.mock.com/api:1.2", "r.mock.com/apigw:1.0",
+             "r.mock.com/api:1.1"])
+
+        # results come back a page at a time
+        self.assertEqual(len(builds(page_size=2)), 5)
+        self.assertEqual(builds(build="api", page_size=1), builds(build="api"))
+
+        # list takes the same filters
+        self.assertEqual(
+            [r.build for r in release_store.list(limit=1, build="web")],
+            ["r.mock.com/web:1.0"])
+
+        # prefixes are not patterns
+        release_store.put("r.mock.com/a_b:1.0", "a.sec")
+        self.assertEqual(builds(build="a_"), ["r.mock.com/a_b:1.0"])
+        self.assertEqual(builds(build="a%"), [])
+        self.assertEqual(builds(build="r.mock.com/a_"), ["r.mock.com/a_b:1.0"])
+        self.assertEqual(builds(build="r.mock.com/%"), [])
+
+        # a tag without a registry matches the start of the whole build name
+        release_store.put("api:1.1", "api.1a2b.sec")
+        release_store.put("api:2.0", "api.1a2b.sec")
+        self.assertEqual(builds(build="api:1."), ["api:1.1"])
+        self.assertEqual(builds(build="api:"), ["api:2.0", "api:1.1"])
+
+    def test_releases(self):
+        """ releases should page by limit, or list every match with 0 """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+        ids = [release_store.put("r.mock.com/api:{}".format(i), "a.sec").id_
+               for i in range(3)]
+        patcher = patch('commands.open_release_store',
+                        return_value=release_store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def printed(*args):
+            with patch('sys.stdout') as mock_stdout:
+                releases(*args)
+            return ''.join(
+                c[0][0] for c in mock_stdout.write.call_args_list).splitlines()
+
+        # run SUT
+        lines = printed('--limit', '2', '--build', 'api')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("Release {}:".format(ids[2])))
+        self.assertEqual(
+            lines[2], "---> more releases with --before {}".format(ids[1]))
+        self.assertEqual(len(printed('--limit', '0')), 3)
+        self.assertEqual(len(printed('--limit', '2', '--page', '2')), 1)
+
+    def test_search_names(self):
+        """ service and config names should be derived from full names """
+        self.assertEqual(service_of("r.iadops.com/herd:1.0_build.abc1234"),
+                         "herd")
+        self.assertEqual(service_of("localhost:5000/team/herd@sha256:ab"),
+                         "herd")
+        self.assertEqual(service_of("herd"), "herd")
+        self.assertEqual(config_name_of("herd.prod.ab12cd.sec"), "herd.prod")
+        self.assertEqual(config_name_of("herd.conf"), "herd.conf")
+
+    def test_release_store_manifest(self):
+        """ releases should keep the manifest and digest they were put with """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+        manifest = ConfigParser(allow_no_value=True)
+        manifest.add_section("Service")
+        manifest.set("Service", "service_port", "9999")
+        manifest.add_section("Dependencies")
+        manifest.set("Dependencies", "mock_dep", None)
+        digest = "mock/build@sha256:{}".format(uuid4().hex)
+
+        # run SUT
+        release_id = release_store.put(
+            "mock/build:1", "mock.conf", manifest, digest).id_
+        release = ReleaseStore('sqlite:///{}'.format(tmp_log_path)).get(
+            release_id)
+
+        # the stored manifest should parse back to the same manifest
+        stored = release.stored_manifest
+        self.assertEqual(stored.get("Service", "service_port"), "9999")
+        self.assertEqual(stored.items("Dependencies"), [("mock_dep", None)])
+        self.assertEqual(release.image_digest, digest)
+        self.assertEqual(release.image, digest)
+
+        # releases without them fall back to the build name
+        release = release_store.put("mock/build:2", "mock.conf")
+        self.assertEqual(release.stored_manifest, None)
+        self.assertEqual(release.image, "mock/build:2")
+
+    def test_release_store_upgrades_old_tables(self):
+        """ stores made before manifests were kept should gain the columns """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        engine = create_engine('sqlite:///{}'.format(tmp_log_path))
+        engine.execute("CREATE TABLE releases (id_ INTEGER PRIMARY KEY, "
+                       "build VARCHAR(1024), config VARCHAR(1024), "
+                       "created_datetime DATETIME)")
+        engine.execute("INSERT INTO releases (build, config) "
+                       "VALUES ('old/build:1', 'old.conf')")
+
+        # opening it should ask for a migration
+        with self.assertRaises(SchemaOutOfDateError):
+            ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+
+        # run SUT
+        self.assertEqual(migrate(engine), 1)
+        self.assertEqual(get_schema_version(engine), latest_version)
+        reset_engines()
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+
+        release = release_store.get(1)
+        self.assertEqual(release.build, 'old/build:1')
+        self.assertEqual(release.service, 'build')
+        self.assertEqual(release.config_name, 'old.conf')
+        indexes = [
+            index['name'] for index in inspect(engine).get_indexes('releases')]
+        self.assertTrue('ix_releases_created_datetime' in indexes)
+        self.assertTrue('ix_releases_service_created_datetime' in indexes)
+        self.assertFalse('ix_releases_service' in indexes)
+        self.assertEqual(release.stored_manifest, None)
+        self.assertEqual(release.image, 'old/build:1')
+
+    def test_pool_workers_get_their_own_engines(self):
+        """ pool workers should not share the parent's pooled connections """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        db_uri = 'sqlite:///{}'.format(tmp_log_path)
+        release_store = ReleaseStore(db_uri)
+        release_store.put('reg/svc:1', 'a.conf')
+
+        # run SUT
+        with worker_pool(1) as pool:
+            engine_id, build = pool.apply(engine_in_worker, (db_uri,))
+
+        self.assertNotEqual(engine_id, id(release_store.engine))
+        self.assertEqual(build, 'reg/svc:1')
+        self.assertEqual(release_store.get(1).build, 'reg/svc:1')
+
+    def test_release_store_shares_engine(self):
+        """ stores should share an engine and check the schema once """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        db_uri = 'sqlite:///{}'.format(tmp_log_path)
+
+        # run SUT
+        first = ReleaseStore(db_uri)
+        with patch('store.get_schema_version') as mock_get_version:
+            second = ReleaseStore(db_uri)
+            self.assertEqual(mock_get_version.call_count, 0)
+
+        self.assertTrue(first.engine is second.engine)
+        self.assertTrue(first.engine is get_engine(db_uri))
+        self.assertEqual(get_schema_version(first.engine), latest_version)
+
+        # a store can be shared by threads
+        pool = ThreadPool(4)
+        ids = pool.map(lambda x: first.put(str(x), str(x)).id_, range(20))
+        pool.close()
+        pool.join()
+        self.assertEqual(len(set(ids)), 20)
+        self.assertEqual(len(second.list(limit=100)), 20)
+
+    def test_encrypt_configs_pool(self):
+        """ a pool should encrypt with the given security module, in order """
+        # set up
+        fake_security = types.ModuleType('fake_security')
+        fake_security.sign_then_encrypt_file = encrypt_in_worker
+        sys.modules['fake_security'] = fake_security
+        self.addCleanup(sys.modules.pop, 'fake_security')
+        paths = ['one.conf', 'two.conf', 'three.conf']
+
+        # run SUT
+        encrypted = encrypt_configs(
+            paths, ['key'], concurrency=2, __security_module__=fake_security)
+
+        self.assertEqual(
+            [path.rsplit('.', 3)[0] for path in encrypted], paths)
+        self.assertTrue(all(path.split('.')[-3] == 'key' for path in encrypted))
+        pids = set(int(path.split('.')[-2]) for path in encrypted)
+        self.assertFalse(os.getpid() in pids)
+
+    def test_configure_batch(self):
+        """ configure --batch should create every release in one go """
+        # set up
+        csv_path = str(uuid4())
+        self.remove_paths.append(csv_path)
+        with open(csv_path, 'w') as csv_file:
+            csv_file.write("build,config\n")
+            csv_file.write("reg/svc:1, one.conf\n")
+            csv_file.write("\n")
+            csv_file.write("reg/svc:1,two.conf\n")
+            csv_file.write("reg/other:2,three.conf\n")
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+        mock_sec = Mock()
+        mock_sec.sign_then_encrypt_file.side_effect = \
+            lambda path, recipients: path + ".hash.sec"
+        mock_sec.distribute_secrets.side_effect = lambda paths: {
+            'names': paths, 'uploaded': paths, 'deduplicated': []}
+        mock_resolve_build = Mock(
+            side_effect=lambda build: (None, build + "@sha256:abc"))
+
+        # the mock can't be imported by the pool's workers
+        patcher = patch('commands.multiprocessing.cpu_count', return_value=1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # run SUT
+        releases = configure(
+            '--batch',
+            csv_path,
+            __security_module__=mock_sec,
+            __release_store__=release_store,
+            __resolve_build__=mock_resolve_build,
+            )
+
+        # every row became a release
+        self.assertEqual(
+            [(r.build, r.config) for r in releases],
+            [('reg/svc:1', 'one.conf.hash.sec'),
+             ('reg/svc:1', 'two.conf.hash.sec'),
+             ('reg/other:2', 'three.conf.hash.sec')],
+            )
+        self.assertEqual(len(release_store.list(limit=10)), 3)
+        self.assertEqual(
+            release_store.get(releases[2].id_).image,
+            'reg/other:2@sha256:abc',
+            )
+
+        # secrets are uploaded in one transfer, builds resolved once each
+        mock_sec.distribute_secrets.assert_called_once_with(
+            ['one.conf.hash.sec', 'two.conf.hash.sec', 'three.conf.hash.sec'])
+        self.assertEqual(mock_resolve_build.call_count, 2)
+
+    def test_configure_batch_rejects_bad_rows(self):
+        """ a malformed csv should fail before anything is encrypted """
+        # set up
+        csv_path = str(uuid4())
+        self.remove_paths.append(csv_path)
+        with open(csv_path, 'w') as csv_file:
+            csv_file.write("reg/svc:1,one.conf,extra\n")
+        mock_sec = Mock()
+
+        # run SUT
+        with self.assertRaises(ValueError):
+            configure_batch(
+                csv_path,
+                __security_module__=mock_sec,
+                __release_store__=Mock(),
+                )
+        self.assertEqual(mock_sec.sign_then_encrypt_file.call_count, 0)
+
+    def test_release_store_put_many(self):
+        """ put_many should store all releases or none """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+
+        # run SUT
+        releases = release_store.put_many([
+                {'build': 'reg/svc:1', 'config': 'a.conf'},
+                {'build': 'reg/svc:2', 'config': 'b.conf', 'image_digest': 'd'},
+                ])
+
+        self.assertEqual([r.id_ for r in releases], [1, 2])
+        self.assertEqual(release_store.get(2).image_digest, 'd')
+        self.assertEqual(release_store.get(1).service, 'svc')
+
+        # a bad release rolls back the whole batch
+        with self.assertRaises(Exception):
+            release_store.put_many([
+                    {'build': 'reg/svc:3', 'config': 'c.conf'},
+                    {'build': 'reg/svc:4', 'config': 'd.conf', 'bogus': 1},
+                    ])
+        self.assertEqual(len(release_store.list(limit=10)), 2)
+
+    def test_open_release_store(self):
+        """ the configured release store should open """
+        self.assertTrue(isinstance(open_release_store(), ReleaseStore))
+
+    def test_releases_opens_the_configured_store(self):
+        """ a command should open the configured store when none is given """
+        with patch('sys.stdout'):
+            releases('--limit', '1')
+
+    def test_release_store_references(self):
+        """ references should find the releases using each config """
+        # set up
+        tmp_log_path = str(uuid4())
+        self.remove_paths.append(tmp_log_path)
+        release_store = ReleaseStore('sqlite:///{}'.format(tmp_log_path))
+        first = release_store.put('reg/svc:1', 'a.conf.abc.sec')
+        second = release_store.put('reg/svc:2', 'a.conf.abc.sec')
+        third = release_store.put('reg/svc:2', 'b.conf.def.sec')
+
+        # run SUT
+        references = release_store.references(
+            ['a.conf.abc.sec', 'b.conf.def.sec', 'c.conf.012.sec'],
+            batch_size=2,
+            )
+
+        self.assertEqual(references, {
+                'a.conf.abc.sec': [second.id_, first.id_],
+                'b.conf.def.sec': [third.id_],
+                })
+
+    def test_secret_index(self):
+        """ the secret index should sync incrementally and answer searches """
+        # set up
+        tmp_index_path = str(uuid4())
+        self.remove_paths.append(tmp_index_path)
+        db_uri = 'sqlite:///{}'.format(tmp_index_path)
+        index = SecretIndex(db_uri, 'sec.mock.com')
+        other_index = SecretIndex(db_uri, 'other.mock.com')
+
+        # run SUT
+        self.assertEqual(index.cursor(), None)
+        index.update([
+                ('app.conf.abc.sec', 10, 100.0),
+                ('app.conf.def.sec', 20, 200.0),
+                ('db.conf.012.sec', 30, 150.0),
+                ])
+        other_index.update([('app.conf.fff.sec', 40, 300.0)])
+
+        self.assertEqual(index.cursor().mtime, 200.0)
+        self.assertEqual(
+            [s.name for s in index.find()],
+            ['app.conf.def.sec', 'db.conf.012.sec', 'app.conf.abc.sec'],
+            )
+        self.assertEqual(
+            [s.name for s in index.find(name='app')],
+            ['app.conf.def.sec', 'app.conf.abc.sec'],
+            )
+        self.assertEqual(
+            [s.name for s in index.find(latest=True)],
+            ['app.conf.def.sec', 'db.conf.012.sec'],
+            )
+        self.assertEqual(index.find(name='db')[0].digest, '012')
+        # name prefixes are not patterns
+        self.assertEqual(index.find(name='%'), [])
+        self.assertEqual(index.find(name='a_p'), [])
+
+        # incremental updates merge, full updates drop what's gone
+        index.update([('app.conf.def.sec', 25, 250.0)])
+        self.assertEqual(len(index.find()), 3)
+        self.assertEqual(index.find()[0].size, 25)
+        index.update([('db.conf.012.sec', 30, 150.0)], full=True)
+        self.assertEqual([s.name for s in index.find()], ['db.conf.012.sec'])
+        self.assertEqual(len(other_index.find()), 1)
+
+    def test_configs(self):
+        """ configs should sync the index from the store then list it """
+        # set up
+        tmp_index_path = str(uuid4())
+        self.remove_paths.append(tmp_index_path)
+        index = SecretIndex('sqlite:///{}'.format(tmp_index_path),
+                            'sec.iadops.com')
+        mock_release_store = Mock()
+        mock_release_store.references.return_value = {'app.conf.abc.sec': [3]}
+        patchers = [
+            patch('commands.open_secret_index', return_value=index),
+            patch('commands.open_release_store',
+                  return_value=mock_release_store),
+            patch('commands.run', return_value=(
+                    "100.5 10 app.conf.abc.sec\n200.5 20 app.conf.def.sec")),
+            patch('commands.settings'),
+            ]
+        mock_run = [patcher.start() for patcher in patchers][2]
+
+        # run SUT
+        try:
+            configs('--latest')
+            # the first listing is full, later ones are skipped while fresh
+            self.assertEqual(mock_run.call_count, 1)
+            self.assertFalse('-newermt' in mock_run.call_args[0][0])
+            configs('--name', 'app')
+            self.assertEqual(mock_run.call_count, 1)
+
+            # a stale index only asks for what changed
+            index.update([])
+            with patch('commands.get_config') as mock_get_config:
+                mock_get_config.return_value.get_int.return_value = -1
+                configs()
+            self.assertEqual(mock_run.call_count, 2)
+            self.assertTrue(
+                '-newermt @199.500000' in mock_run.call_args[0][0])
+        finally:
+            for patcher in patchers:
+                patcher.stop()
+
+        self.assertEqual(len(index.find()), 2)
+        mock_release_store.references.assert_called_with(
+            ['app.conf.def.sec', 'app.conf.abc.sec'])
+
     def test_can_pass(self):
         self.assertTrue(True)
@@ -0,0 +1,139 @@
+import os
+import unittest
+from uuid import uuid4
+from mock import MagicMock as Mock
+from mock import patch
+from fabric import state
+
+import connections
+from connections import (
+    ConnectionStats,
+    TrackedConnectionCache,
+    ssh_options,
+    https_get,
+    close_all,
+    )
+
+
+class HerdConnectionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stop = []
+        self.stats_patcher = patch('connections.stats', ConnectionStats())
+        self.stats = self.stats_patcher.start()
+        self.stop.append(self.stats_patcher)
+        self.connect_patcher = patch('fabric.network.connect')
+        self.mock_connect = self.connect_patcher.start()
+        self.stop.append(self.connect_patcher)
+
+    def tearDown(self):
+        map(lambda p: p.stop(), self.stop)
+
+    def test_tracked_connection_cache(self):
+        """ the first use of a host opens a connection, later uses reuse it """
+        # Set up
+        cache = TrackedConnectionCache()
+        host = "{}.mock.com".format(uuid4())
+        other_host = "{}.mock.com".format(uuid4())
+
+        # Run SUT
+        first = cache[host]
+        second = cache[host]
+        cache[other_host]
+
+        # only one connection per host
+        self.assertTrue(first is second)
+        self.assertEqual(self.mock_connect.call_count, 2)
+        self.assertEqual(self.stats.totals(), (2, 1))
+
+    def test_stats_merge(self):
+        """ counts from worker processes should add to the invocation's """
+        # Set up
+        worker_stats = ConnectionStats()
+        before = worker_stats.snapshot()
+        worker_stats.record("a", False)
+        worker_stats.record("a", True)
+        worker_stats.record("a", True)
+        self.stats.record("b", False)
+
+        # Run SUT
+        self.stats.merge(worker_stats.since(before))
+
+        self.assertEqual(self.stats.totals(), (2, 2))
+        self.assertEqual(self.stats.summary(),
+                         "2 ssh connections opened, 2 reused")
+
+    def test_ssh_options(self):
+        """ subprocesses should share one openssh master per host """
+        # Set up
+        host = "{}.mock.com".format(uuid4())
+        control_path = os.path.join(connections.control_dir(), host)
+
+        # Run SUT
+        options = ssh_options("user@{}".format(host))
+
+        self.assertTrue("-o ControlMaster=auto" in options)
+        self.assertTrue("-o ControlPath={}".format(control_path) in options)
+        self.assertEqual(self.stats.totals(), (1, 0))
+
+        # once the master socket exists it is reused
+        open(control_path, 'w').close()
+        self.assertEqual(ssh_options(host), options)
+        self.assertEqual(self.stats.totals(), (1, 1))
+
+    def test_close_all(self):
+        """ closing should drop fabric connections and stop masters """
+        # Set up
+        host = "{}.mock.com".format(uuid4())
+        mock_connection = Mock()
+        dict.__setitem__(state.connections, host, mock_connection)
+        directory = connections.control_dir()
+        open(os.path.join(directory, host), 'w').close()
+        call_patcher = patch('connections.subprocess.call')
+        mock_call = call_patcher.start()
+        self.stop.append(call_patcher)
+
+        # Run SUT
+        close_all()
+
+        mock_connection.close.assert_called_once_with()
+        self.assertFalse(host in dict.keys(state.connections))
+        self.assertEqual(mock_call.call_count, 1)
+        self.assertEqual(mock_call.call_args[0][0][-2:], ['exit', host])
+        self.assertFalse(os.path.exists(directory))
+        # closing doesn't count as using a connection
+        self.assertEqual(self.stats.totals(), (0, 0))
+
+    def test_https_get(self):
+        """ requests to a host should share a kept alive connection """
+        # Set up
+        host = "{}.mock.com".format(uuid4())
+        https_patcher = patch('connections.httplib.HTTPSConnection')
+        mock_https = https_patcher.start()
+        self.stop.append(https_patcher)
+        mock_connection = mock_https.return_value
+        mock_connection.getresponse.return_value.status = 200
+
+        # Run SUT
+        https_get(host, '/secret/a')
+        https_get(host, '/secret/b')
+
+        mock_https.assert_called_once_with(host)
+        self.assertEqual(mock_connection.request.call_count, 2)
+
+        # a connection the server closed is replaced once
+        mock_connection.getresponse.side_effect = [
+            connections.httplib.BadStatusLine(''),
+            mock_connection.getresponse.return_value,
+            ]
+        https_get(host, '/secret/c')
+        self.assertEqual(mock_https.call_count, 2)
+
+        # errors are raised
+        mock_connection.getresponse.side_effect = None
+        mock_connection.getresponse.return_value.status = 404
+        with self.assertRaises(IOError):
+            https_get(host, '/secret/d')
+
+        close_all()
+        self.assertEqual(connections._https_connections, {})
@@ -1,22 +1,40 @@
 import os
+import re
+import json
 import unittest
 from mock import MagicMock as Mock
 from mock import patch
 import fabric.api
+from fabric.operations import _AttributeString
 from uuid import uuid4
 import random
 from StringIO import StringIO
 from ConfigParser import ConfigParser
 
 import security
+from store import ReleaseStore, reset_engines
 from commands import (
-    ReleaseStore,
     stage_config,
     wipe_config,
     execute_release,
+    get_manifest,
+    resolve_build,
+    batch_deploy,
+    deploy_to_hosts,
+    read_hosts_file,
+    rollout,
     __deploy__,
     )
 
+def remote_output(text, return_code=0):
+    """ text as fabric's run returns it """
+    output = _AttributeString(text)
+    output.return_code = return_code
+    output.failed = return_code != 0
+    output.succeeded = not output.failed
+    return output
+
+
 class HerdDeployTests(unittest.TestCase):
 
     def setUp(self):
@@ -52,6 +70,7 @@ class HerdDeployTests(unittest.TestCase):
         def stop(p):
             p.stop()
 
+        reset_engines()
         map(rm, self.remove)
         map(stop, self.stop)
 
@@ -65,7 +84,8 @@ class HerdDeployTests(unittest.TestCase):
         mock_cypherfile = StringIO(str(uuid4()))
         mock_sec.fetch_secret.return_value = mock_cypherfile
         mock_plaintext = str(uuid4())
-        mock_sec.decrypt_and_verify_file.return_value = mock_plaintext
+        mock_sec.decrypt_and_verify_stream.return_value = StringIO(
+            mock_plaintext)
         sec_patcher = patch('commands.security', mock_sec)
         sec_patcher.start()
         self.stop.append(sec_patcher)
@@ -77,15 +97,16 @@ class HerdDeployTests(unittest.TestCase):
         # Should have fetched the correct config
         mock_sec.fetch_secret.assert_called_once_with(self.mock_config_name)
 
-        # Should have decrypted and verified the config
-        mock_sec.decrypt_and_verify_file.assert_called_once_with(
+        # Should have streamed the decrypted and verified config
+        mock_sec.decrypt_and_verify_stream.assert_called_once_with(
             mock_cypherfile,
             )
+        self.assertEqual(mock_sec.decrypt_and_verify_file.call_count, 0)
 
         # Should have put the file on the ramdisk
         # call mock_put once
         self.assertEqual(mock_put.call_count, 1)
-        # first arg should be a file object containing mock_plaintext
+        # first arg should be the decrypting stream
         self.assertEqual(mock_put.call_args_list[0][0][0].read(),
                          mock_plaintext,
                          )
@@ -108,6 +129,45 @@ class HerdDeployTests(unittest.TestCase):
                          )
 
 
+    def test_stage_config_wipes_unverified_config(self):
+        """ a config failing verification mid upload should be wiped """
+        # Set Up
+        put_patcher = patch("commands.put", side_effect=SystemExit)
+        put_patcher.start()
+        self.stop.append(put_patcher)
+        run_patcher = patch("commands.run")
+        mock_run = run_patcher.start()
+        self.stop.append(run_patcher)
+        sec_patcher = patch('commands.security')
+        sec_patcher.start()
+        self.stop.append(sec_patcher)
+
+        # run SUT
+        with self.assertRaises(SystemExit):
+            stage_config(self.release, str(uuid4()))
+
+        # the partly uploaded config was shredded
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertTrue(mock_run.call_args[0][0].startswith(
+                "shred -u /test/config/stage/path/"))
+
+    def test_stage_config_plaintext(self):
+        """ a given plaintext should be staged without decrypting again """
+        # Set Up
+        put_patcher = patch("commands.put")
+        mock_put = put_patcher.start()
+        self.stop.append(put_patcher)
+        sec_patcher = patch('commands.security')
+        mock_sec = sec_patcher.start()
+        self.stop.append(sec_patcher)
+        plaintext = str(uuid4())
+
+        # run SUT
+        stage_config(self.release, str(uuid4()), plaintext)
+
+        self.assertEqual(mock_put.call_args[0][0].read(), plaintext)
+        self.assertEqual(mock_sec.fetch_secret.call_count, 0)
+
     def test_wipe_config(self):
         """ should use shred -u to remove the ramdisk file """
         # Set up
@@ -165,6 +225,224 @@ class HerdDeployTests(unittest.TestCase):
         # should get the manifest from the deploy target
         mock_get_manifest.assert_called_once_with(self.release, host)
 
+    def test_get_manifest_from_labels(self):
+        """ the manifest should be read from the image's labels """
+        # Set up
+        host = str(uuid4())
+        service_port = str(random.randint(1000, 9999))
+        labels = {
+            "herd.service.name": "mock",
+            "herd.service.service_port": service_port,
+            "herd.dependencies.environment_name": "",
+            "maintainer": "someone",
+            }
+
+        def mock_run(cmd):
+            if cmd.startswith("docker inspect"):
+                return json.dumps(labels)
+            return ""
+        self.mock_run.side_effect = mock_run
+
+        # Run SUT
+        manifest = get_manifest(self.release, host)
+
+        # should pull then inspect the build without starting a container
+        self.assertEqual(
+            [c[0][0] for c in self.mock_run.call_args_list],
+            ["docker pull {}".format(self.release.build),
+             "docker inspect --format '{{{{json .Config.Labels}}}}' {}".format(
+                    self.release.build)],
+            )
+        self.mock_settings.assert_called_once_with(host_string=host)
+
+        self.assertEqual(manifest.get("Service", "service_port"), service_port)
+        self.assertEqual(manifest.get("Service", "name"), "mock")
+        self.assertEqual(manifest.items("Dependencies"),
+                         [("environment_name", None)])
+
+    def test_get_manifest_legacy_image(self):
+        """ images without herd labels should have /Manifest read instead """
+        # Set up
+        host = str(uuid4())
+
+        def mock_run(cmd):
+            if cmd.startswith("docker inspect"):
+                return "null"
+            if cmd.startswith("docker run"):
+                return "[Service]\nservice_port=1234\n[Dependencies]\ndep\n"
+            return ""
+        self.mock_run.side_effect = mock_run
+
+        # Run SUT
+        manifest = get_manifest(self.release, host)
+
+        # should fall back to a throwaway container
+        self.mock_run.assert_called_with(
+            "docker run --rm {} cat /Manifest".format(self.release.build))
+        self.assertEqual(manifest.get("Service", "service_port"), "1234")
+        self.assertEqual(manifest.items("Dependencies"), [("dep", None)])
+
+    def test_execute_stored_release(self):
+        """ releases with a stored manifest should run without inspection """
+        # Set up
+        host = str(uuid4())
+        stage_name = str(uuid4())
+        digest = "{}@sha256:{}".format(self.mock_build_name, uuid4().hex)
+        release = self.releases.put(
+            self.mock_build_name,
+            self.mock_config_name,
+            manifest="[Service]\nservice_port=1234\n[Dependencies]\ndep\n",
+            image_digest=digest,
+            )
+        get_manifest_patcher = patch("commands.get_manifest")
+        mock_get_manifest = get_manifest_patcher.start()
+        self.stop.append(get_manifest_patcher)
+
+        # Run SUT
+        execute_release(release, host, None, stage_name)
+
+        # should not look at the image on the host
+        self.assertEqual(mock_get_manifest.call_count, 0)
+
+        # should run the build pinned to its digest with the stored manifest
+        self.mock_run.assert_called_once_with(
+            "docker run -d -p 1234:1234 --env-file={} -e Dep {}".format(
+                os.path.join("/test/config/stage/path", stage_name),
+                digest,
+                ))
+
+        # Run SUT (a tag isn't pinned, so it is pulled again)
+        self.mock_run.reset_mock()
+        release = self.releases.put(
+            self.mock_build_name,
+            self.mock_config_name,
+            manifest="[Service]\nservice_port=1234\n[Dependencies]\ndep\n",
+            )
+        execute_release(release, host, None, stage_name)
+
+        self.assertEqual(mock_get_manifest.call_count, 0)
+        self.assertEqual(
+            [c[0][0] for c in self.mock_run.call_args_list],
+            ["docker pull {}".format(self.mock_build_name),
+             "docker run -d -p 1234:1234 --env-file={} -e Dep {}".format(
+                    os.path.join("/test/config/stage/path", stage_name),
+                    self.mock_build_name)])
+
+    def test_resolve_build(self):
+        """ resolving a build should give its manifest and repo digest """
+        # Set up
+        host = str(uuid4())
+        build = "r.mock.com:5000/mock:1.0"
+        digest = "r.mock.com:5000/mock@sha256:{}".format(uuid4().hex)
+        other_digest = "mirror.com/mock@sha256:{}".format(uuid4().hex)
+
+        def mock_run(cmd):
+            if ".Config.Labels" in cmd:
+                return json.dumps({"herd.service.service_port": "1234"})
+            if ".RepoDigests" in cmd:
+                return json.dumps([other_digest, digest])
+            return ""
+        self.mock_run.side_effect = mock_run
+
+        # Run SUT
+        manifest, image_digest = resolve_build(build, host)
+
+        self.assertEqual(manifest.get("Service", "service_port"), "1234")
+        self.assertEqual(image_digest, digest)
+
+        # builds without a digest resolve to None
+        self.mock_run.side_effect = lambda cmd: "null" if "Digests" in cmd \
+            else mock_run(cmd)
+        self.assertEqual(resolve_build(build, host)[1], None)
+
+        # by default the first build host is used without probing the pool
+        hosts_patcher = patch('commands.build_hosts',
+                              return_value=('a.mock.com', 'b.mock.com'))
+        hosts_patcher.start()
+        self.stop.append(hosts_patcher)
+        pick_patcher = patch('commands.build_host')
+        mock_pick = pick_patcher.start()
+        self.stop.append(pick_patcher)
+        self.mock_settings.reset_mock()
+        resolve_build(build)
+        self.assertEqual(mock_pick.call_count, 0)
+        self.mock_settings.assert_called_with(host_string='a.mock.com')
+
+    def test_batch_deploy(self):
+        """ a batched deploy should send the host one script to run """
+        # Set up
+        put_patcher = patch("commands.put")
+        mock_put = put_patcher.start()
+        self.stop.append(put_patcher)
+        host = str(uuid4())
+        plaintext = "a={}".format(uuid4())
+        release = self.releases.put(
+            self.mock_build_name,
+            self.mock_config_name,
+            manifest="[Service]\nservice_port=1234\n[Dependencies]\n",
+            )
+        failing = []
+
+        def mock_run(cmd):
+            script = mock_put.call_args[0][0].getvalue()
+            token = re.search("HERD-STEP-[0-9a-f]+", script).group(0)
+            output = []
+            status = 0
+            for step in ["stage_config", "pull", "execute_release"]:
+                if status:
+                    output.append("{} skip {}".format(token, step))
+                    continue
+                status = 1 if step in failing else 0
+                output.append("{} begin {}".format(token, step))
+                output.append("{} end {} {}".format(token, step, status))
+            for step in ["wipe_config", "wipe_script"]:
+                output.append("{} begin {}".format(token, step))
+                output.append("{} end {} 0".format(token, step))
+            return remote_output('\r\n'.join(output), status)
+        self.mock_run.side_effect = mock_run
+
+        # Run SUT
+        results = batch_deploy(release, host, "8080", plaintext)
+
+        # one file transfer and one command
+        self.assertEqual(mock_put.call_count, 1)
+        self.assertEqual(self.mock_run.call_count, 1)
+        script = mock_put.call_args[0][0].getvalue()
+        script_path = mock_put.call_args[0][1]
+        self.assertTrue(script_path.startswith("/test/config/stage/path/"))
+        self.mock_run.assert_called_once_with("bash {}".format(script_path))
+        # the script holds the config so only its owner may read it
+        self.assertEqual(mock_put.call_args[1], {'mode': 0600})
+        self.assertEqual(
+            [(r['name'], r['exit_code']) for r in results],
+            [("stage_config", 0), ("pull", 0), ("execute_release", 0),
+             ("wipe_config", 0), ("wipe_script", 0)],
+            )
+
+        # the script should stage, pull, run and wipe
+        self.assertTrue(plaintext in script)
+        self.assertTrue("docker pull {}".format(self.mock_build_name) in script)
+        # the release's tag isn't pinned, so it is pulled even if it's there
+        self.assertFalse("docker inspect" in script)
+        self.assertTrue("docker run -d -p 8080:1234 " in script)
+        self.assertTrue("shred -u {}\n".format(script_path[:-3]) in script)
+        self.assertTrue("shred -u {}\n".format(script_path) in script)
+
+        # a failed pull should abort the deploy
+        failing.append("pull")
+        with self.assertRaises(SystemExit):
+            batch_deploy(release, host, "8080", plaintext)
+
+        # a script that never ran should abort and be wiped
+        self.mock_run.side_effect = None
+        self.mock_run.return_value = remote_output(
+            "bash: command not found", 127)
+        with self.assertRaises(SystemExit):
+            batch_deploy(release, host, "8080", plaintext)
+        script_path = mock_put.call_args[0][1]
+        self.mock_run.assert_called_with(
+            "shred -u {} {}".format(script_path[:-3], script_path))
+
     def test_deploy(self):
         """ deploy should stage, execute then wipe """
         # Set up
@@ -185,8 +463,9 @@ class HerdDeployTests(unittest.TestCase):
         # Run SUT
         __deploy__(self.release, "{}:{}".format(host, port))
 
-        # Stage should have been called with release and host
-        mock_stage.assert_called_once_with(self.release, host)
+        # Stage should have been called with release and host and should
+        # decrypt the config itself
+        mock_stage.assert_called_once_with(self.release, host, None)
 
         # exe should have been called with stage's return_value
         mock_exe.assert_called_once_with(self.release, host, port, mock_stage())
@@ -195,5 +474,146 @@ class HerdDeployTests(unittest.TestCase):
         # return_value
         mock_wipe.assert_called_once_with(host, mock_stage())
 
+    def test_deploy_to_hosts(self):
+        """ a batched deploy to many hosts should decrypt once and report each
+        host """
+        # Set up
+        decrypt_patcher = patch('commands.decrypt_config')
+        deploy_patcher = patch('commands.__deploy__')
+        mock_decrypt = decrypt_patcher.start()
+        self.stop.append(decrypt_patcher)
+        mock_decrypt.return_value = str(uuid4())
+        mock_deploy = deploy_patcher.start()
+        self.stop.append(deploy_patcher)
+        bad_host = str(uuid4())
+
+        def fail_on_bad_host(release, host, plaintext, batched):
+            if host == bad_host:
+                raise SystemExit("mock failure")
+        mock_deploy.side_effect = fail_on_bad_host
+
+        hosts = [str(uuid4()), bad_host, "{}:8080".format(uuid4())]
+
+        # Run SUT
+        results = deploy_to_hosts(self.release, hosts, batched=True)
+
+        # the config should only be decrypted once
+        mock_decrypt.assert_called_once_with(self.release)
+
+        # every host should get the decrypted plaintext
+        self.assertEqual(
+            [c[0] for c in mock_deploy.call_args_list],
+            [(self.release, h, mock_decrypt.return_value, True)
+             for h in hosts],
+            )
+
+        # results are reported per host in order with timings
+        self.assertEqual([r['host'] for r in results], hosts)
+        self.assertEqual([r['ok'] for r in results], [True, False, True])
+        self.assertEqual(results[1]['error'], "mock failure")
+        for result in results:
+            self.assertTrue(result['seconds'] >= 0)
+
+        # Run SUT (unbatched, each host streams its own config)
+        mock_decrypt.reset_mock()
+        mock_deploy.reset_mock()
+        sec_patcher = patch('commands.security')
+        mock_sec = sec_patcher.start()
+        self.stop.append(sec_patcher)
+        deploy_to_hosts(self.release, hosts)
+
+        # the cyphertext is cached once for the workers to share
+        self.assertEqual(mock_decrypt.call_count, 0)
+        mock_sec.cache_secret.assert_called_once_with(self.mock_config_name)
+        self.assertEqual(
+            [c[0] for c in mock_deploy.call_args_list],
+            [(self.release, h, None, False) for h in hosts],
+            )
+
+    def test_deploy_to_hosts_in_parallel(self):
+        """ deploys on a worker pool should still report every host """
+        # Set up
+        decrypt_patcher = patch('commands.decrypt_config')
+        deploy_patcher = patch('commands.__deploy__')
+        mock_decrypt = decrypt_patcher.start()
+        self.stop.append(decrypt_patcher)
+        mock_decrypt.return_value = str(uuid4())
+        deploy_patcher.start()
+        self.stop.append(deploy_patcher)
+        hosts = [str(uuid4()) for x in range(4)]
+
+        # Run SUT
+        results = deploy_to_hosts(self.release, hosts, concurrency=2)
+
+        self.assertEqual([r['host'] for r in results], hosts)
+        self.assertTrue(all(r['ok'] for r in results))
+
+    def test_rollout_waves(self):
+        """ rollout should deploy in waves and stop past the failure budget """
+        # Set up
+        patchers = dict(
+            (name, patch('commands.{}'.format(name)))
+            for name
+            in ['decrypt_config', 'deploy_to_hosts', 'prepull',
+                'multiprocessing']
+            )
+        mocks = dict((name, p.start()) for name, p in patchers.items())
+        self.stop.extend(patchers.values())
+        mocks['decrypt_config'].return_value = str(uuid4())
+        bad_hosts = set(["h3", "h4"])
+
+        def mock_deploy(release, hosts, concurrency, plaintext, batched):
+            return [{'host': h, 'ok': h not in bad_hosts} for h in hosts]
+        mocks['deploy_to_hosts'].side_effect = mock_deploy
+        hosts = ["h{}".format(x) for x in range(1, 8)]
+
+        # Run SUT (without a failure budget every wave is deployed)
+        results = rollout(self.release, hosts, 3, wave_size=2)
+
+        self.assertEqual([r['host'] for r in results], hosts)
+        self.assertEqual(
+            [c[0][1] for c in mocks['deploy_to_hosts'].call_args_list],
+            [["h1", "h2"], ["h3", "h4"], ["h5", "h6"], ["h7"]],
+            )
+        # the config is left for each host to stream
+        self.assertEqual(mocks['decrypt_config'].call_count, 0)
+        for c in mocks['deploy_to_hosts'].call_args_list:
+            self.assertEqual(c[0][3], None)
+
+        # the next wave is pre-pulled while the current wave deploys
+        self.assertEqual(
+            [c[0][1] for c in mocks['prepull'].call_args_list],
+            [["h3", "h4"], ["h5", "h6"], ["h7"]],
+            )
+
+        # Run SUT (with a failure budget the rollout stops early)
+        mocks['deploy_to_hosts'].reset_mock()
+        results = rollout(self.release, hosts, 3, wave_size=2, max_failures=1)
+
+        self.assertEqual([r['host'] for r in results], hosts[:4])
+        self.assertEqual(mocks['deploy_to_hosts'].call_count, 2)
+
+        # Run SUT (a single wave does not pre-pull)
+        mocks['prepull'].reset_mock()
+        rollout(self.release, hosts, 3)
+        self.assertEqual(mocks['prepull'].call_count, 0)
+
+        # Run SUT (a batched rollout decrypts the config once for every wave)
+        mocks['deploy_to_hosts'].reset_mock()
+        rollout(self.release, hosts, 3, wave_size=2, batched=True)
+
+        mocks['decrypt_config'].assert_called_once_with(self.release)
+        for c in mocks['deploy_to_hosts'].call_args_list:
+            self.assertEqual(c[0][3], mocks['decrypt_config'].return_value)
+
+    def test_read_hosts_file(self):
+        """ hosts files list one target per line with optional comments """
+        hosts_path = str(uuid4())
+        self.remove.append(hosts_path)
+        with open(hosts_path, 'w') as hosts_file:
+            hosts_file.write("# web nodes\na.host\n\nb.host:8080  # canary\n")
+
+        self.assertEqual(read_hosts_file(hosts_path), ["a.host", "b.host:8080"])
+
     def test_can_pass(self):
         self.assertTrue(True)
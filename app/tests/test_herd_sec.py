@@ -1,20 +1,71 @@
 import os
+import shutil
+import hashlib
+import tempfile
 import unittest
 from uuid import uuid4 as uuid
+from StringIO import StringIO
 import gnupg
+import fabric.api
 from mock import MagicMock as Mock
+from mock import patch
+
+from connections import ssh_options
 
 from security import (
     sign_then_encrypt_file,
     decrypt_and_verify_file,
     distribute_secret,
+    distribute_secrets,
     fetch_secret,
+    cache_secret,
+    gpg_session,
+    reset_gpg_sessions,
+    calculate_digest,
+    scan_armor,
+    stored_secret_digests,
+    SecretCache,
+    SecretMismatchError,
     DistributeMalformedError,
+    DistributeFailedError,
     NotTrustedError,
     DecryptionError,
     )
 
 
+class FakeSFTPClient(object):
+    """ just enough of paramiko's sftp client for fabric's put, keeping what
+    is uploaded in memory """
+
+    def __init__(self):
+        self.files = {}
+
+    def normalize(self, path):
+        return "/home/mock"
+
+    def getcwd(self):
+        return None
+
+    def stat(self, path):
+        raise IOError("no such file")
+
+    lstat = stat
+
+    def putfo(self, fileobj, path):
+        chunks = []
+        for chunk in iter(lambda: fileobj.read(32768), ''):
+            chunks.append(chunk)
+        self.files[path] = ''.join(chunks)
+        return Mock(st_mode=None)
+
+    def put(self, localpath, path):
+        with open(localpath, 'rb') as localfile:
+            return self.putfo(localfile, path)
+
+    def close(self):
+        pass
+
+
 class HerdSecretsTest(unittest.TestCase):
 
     def setUp(self):
@@ -79,12 +130,19 @@ class HerdSecretsTest(unittest.TestCase):
 
         # intercept os.system
         self.realsystem = os.system
-        self.mock_system = Mock()
+        self.mock_system = Mock(return_value=0)
         os.system = self.mock_system
 
+        # the secret store has no secrets yet
+        self.stored_patcher = patch('security.stored_secret_digests',
+                                    return_value={})
+        self.mock_stored = self.stored_patcher.start()
+
     def tearDown(self):
         # restore os.system
         os.system = self.realsystem
+        self.stored_patcher.stop()
+        reset_gpg_sessions()
 
         # remove test files
         def remove(p):
@@ -205,10 +263,240 @@ class HerdSecretsTest(unittest.TestCase):
         distribute_secret(cypherpath)
 
         # confirm that os.system called the correct scp command
-        scp_cmd = "scp {} sec.iadops.com:/var/secret/{}".format(
-            cypherpath, os.path.basename(cypherpath))
+        scp_cmd = "scp {} {} sec.iadops.com:/var/secret/".format(
+            ssh_options("sec.iadops.com"),
+            cypherpath,
+            )
         os.system.assert_called_once_with(scp_cmd)
 
+    def test_distribute_secrets(self):
+        """ herd should check every secret then upload them in one scp """
+        # set up
+        cypherpath = sign_then_encrypt_file(
+            self.plainpath,
+            self.my_fingerprint,
+            self.recipients,
+            )
+        self.remove.append(cypherpath)
+        bad_extension_path = cypherpath[:-4] + ".gpg"
+        self.remove.append(bad_extension_path)
+        with open(cypherpath, 'r') as cypherfile:
+            with open(bad_extension_path, 'w') as bad_extension_file:
+                bad_extension_file.write(cypherfile.read())
+
+        # one bad file means nothing is uploaded
+        with self.assertRaises(DistributeMalformedError):
+            distribute_secrets([cypherpath, bad_extension_path])
+        self.assertEqual(os.system.call_count, 0)
+
+        # run SUT
+        name = os.path.basename(cypherpath)
+        result = distribute_secrets([cypherpath, cypherpath])
+
+        self.assertEqual(result['names'], [name] * 2)
+        self.assertEqual(result['uploaded'], [name])
+        self.assertEqual(result['deduplicated'], [])
+        self.mock_stored.assert_called_once_with("sec.iadops.com", [name])
+        os.system.assert_called_once_with(
+            "scp {} {} sec.iadops.com:/var/secret/".format(
+                ssh_options("sec.iadops.com"), cypherpath))
+
+        # secrets the store has with the same digest aren't uploaded again
+        os.system.reset_mock()
+        self.mock_stored.return_value = {name: name.split('.')[-2]}
+        result = distribute_secrets([cypherpath])
+        self.assertEqual(result['uploaded'], [])
+        self.assertEqual(result['deduplicated'], [name])
+        self.assertEqual(os.system.call_count, 0)
+
+        # but are if the stored copy doesn't match
+        self.mock_stored.return_value = {name: "0" * 64}
+        result = distribute_secrets([cypherpath])
+        self.assertEqual(result['uploaded'], [name])
+        self.assertEqual(os.system.call_count, 1)
+
+        # a failed scp is an error rather than an upload
+        os.system.return_value = 256
+        with self.assertRaises(DistributeFailedError):
+            distribute_secrets([cypherpath])
+
+    def test_stored_secret_digests(self):
+        """ the store should be asked for digests in one ssh command """
+        # set up
+        self.stored_patcher.stop()
+        popen_patcher = patch('security.subprocess.Popen')
+        mock_popen = popen_patcher.start()
+        mock_popen.return_value.communicate.return_value = (
+            "abc123  a.abc123.sec\ndef456 *b.def456.sec\n", None)
+
+        # run SUT
+        try:
+            digests = stored_secret_digests(
+                "sec.iadops.com", ["a.abc123.sec", "b.def456.sec", "c.0.sec"])
+        finally:
+            popen_patcher.stop()
+            self.stored_patcher.start()
+
+        self.assertEqual(
+            digests, {"a.abc123.sec": "abc123", "b.def456.sec": "def456"})
+        self.assertEqual(mock_popen.call_count, 1)
+        cmd = mock_popen.call_args[0][0]
+        self.assertEqual(cmd[0], 'ssh')
+        self.assertEqual(
+            cmd[-1],
+            "cd /var/secret && sha256sum -- "
+            "a.abc123.sec b.def456.sec c.0.sec 2>/dev/null",
+            )
+
+    def test_gpg_session_is_shared(self):
+        """ herd should build one gnupg.GPG per keyring and reuse it """
+        session = gpg_session()
+        self.assertTrue(session is gpg_session())
+        self.assertTrue(session is gpg_session("app/tests/gnupghome"))
+        other_homedir = tempfile.mkdtemp()
+        try:
+            self.assertFalse(session is gpg_session(other_homedir))
+        finally:
+            shutil.rmtree(other_homedir, ignore_errors=True)
+
+        # encrypting doesn't build another
+        with patch('gnupg.GPG') as mock_gpg:
+            cypherpath = sign_then_encrypt_file(
+                self.plainpath,
+                self.my_fingerprint,
+                self.recipients,
+                )
+            self.remove.append(cypherpath)
+            self.assertEqual(mock_gpg.call_count, 0)
+
+    def test_gpg_session_trust_levels(self):
+        """ a signer's trust should be looked up in the keyring at most once """
+        session = gpg_session()
+        session.gpg = Mock()
+        session.gpg.list_keys.return_value = [
+            {'fingerprint': self.my_fingerprint, 'trust': 'u'},
+            {'fingerprint': self.untrusted_fingerprint, 'trust': '-'},
+            ]
+        verified = gnupg._parsers.Crypt(session.gpg)
+        verified.fingerprint = self.my_fingerprint
+
+        # gpg didn't report the trust level so the keyring is read
+        self.assertEqual(session.trust_level(verified), verified.TRUST_ULTIMATE)
+        verified.fingerprint = self.untrusted_fingerprint
+        self.assertEqual(
+            session.trust_level(verified), verified.TRUST_UNDEFINED)
+        self.assertEqual(session.gpg.list_keys.call_count, 1)
+
+        # a reported trust level is remembered
+        verified.fingerprint = self.their_fingerprint
+        verified.trust_level = verified.TRUST_FULLY
+        self.assertEqual(session.trust_level(verified), verified.TRUST_FULLY)
+        verified.trust_level = None
+        self.assertEqual(session.trust_level(verified), verified.TRUST_FULLY)
+        self.assertEqual(session.gpg.list_keys.call_count, 1)
+
+    def test_gpg_stream(self):
+        """ gpg output should be read in chunks and checked at its end """
+        # set up
+        on_result = Mock()
+        plaintext = StringIO(str(uuid()) * 10000)
+
+        # run SUT
+        crypt = gpg_session().pipe(
+            ['--armor', '--always-trust', '--encrypt',
+             '--recipient {}'.format(self.my_fingerprint)],
+            plaintext,
+            on_result=on_result,
+            )
+
+        first = crypt.read(100)
+        self.assertEqual(len(first), 100)
+        self.assertEqual(crypt.tell(), 100)
+        crypt.seek(100)
+        with self.assertRaises(IOError):
+            crypt.seek(0)
+        self.assertEqual(on_result.call_count, 0)
+
+        cyphertext = first + ''.join(crypt)
+        on_result.assert_called_once_with(crypt.result)
+        self.assertTrue(crypt.result.ok)
+        self.assertTrue(cyphertext.startswith("-----BEGIN PGP MESSAGE-----"))
+        self.assertEqual(crypt.read(), '')
+
+    def test_gpg_stream_put(self):
+        """ fabric's put should upload gpg output and seek back after """
+        # set up a host whose sftp keeps the upload in memory
+        sftp = FakeSFTPClient()
+        connection = Mock()
+        connection.open_sftp.return_value = sftp
+        connections_patcher = patch(
+            'fabric.sftp.connections', {'mock.host': connection})
+        connections_patcher.start()
+        self.addCleanup(connections_patcher.stop)
+        on_result = Mock()
+        crypt = gpg_session().pipe(
+            ['--armor', '--always-trust', '--encrypt',
+             '--recipient {}'.format(self.my_fingerprint)],
+            StringIO(str(uuid()) * 10000),
+            on_result=on_result,
+            )
+
+        # run SUT
+        with fabric.api.settings(fabric.api.hide('everything'),
+                                 host_string='mock.host'):
+            fabric.api.put(crypt, "/stage/config")
+
+        # the whole output is uploaded and checked
+        self.assertTrue(sftp.files["/stage/config"].startswith(
+            "-----BEGIN PGP MESSAGE-----"))
+        self.assertEqual(len(sftp.files["/stage/config"]), crypt.tell())
+        on_result.assert_called_once_with(crypt.result)
+
+    def test_hash_algos(self):
+        """ security_hash_algo should pick hashlib or Crypto hashes """
+        from Crypto.Hash import SHA256, BLAKE2b
+        data = str(uuid())
+
+        def digest_with(algo):
+            with patch('security.get_config',
+                       return_value={'security_hash_algo': algo}):
+                return calculate_digest(data)
+
+        self.assertEqual(digest_with("SHA256"), SHA256.new(data).hexdigest())
+        self.assertEqual(
+            digest_with("BLAKE2b"),
+            BLAKE2b.new(data=data, digest_bits=512).hexdigest(),
+            )
+        self.assertEqual(calculate_digest(data), digest_with("SHA256"))
+
+    def test_scan_armor(self):
+        """ armor should be checked in one pass over the lines """
+        header = "-----BEGIN PGP MESSAGE-----\n"
+        tail = "-----END PGP MESSAGE-----\n"
+        seen = []
+
+        # the version header, last data line and checksum may have spaces
+        well_formed = [header, "Version: x y\n", "\n", "abc\n", "def\n",
+                       "de f\n", "=ab c\n", tail]
+        self.assertEqual(scan_armor(well_formed, seen.append), [])
+        self.assertEqual(seen, well_formed)
+
+        self.assertEqual(
+            scan_armor([header, "\n", "a c\n", "def\n", "=abc\n", tail]),
+            ["Whitespace in ASCII-Armored data"],
+            )
+        self.assertEqual(
+            scan_armor([header, "\n", "=abc\n", tail]),
+            ["No ASCII-Armored data"],
+            )
+        self.assertEqual(
+            scan_armor([header, "abc\n", "\n"]),
+            ["Missing or malformed Armor Tail", "Missing blank line",
+             "No ASCII-Armored data"],
+            )
+        self.assertEqual(scan_armor([])[0],
+                         "Missing or malformed Armor Header Line")
+
     def test_fetch_secret(self):
         """ herd should be able to download a secret file """
         # set up
@@ -222,6 +510,77 @@ class HerdSecretsTest(unittest.TestCase):
         expected_str = "https://sec.iadops.com/secret/{}".format(secret_name)
         mock_fetcher.assert_called_once_with(expected_str)
 
+    def test_fetch_secret_cached(self):
+        """ secrets named by their digest should only be fetched once """
+        # set up
+        cache_path = tempfile.mkdtemp()
+        self.remove.append(cache_path)
+        cache = SecretCache(cache_path, 1024 * 1024)
+        cyphertext = str(uuid())
+        secret_name = "app.conf.{}.sec".format(calculate_digest(cyphertext))
+        mock_fetcher = Mock(side_effect=lambda url: StringIO(cyphertext))
+
+        # run SUT
+        with patch('security.secret_cache', return_value=cache):
+            first = fetch_secret(secret_name, mock_fetcher).read()
+            second = fetch_secret(secret_name, mock_fetcher).read()
+
+            self.assertEqual(first, cyphertext)
+            self.assertEqual(second, cyphertext)
+            mock_fetcher.assert_called_once_with(
+                "https://sec.iadops.com/secret/{}".format(secret_name))
+            self.assertEqual(
+                cache_secret(secret_name, mock_fetcher),
+                os.path.join(cache_path, calculate_digest(cyphertext)))
+            self.assertEqual(mock_fetcher.call_count, 1)
+
+            # a secret named with another hash algorithm than the configured
+            # one can't be checked, so it is fetched without the cache
+            with patch('security.new_hasher', side_effect=hashlib.sha512):
+                self.assertEqual(
+                    fetch_secret(secret_name, mock_fetcher).read(), cyphertext)
+            self.assertEqual(mock_fetcher.call_count, 2)
+
+            # a fetched secret must match its name
+            wrong_name = "app.conf.{}.sec".format(calculate_digest("x"))
+            with self.assertRaises(SecretMismatchError):
+                fetch_secret(wrong_name, mock_fetcher)
+        self.assertEqual(os.listdir(cache_path),
+                         [calculate_digest(cyphertext)])
+        shutil.rmtree(cache_path)
+
+    def test_secret_cache(self):
+        """ entries should be verified and the least recently used evicted """
+        # set up
+        cache_path = tempfile.mkdtemp()
+        self.remove.append(cache_path)
+        cache = SecretCache(cache_path, 250)
+        secrets = dict(
+            (calculate_digest(data), data)
+            for data
+            in ['a' * 100, 'b' * 100, 'c' * 100]
+            )
+        a, b, c = [calculate_digest(x * 100) for x in 'abc']
+
+        # run SUT
+        cache.put(a, StringIO(secrets[a]))
+        cache.put(b, StringIO(secrets[b]))
+        os.utime(cache.entry_path(a), (0, 0))
+        os.utime(cache.entry_path(b), (1, 1))
+        self.assertEqual(cache.get(a), cache.entry_path(a))
+
+        # b is now the least recently used
+        cache.put(c, StringIO(secrets[c]))
+        self.assertEqual(cache.get(b), None)
+        self.assertEqual(sorted(os.listdir(cache_path)), sorted([a, c]))
+
+        # tampered entries are dropped
+        with open(cache.entry_path(c), 'a') as entry:
+            entry.write('x')
+        self.assertEqual(cache.get(c), None)
+        self.assertFalse(os.path.exists(cache.entry_path(c)))
+        shutil.rmtree(cache_path)
+
     def test_decrypt_and_verify_my_secret(self):
         """ herd should decrypt and verify secrets intended for me
 
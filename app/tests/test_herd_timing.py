@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from StringIO import StringIO
+from mock import patch
+
+import helpers
+import timing
+import security
+from main import main
+from store import SessionStore
+
+
+def record_in_worker():
+    timing.record("worker step", 'run', timing.time.time(), 0.5)
+
+
+class HerdTimingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work)
+        self.trace_path = os.path.join(self.work, 'trace.json')
+        self.addCleanup(timing.finish)
+
+    def test_trace(self):
+        """ fabric operations, queries and spans should land in the trace """
+        # set up
+        original_local = helpers.local
+        timing.start()
+        self.assertNotEqual(helpers.local, original_local)
+
+        # run SUT
+        helpers.local("echo traced", capture=True)
+        store = SessionStore('sqlite:///:memory:')
+        with store.session_scope() as session:
+            session.execute("select 1")
+        with timing.span("step", 'gpg') as details:
+            details['bytes'] = 10
+        worker = multiprocessing.Process(target=record_in_worker)
+        worker.start()
+        worker.join()
+        with patch('sys.stderr'):
+            timing.finish(self.trace_path)
+
+        # the operations are put back
+        self.assertEqual(helpers.local, original_local)
+        with open(self.trace_path) as trace:
+            events = json.load(trace)['traceEvents']
+        by_category = dict((event['cat'], event) for event in events)
+        self.assertEqual(
+            sorted(by_category), ['gpg', 'local', 'run', 'sql'])
+        self.assertTrue(all(event['ph'] == 'X' for event in events))
+        self.assertEqual(by_category['local']['name'], "echo traced")
+        self.assertEqual(by_category['local']['args']['bytes'], 6)
+        self.assertEqual(by_category['sql']['name'], "select 1")
+        self.assertEqual(by_category['gpg']['args'], {'bytes': 10})
+        self.assertEqual(by_category['run']['dur'], 500000)
+        self.assertNotEqual(by_category['run']['pid'], os.getpid())
+
+    def test_transfer_bytes(self):
+        """ puts and https fetches should record every byte sent """
+        # set up a put that seeks the file back like fabric's does
+        def put(local_path, remote_path):
+            position = local_path.tell()
+            local_path.seek(0)
+            local_path.read()
+            local_path.seek(position)
+        timing.start()
+
+        # run SUT
+        timing.traced_put(put)(StringIO('x' * 10), '/remote/path')
+        with patch('security.connections.https_get',
+                   return_value=StringIO('y' * 20)):
+            response = security.fetch_url('https://sec.mock.com/secret/a')
+        self.assertEqual(response.read(), 'y' * 20)
+        with patch('sys.stderr'):
+            events = timing.finish()
+
+        by_category = dict((event['cat'], event) for event in events)
+        self.assertEqual(by_category['put']['args']['bytes'], 10)
+        self.assertEqual(by_category['https']['args']['bytes'], 20)
+        self.assertEqual(
+            by_category['https']['args']['host'], 'sec.mock.com')
+
+    def test_not_recording(self):
+        """ spans outside a trace should not be recorded anywhere """
+        self.assertFalse(timing.recording())
+        with timing.span("step", 'gpg'):
+            pass
+        self.assertEqual(timing.finish(), None)
+
+    def test_print_profile(self):
+        """ the profile should rank steps by their total time """
+        events = [
+            {'cat': 'run', 'name': 'a', 'dur': 1000000},
+            {'cat': 'run', 'name': 'b', 'dur': 1500000},
+            {'cat': 'run', 'name': 'a', 'dur': 1000000},
+            {'cat': 'command', 'name': 'herd x', 'dur': 9000000},
+            ]
+        with patch('sys.stderr') as mock_stderr:
+            timing.print_profile(events)
+        lines = ''.join(
+            c[0][0] for c in mock_stderr.write.call_args_list).splitlines()
+        self.assertEqual(lines[1].split(), ['2.00s', '2x', 'run', 'a'])
+        self.assertEqual(lines[2].split(), ['1.50s', '1x', 'run', 'b'])
+        self.assertEqual(len(lines), 3)
+
+    def test_main_trace(self):
+        """ herd --trace should write the command's span """
+        sys.argv = ['herd', '--trace', self.trace_path, '--profile', 'trivial']
+        with patch('sys.stderr'):
+            main()
+        with open(self.trace_path) as trace:
+            events = json.load(trace)['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['herd trivial'])
@@ -1,21 +1,50 @@
-
 import os
+import re
+import pipes
+import base64
+import shutil
+import tempfile
 import unittest
+import subprocess
+from mock import MagicMock as Mock
+from mock import patch
+from ConfigParser import NoOptionError
+
+from config import HerdConfig
 
 from commands import (
     project_root,
     unittest_cmd,
     service_name,
     )
+from helpers import (
+    run_sharded,
+    unittest_shards,
+    context_hash,
+    ship_context,
+    make_as_if_committed,
+    evict_builds,
+    pick_build_host,
+    build_host,
+    run_id,
+    run_cmd_in,
+    clean_up_runs,
+    gc_build_host,
+    )
+from commands import gc, integrate, report_stages
 
 
 class HerdUnittestTests(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.stop = []
 
     def tearDown(self):
-        pass
+        map(lambda p: p.stop(), self.stop)
+
+    def start(self, patcher):
+        self.stop.append(patcher)
+        return patcher.start()
 
     def test_project_root(self):
         """ ensure that the path reported by project root has a .git folder """
@@ -26,3 +55,430 @@ class HerdUnittestTests(unittest.TestCase):
 
     def test_unittest_cmd(self):
         self.assertEqual(unittest_cmd(), "python app/tests/test_herd.py")
+
+    def make_repo(self):
+        """ a git repo with a committed file and an ignored file pattern
+
+        returns the repo's root and functions to run git in it and write
+        files to it
+
+        """
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        def git(*args):
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(
+                    ['git', '-c', 'user.name=t', '-c', 'user.email=t@t']
+                    + list(args),
+                    cwd=root, stdout=devnull, stderr=devnull)
+        def write(name, content):
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(content)
+        git('init')
+        write('.gitignore', 'ignored\n')
+        write('a', 'a')
+        git('add', '.')
+        git('commit', '-m', 'a')
+        self.start(patch('helpers.project_root', return_value=root))
+        return root, git, write
+
+    def test_context_hash(self):
+        """ the context hash should change exactly when the context does """
+        # set up
+        root, git, write = self.make_repo()
+
+        # run SUT
+        committed = context_hash()
+        self.assertEqual(context_hash(), committed)
+
+        # ignored files don't count
+        write('ignored', 'x')
+        self.assertEqual(context_hash(), committed)
+
+        # changed and untracked files do, by content
+        write('a', 'b')
+        changed = context_hash()
+        self.assertNotEqual(changed, committed)
+        write('b', 'b')
+        untracked = context_hash()
+        self.assertNotEqual(untracked, changed)
+        write('b', 'c')
+        self.assertNotEqual(context_hash(), untracked)
+
+        # as do deletions
+        os.remove(os.path.join(root, 'b'))
+        write('a', 'a')
+        self.assertEqual(context_hash(), committed)
+        os.remove(os.path.join(root, 'a'))
+        self.assertNotEqual(context_hash(), committed)
+
+    def test_unchanged_context_skips_build(self):
+        """ a build of the same context should be reused """
+        # set up
+        self.start(patch('helpers.context_hash', return_value='f' * 64))
+        mock_on_build_host = self.start(patch('helpers.on_build_host'))
+        mock_ship = self.start(patch('helpers.ship_context'))
+        self.start(patch('helpers.evict_builds'))
+        build_name = "herd-unittest-herd:{}".format('f' * 32)
+
+        # run SUT
+        self.assertEqual(make_as_if_committed(''), build_name)
+
+        # one round trip found and touched the build
+        self.assertEqual(mock_on_build_host.call_count, 1)
+        self.assertTrue(mock_on_build_host.call_args[0][0].startswith(
+                "docker image inspect {} ".format(build_name)))
+        self.assertEqual(mock_ship.call_count, 0)
+
+        # without a kept build, or when rebuilding, the context is built
+        for build_flag, found in [('', False), ("--no-cache ", True)]:
+            mock_on_build_host.reset_mock()
+            mock_on_build_host.return_value.succeeded = found
+            self.assertEqual(make_as_if_committed(build_flag), build_name)
+            self.assertEqual(mock_ship.call_count, 1)
+            builds = [c[0][0] for c in mock_on_build_host.call_args_list
+                      if c[0][0].startswith("docker build ")]
+            self.assertEqual(len(builds), 1)
+            self.assertTrue(builds[0].endswith(
+                    " {}-t {} .".format(build_flag, build_name)))
+            self.assertTrue("--label io.herd.service=herd " in builds[0])
+            mock_ship.reset_mock()
+
+    def test_evict_builds(self):
+        """ the least recently used builds over the budget should go """
+        # set up
+        megabyte = 1024 * 1024
+        listing = Mock(failed=False)
+        listing.splitlines.return_value = [
+            "a_1 a:1 {}".format(4000 * megabyte),
+            "b_1 b:1 {}".format(4000 * megabyte),
+            "c_1 c:1 {}".format(4000 * megabyte),
+            "d_1 d:1 {}".format(1000 * megabyte),
+            ]
+        self.start(patch('helpers.run', return_value=listing))
+        mock_on_build_host = self.start(patch('helpers.on_build_host'))
+
+        # run SUT
+        evicted = evict_builds()
+
+        self.assertEqual(evicted, ['c:1', 'd:1'])
+        self.assertTrue(mock_on_build_host.call_args[0][0].startswith(
+                "docker rmi c:1 d:1;"))
+
+    def test_ship_git_delta(self):
+        """ git shipping should rebuild the context from a delta remotely """
+        # set up a build host that is really a local directory
+        root, git, write = self.make_repo()
+        build_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build_base)
+        build_path = os.path.join(build_base, 'herd')
+        self.start(patch('helpers.get_config', return_value=HerdConfig({
+                    'build_host': 'herd@build.mock.com:2222',
+                    'build_context_mode': 'git',
+                    })))
+        self.start(patch(
+                'helpers.ship_command',
+                side_effect=lambda host, cmd: "sh -c {}".format(
+                    pipes.quote(cmd))))
+        def shipped():
+            files = {}
+            for name in os.listdir(build_path):
+                if name != '.git':
+                    with open(os.path.join(build_path, name)) as f:
+                        files[name] = f.read()
+            return files
+
+        # run SUT
+        write('ignored', 'x')
+        write('b', 'b')
+        first_sent, seconds = ship_context(build_path)
+        self.assertEqual(
+            shipped(), {'.gitignore': 'ignored\n', 'a': 'a', 'b': 'b'})
+        # the shipped commit is remembered under a valid ref for the host
+        git('rev-parse', '--verify',
+            'refs/herd/shipped/herd_build.mock.com_2222')
+
+        # later commits and changes are sent as a delta
+        write('a', 'a2')
+        git('commit', '-am', 'a2')
+        write('a', 'a3')
+        os.remove(os.path.join(root, 'b'))
+        write('c', 'c')
+        ship_context(build_path)
+        self.assertEqual(
+            shipped(), {'.gitignore': 'ignored\n', 'a': 'a3', 'c': 'c'})
+
+        # a build host that lost its history gets all of it again
+        shutil.rmtree(build_path)
+        ship_context(build_path)
+        self.assertEqual(
+            shipped(), {'.gitignore': 'ignored\n', 'a': 'a3', 'c': 'c'})
+        self.assertFalse(os.path.exists(build_path + '.ship'))
+
+    def fake_probes(self, loads):
+        """ probes answering with each host's load average, cpus and running
+        containers, hosts not in loads fail to answer """
+        def probe_command(host):
+            if host not in loads:
+                return "exit 255"
+            load, cpus, containers = loads[host]
+            return "echo '{} 0.1 0.1 1/100 999'; echo {}; echo {}".format(
+                load, cpus, containers)
+        self.start(patch('helpers.probe_command', side_effect=probe_command))
+
+    def test_pick_build_host(self):
+        """ the least loaded host should be picked unless the host with the
+        last build context is close enough """
+        # set up
+        root, git, write = self.make_repo()
+        self.fake_probes({
+                'a.mock.com': (4.0, 4, 2),
+                'b.mock.com': (2.0, 4, 0),
+                'c.mock.com': (7.0, 2, 5),
+                })
+        hosts = ('a.mock.com', 'b.mock.com', 'c.mock.com', 'd.mock.com')
+
+        # run SUT
+        self.assertEqual(pick_build_host(hosts), 'b.mock.com')
+        git('config', 'herd.buildhost', 'a.mock.com')
+        self.assertEqual(pick_build_host(hosts), 'a.mock.com')
+        git('config', 'herd.buildhost', 'c.mock.com')
+        self.assertEqual(pick_build_host(hosts), 'b.mock.com')
+        git('config', 'herd.buildhost', 'd.mock.com')
+        self.assertEqual(pick_build_host(hosts), 'b.mock.com')
+
+    def test_pick_build_host_unreachable(self):
+        """ picking should abort when no host answers """
+        root, git, write = self.make_repo()
+        self.fake_probes({})
+        with self.assertRaises(SystemExit):
+            pick_build_host(('a.mock.com', 'b.mock.com'))
+
+    def test_build_host_pool(self):
+        """ a pool's host should be picked once and remembered when synced """
+        # set up
+        root, git, write = self.make_repo()
+        self.fake_probes({'a.mock.com': (3.0, 4, 0), 'b.mock.com': (1.0, 4, 0)})
+        self.start(patch('helpers.get_config', return_value=HerdConfig({
+                    'build_host': 'other.mock.com',
+                    'build_hosts': 'a.mock.com, b.mock.com',
+                    })))
+        self.start(patch('helpers.ship_rsync', return_value=0))
+        self.start(patch('helpers._picked_build_hosts', {}))
+
+        # run SUT
+        self.assertEqual(build_host(), 'b.mock.com')
+        self.assertEqual(build_host(), 'b.mock.com')
+        ship_context('/build/herd')
+
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'config', 'herd.buildhost'], cwd=root).strip(),
+            'b.mock.com')
+
+    def test_ship_rsync(self):
+        """ rsync shipping should report the bytes rsync sent """
+        # set up
+        mock_local = self.start(patch('helpers.local', return_value=(
+                    "Number of files: 10\nTotal bytes sent: 1,234\n"
+                    "Total bytes received: 56\n")))
+
+        # run SUT
+        sent, seconds = ship_context('/build/herd')
+
+        self.assertEqual(sent, 1234)
+        self.assertTrue(mock_local.call_args[0][0].startswith(
+                "rsync -rlz --stats "))
+        self.assertTrue(mock_local.call_args[0][0].endswith(
+                "localhost:/build/herd"))
+
+    def fake_build_host(self, exit_codes):
+        """ an on_build_host running a shard script with the exit codes
+
+        returns the mock and a list collecting the scripts it was sent
+
+        """
+
+        scripts = []
+        def on_build_host(cmd):
+            script = base64.b64decode(cmd.split()[1])
+            scripts.append(script)
+            token = re.search("HERD-STEP-[0-9a-f]+", script).group(0)
+            lines = ["{} begin start".format(token),
+                     "{} end start 0".format(token)]
+            for shard, code in enumerate(exit_codes):
+                lines += ["{} begin shard_{}".format(token, shard),
+                          "output of shard {}".format(shard),
+                          "{} end shard_{} {}".format(token, shard, code)]
+            return "\n".join(lines)
+        mock = self.start(patch('helpers.on_build_host',
+                                side_effect=on_build_host))
+        return mock, scripts
+
+    def test_run_sharded(self):
+        """ shards should run in their own containers and merge results """
+        # set up
+        mock_on_build_host, scripts = self.fake_build_host([0, 0, 0])
+
+        # run SUT
+        results = run_sharded("build:1", 3, "test --shard {shard}/{shards}")
+
+        # one round trip started and collected every shard
+        self.assertEqual(mock_on_build_host.call_count, 1)
+        for shard in range(3):
+            self.assertTrue(re.search(
+                    "docker run -d --name herd-shard-[0-9a-f]+-{0} .*"
+                    "--label io.herd.run={1} build:1 test --shard {0}/3".format(
+                        shard, run_id()), scripts[0]))
+        self.assertEqual(
+            [(r['shard'], r['exit_code'], r['output']) for r in results],
+            [(i, 0, "output of shard {}".format(i)) for i in range(3)],
+            )
+
+    def test_run_sharded_failure(self):
+        """ a failed shard should fail the whole run """
+        self.fake_build_host([0, 1])
+        with self.assertRaises(SystemExit):
+            run_sharded("build:1", 2, "test {shard}")
+
+    def test_clean_up_runs(self):
+        """ only the containers this invocation ran should be removed """
+        # set up
+        mock_on_build_host = self.start(patch('helpers.on_build_host'))
+
+        # run SUT
+        run_cmd_in("build:1", "test")
+        clean_up_runs()
+
+        run_cmd, clean_up_cmd = [
+            c[0][0] for c in mock_on_build_host.call_args_list]
+        self.assertTrue(
+            "--label io.herd.run={} build:1 test".format(run_id()) in run_cmd)
+        self.assertEqual(
+            clean_up_cmd,
+            "docker ps -aq --filter label=io.herd.run={} "
+            "| xargs -r docker rm -f".format(run_id()))
+
+    def test_clean_up_runs_in_background(self):
+        """ clean up in the background should be left running remotely """
+        mock_on_build_host = self.start(patch('helpers.on_build_host'))
+        clean_up_runs(background=True)
+        self.assertTrue(re.match(
+                r"nohup sh -c 'docker ps -aq --filter label=io.herd.run=\w+ "
+                r"\| xargs -r docker rm -f' >/dev/null 2>&1 </dev/null &$",
+                mock_on_build_host.call_args[0][0]))
+
+    def test_integrate(self):
+        """ integrate should ship ahead while fetching and time each stage """
+        # set up
+        mocks = dict(
+            (name, self.start(patch('commands.{}'.format(name))))
+            for name
+            in ['fetch_updates', 'merge_updates', '_unittest_', 'push',
+                'clean_up_runs', 'success']
+            )
+        self.start(patch('commands.build_host', return_value='build'))
+        self.start(patch('commands.build_context_path',
+                         return_value='/build/herd'))
+        self.start(patch('commands.on_build_host'))
+        mock_ship = self.start(patch('commands.ship_context'))
+
+        # run SUT
+        stages = integrate('rebuild')
+
+        self.assertEqual(
+            [stage[0] for stage in stages],
+            ['fetch', 'ship ahead', 'merge', 'unittest', 'push', 'clean up'])
+        mocks['_unittest_'].assert_called_with("--no-cache ")
+        mocks['clean_up_runs'].assert_called_with(True)
+
+        # a failure to ship ahead leaves it to the unit tests
+        mock_ship.side_effect = SystemExit(1)
+        self.assertEqual(len(integrate()), 6)
+
+    def test_report_stages(self):
+        """ the stage report should total the time overlapping saved """
+        with patch('sys.stdout') as mock_stdout:
+            report_stages(
+                [('fetch', 3.0), ('ship ahead', 2.0, 'overlapped fetch')], 3.5)
+        output = ''.join(c[0][0] for c in mock_stdout.write.call_args_list)
+        self.assertTrue("ship ahead       2.00s  (overlapped fetch)" in output)
+        self.assertTrue("3.50s  (1.50s saved by overlapping)" in output)
+
+    def test_gc_build_host(self):
+        """ pruning should report what was removed from the host """
+        # set up
+        self.start(patch('helpers.env', Mock(user='me')))
+        self.start(patch('helpers.get_config', return_value=HerdConfig({
+                    'build_base_path': '/build',
+                    })))
+        scripts = []
+        def run(cmd):
+            script = base64.b64decode(re.match(r"echo (\S+) ", cmd).group(1))
+            scripts.append(script)
+            token = re.search(r"HERD-STEP-\w+", script).group(0)
+            def step(name, output):
+                return "{0} begin {1}\n{2}\n{0} end {1} 0\n".format(
+                    token, name, output)
+            return (step("containers", "Deleted Containers:\n{}\n{}\n\n"
+                         "Total reclaimed space: 12kB".format(
+                        'a' * 64, 'b' * 64))
+                    + step("builds", "herd-unittest-svc:abc")
+                    + step("images", "Total reclaimed space: 0B"))
+        self.start(patch('helpers.run', side_effect=run))
+
+        # run SUT
+        result = gc_build_host('build.mock.com', 48)
+
+        self.assertEqual(result, {
+                'host': 'build.mock.com',
+                'ok': True,
+                'containers': 2,
+                'builds': ['herd-unittest-svc:abc'],
+                'reclaimed': ['12kB', '0B'],
+                })
+        self.assertTrue("--filter label=io.herd.user=me --filter until=48h"
+                        in scripts[0])
+        self.assertTrue("find /build/me/.herd_build_cache -maxdepth 1 "
+                        "-type f -mmin +2880 " in scripts[0])
+
+        # every user's objects
+        gc_build_host('build.mock.com', 1, all_users=True)
+        self.assertTrue("--filter label=io.herd.service --filter until=1h"
+                        in scripts[1])
+        self.assertTrue("find /build/*/.herd_build_cache " in scripts[1])
+
+    def test_gc(self):
+        """ gc should prune every build host and fail if one did """
+        # set up
+        self.start(patch('commands.build_hosts', return_value=('a',)))
+        mock_gc_build_host = self.start(patch(
+                'commands.gc_build_host', return_value={
+                    'host': 'a', 'ok': True, 'containers': 1, 'builds': [],
+                    'reclaimed': []}))
+
+        # run SUT
+        gc('--hours', '6')
+        mock_gc_build_host.assert_called_with('a', 6, False)
+        gc('--all-users')
+        mock_gc_build_host.assert_called_with('a', 24, True)
+
+        mock_gc_build_host.side_effect = SystemExit(1)
+        with self.assertRaises(SystemExit):
+            gc()
+
+    def test_unittest_shards(self):
+        """ shards are only used when the Manifest asks for more than one """
+        options = {'unittest_shards': '4', 'unittest_shard_cmd': 'test'}
+        def manifest(section, option):
+            if option not in options:
+                raise NoOptionError(option, section)
+            return options[option]
+        self.start(patch('helpers.manifest', side_effect=manifest))
+
+        self.assertEqual(unittest_shards(), (4, 'test'))
+        options['unittest_shards'] = '1'
+        self.assertEqual(unittest_shards(), None)
+        del options['unittest_shards']
+        self.assertEqual(unittest_shards(), None)
@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# how many of the biggest time sinks the profile lists
+profile_top = 10
+
+# span names are cut to this many characters, the full command is kept in
+# the span's args
+span_name_length = 80
+
+# while recording, the file every process appends its spans to as one JSON
+# trace event a line, and the time the trace starts at
+_recording = {}
+
+# what instrument replaced, so it can be put back
+_instrumented = []
+
+
+def start():
+    """ record a span for every step from now on, in every process
+
+    the spans are collected by finish
+
+    """
+
+    if _recording:
+        return
+    spans_file, path = tempfile.mkstemp(prefix='herd-trace-')
+    os.close(spans_file)
+    _recording.update({'path': path, 'origin': time.time()})
+    instrument()
+
+
+def recording():
+    return bool(_recording)
+
+
+def record(name, category, started, seconds, **args):
+    """ record a span that started at the time started and took seconds """
+    if not _recording:
+        return
+    event = {
+        'name': name[:span_name_length],
+        'cat': category,
+        'ph': 'X',
+        'ts': int((started - _recording['origin']) * 1000000),
+        'dur': int(seconds * 1000000),
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': dict((key, value) for key, value in args.items()
+                     if value is not None),
+        }
+    # appending a line at a time keeps the spans of forked workers apart
+    with open(_recording['path'], 'a') as spans:
+        spans.write(json.dumps(event) + '\n')
+
+
+@contextmanager
+def span(name, category, **args):
+    """ record the time the block takes as a span
+
+    yields the span's args, so the block can add to them
+
+    """
+
+    started = time.time()
+    try:
+        yield args
+    finally:
+        record(name, category, started, time.time() - started, **args)
+
+
+class ReadSpan(object):
+    """ a file object recording a span from started until it is read to its
+    end or closed, with the bytes read """
+
+    def __init__(self, fileobj, name, category, started, **args):
+        self.fileobj = fileobj
+        self.name = name
+        self.category = category
+        self.started = started
+        self.args = args
+        self.position = 0
+        self.finished = False
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        if size < 0 or not data:
+            self.finish()
+        return data
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        record(self.name, self.category, self.started,
+               time.time() - self.started, bytes=self.position, **self.args)
+
+    def close(self):
+        self.finish()
+        self.fileobj.close()
+
+
+def finish(trace_path=None, profile=False):
+    """ stop recording, write the spans to trace_path as a Chrome trace and
+    print the profile if asked to """
+
+    if not _recording:
+        return
+    uninstrument()
+    path = _recording.pop('path')
+    _recording.clear()
+    with open(path) as spans:
+        events = [json.loads(line) for line in spans if line.strip()]
+    os.remove(path)
+
+    if trace_path is not None:
+        with open(trace_path, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+        print >> sys.stderr, "---> Wrote a trace of {} spans to {}".format(
+            len(events), trace_path)
+    if profile:
+        print_profile(events)
+    return events
+
+
+def print_profile(events, top=profile_top):
+    """ print the steps that took the most time in total, on stderr """
+    totals = defaultdict(lambda: [0, 0])
+    for event in events:
+        if event['cat'] == 'command':
+            continue
+        total = totals[(event['cat'], event['name'])]
+        total[0] += event['dur']
+        total[1] += 1
+    print >> sys.stderr, "---> Top time sinks"
+    ranked = sorted(totals.items(), key=lambda item: -item[1][0])
+    for (category, name), (duration, count) in ranked[:top]:
+        print >> sys.stderr, "    {:>9.2f}s {:>4}x  {:<6} {}".format(
+            duration / 1000000.0, count, category, name)
+
+
+def instrument():
+    """ trace fabric's operations and every sqlalchemy query
+
+    fabric's run, sudo, local, put and get are replaced in fabric.api and in
+    every module that already imported them, so commands must be loaded after
+    this to be traced.
+
+    """
+
+    import fabric.api
+    originals = dict(
+        (name, getattr(fabric.api, name))
+        for name
+        in ['run', 'sudo', 'local', 'put', 'get']
+        )
+    wrappers = {
+        'run': traced_command(originals['run'], 'run'),
+        'sudo': traced_command(originals['sudo'], 'sudo'),
+        'local': traced_command(originals['local'], 'local'),
+        'put': traced_put(originals['put']),
+        'get': traced_get(originals['get']),
+        }
+    for module in list(sys.modules.values()):
+        for name, original in originals.items():
+            if module is not None and getattr(module, name, None) is original:
+                _instrumented.append((module, name, original))
+                setattr(module, name, wrappers[name])
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.listen(Engine, 'before_cursor_execute', _before_query)
+    event.listen(Engine, 'after_cursor_execute', _after_query)
+
+
+def uninstrument():
+    """ put back what instrument replaced """
+    while _instrumented:
+        module, name, original = _instrumented.pop()
+        setattr(module, name, original)
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if event.contains(Engine, 'before_cursor_execute', _before_query):
+        event.remove(Engine, 'before_cursor_execute', _before_query)
+        event.remove(Engine, 'after_cursor_execute', _after_query)
+
+
+def traced_command(operation, category):
+    """ operation, recording a span with the host, command and output size """
+    def traced(command, *args, **kwargs):
+        from fabric.api import env
+        host = 'localhost' if category == 'local' else env.host_string
+        with span(command, category, host=host, command=command) as details:
+            result = operation(command, *args, **kwargs)
+            details['bytes'] = len(result or '')
+        return result
+    return traced
+
+
+def traced_put(operation):
+    """ fabric's put, recording a span with the host and bytes sent """
+    def traced(local_path=None, remote_path=None, *args, **kwargs):
+        from fabric.api import env
+        name = "put {}".format(remote_path)
+        with span(name, 'put', host=env.host_string) as details:
+            # fabric seeks a file object back to where it was once it is
+            # uploaded, so it is measured first
+            size = put_size(local_path)
+            result = operation(local_path, remote_path, *args, **kwargs)
+            if size is None and hasattr(local_path, 'tell'):
+                # a stream that can't seek has been read through by now
+                size = local_path.tell()
+            details['bytes'] = size
+        return result
+    return traced
+
+
+def put_size(local_path):
+    """ the bytes in the file object or file at local_path, None if that
+    can't be told without reading it """
+    if hasattr(local_path, 'tell'):
+        position = local_path.tell()
+        try:
+            local_path.seek(0, 2)
+            return local_path.tell()
+        except IOError:
+            return None
+        finally:
+            local_path.seek(position)
+    if local_path is not None and os.path.isfile(local_path):
+        return os.path.getsize(local_path)
+    return None
+
+
+def traced_get(operation):
+    """ fabric's get, recording a span with the host and bytes received """
+    def traced(remote_path, local_path=None, *args, **kwargs):
+        from fabric.api import env
+        name = "get {}".format(remote_path)
+        with span(name, 'get', host=env.host_string) as details:
+            result = operation(remote_path, local_path, *args, **kwargs)
+            details['bytes'] = sum(
+                os.path.getsize(path) for path in result or []
+                if os.path.isfile(path))
+        return result
+    return traced
+
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('herd_query_started', []).append(time.time())
+
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    if not conn.info.get('herd_query_started'):
+        return
+    started = conn.info['herd_query_started'].pop()
+    record(' '.join(statement.split()), 'sql', started,
+           time.time() - started, host=str(conn.engine.url.host or 'local'),
+           command=statement, rows=cursor.rowcount)